@@ -1,13 +1,27 @@
 from flask import Flask
 from flask_cors import CORS
+import logging
 import os
 
+# 日志需在导入其他模块之前配置，模块导入时（如加载 config.json）就会输出日志
+from .logging_setup import setup_logging
+setup_logging()
+
 # Import configuration functions
 from . import config as app_config
 
+logger = logging.getLogger(__name__)
+
 def create_app():
     """Factory function to create the Flask application."""
     app = Flask(__name__)
+
+    # 部署在反向代理之后时，按代理层数从 X-Forwarded-* 中取出客户端地址（限流按该地址计数）
+    trusted_proxies = int(os.getenv('TRUSTED_PROXIES', '0'))
+    if trusted_proxies > 0:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies, x_proto=trusted_proxies)
+        logger.info("已启用ProxyFix，信任 %s 层代理", trusted_proxies)
     
     # 根据环境变量配置CORS
     if os.getenv('FLASK_ENV') == 'production':
@@ -20,7 +34,7 @@ def create_app():
              expose_headers=["Content-Length", "Content-Type"],
              supports_credentials=True
         )
-        print(f"生产环境CORS配置已启用，允许的源: {allowed_origins}")
+        logger.info("生产环境CORS配置已启用，允许的源: %s", allowed_origins)
     else:
         # 开发环境：允许所有源
         CORS(app,
@@ -30,14 +44,26 @@ def create_app():
              expose_headers=["Content-Length", "Content-Type"],
              supports_credentials=True
         )
-        print("开发环境CORS配置已启用，支持所有源。")
+        logger.info("开发环境CORS配置已启用，支持所有源。")
 
-    print("Loading initial Dify configuration...")
+    logger.info("Loading initial Dify configuration...")
     app_config.load_config()
 
     from .routes.main_routes import init_blueprints
     init_blueprints(app)
-    print("Registered all blueprints.")
+    logger.info("Registered all blueprints.")
+
+    # 按请求开启的性能剖析，先于限流注册，排队等待时间也会计入
+    from .services import profiler
+    profiler.init_app(app)
+
+    # 按用户/模型/路由类别的限流与并发控制
+    from .services import rate_limiter
+    rate_limiter.init_app(app)
+
+    # 空闲对话的自动压缩归档
+    from .services import history_tiering
+    history_tiering.init_app(app)
 
     @app.route('/')
     def index():
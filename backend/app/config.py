@@ -1,47 +1,225 @@
 import json
+import logging
 import os
+import threading
+import time
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
 
 
 CONFIG_FILE = os.path.join(os.path.dirname(__file__), '..', 'config.json') # Place config.json in backend/ root
+CONFIG_LOCK_FILE = CONFIG_FILE + '.lock'
+# 两次检查 config.json 是否变化的最小间隔（秒）；每个 worker 独立检查，修改后在该间隔内生效
+CONFIG_CHECK_INTERVAL = float(os.getenv('CONFIG_CHECK_INTERVAL', '0.05'))
 
+_EMPTY = MappingProxyType({})
 
-_model_configs = {}
 
-def load_config():
-    """Loads all model configurations from CONFIG_FILE into memory."""
-    global _model_configs
-    _model_configs = {} # Reset before loading
-    if os.path.exists(CONFIG_FILE):
+class _Snapshot:
+    """
+    某一时刻 config.json 的只读快照。加载时完成端点解析，查询时直接返回只读视图，无需复制。
+    重新加载时整体替换模块级的 _snapshot 引用，正在处理的请求继续使用旧快照。
+    """
+    __slots__ = ('signature', 'configs', 'endpoints')
+
+    def __init__(self, signature, raw_configs):
+        self.signature = signature
+        configs = {}
+        endpoints = {}
+        for model_id, config in raw_configs.items():
+            model_endpoints = tuple(MappingProxyType(e) for e in _normalize_endpoints(config))
+            config = dict(config) if isinstance(config, dict) else {}
+            # 多端点配置时 api_url/api_key 取第一个端点
+            if model_endpoints and not config.get('api_url'):
+                config['api_url'] = model_endpoints[0]['api_url']
+                config['api_key'] = model_endpoints[0]['api_key']
+            configs[model_id] = MappingProxyType(config)
+            endpoints[model_id] = model_endpoints
+        self.configs = MappingProxyType(configs)
+        self.endpoints = MappingProxyType(endpoints)
+
+    def with_signature(self, signature):
+        """内容不变、文件签名更新的快照"""
+        snapshot = _Snapshot(signature, {})
+        snapshot.configs, snapshot.endpoints = self.configs, self.endpoints
+        return snapshot
+
+
+_snapshot = _Snapshot(None, {})
+_next_check = 0.0
+_reload_lock = threading.Lock()
+
+
+def _file_signature():
+    """config.json 的 (mtime_ns, size, inode)，文件不存在时为 None。原子替换会改变 inode"""
+    try:
+        st = os.stat(CONFIG_FILE)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _read_config_file():
+    """读取并校验 config.json，返回模型配置字典；格式错误时抛出 ValueError"""
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
         try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                loaded_config = json.load(f)
-                # Assume new format: keys are model IDs
-                if isinstance(loaded_config, dict):
-                    _model_configs = loaded_config
-                    print(f"Loaded model configs from {CONFIG_FILE}")
-                    for model_id, config in _model_configs.items():
-                        url = config.get('api_url', 'None')
-                        key_status = '***' if config.get('api_key') else 'None'
-                        print(f"  - Model {model_id}: URL={url}, Key={key_status}")
-                else:
-                    print(f"Warning: Config file {CONFIG_FILE} does not contain a valid dictionary. Using empty config.")
-
-        except json.JSONDecodeError:
-            print(f"Error: Could not decode JSON from config file {CONFIG_FILE}. Using empty config.")
-            _model_configs = {}
-        except Exception as e:
-            print(f"Error loading config file {CONFIG_FILE}: {e}. Using empty config.")
-            _model_configs = {}
+            loaded_config = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Could not decode JSON: {e}")
+    # Assume new format: keys are model IDs
+    if not isinstance(loaded_config, dict):
+        raise ValueError("config does not contain a valid dictionary")
+    return loaded_config
+
+
+def _describe_changes(old, new):
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    changed = sorted(m for m in set(old) & set(new) if old[m] != new[m])
+    parts = []
+    if added:
+        parts.append(f"added {', '.join(added)}")
+    if removed:
+        parts.append(f"removed {', '.join(removed)}")
+    if changed:
+        parts.append(f"changed {', '.join(changed)}")
+    return '; '.join(parts) or 'no model changes'
+
+
+def _reload(signature):
+    """按文件当前内容替换快照。文件损坏时保留上一份有效快照（首次加载则为空配置）"""
+    global _snapshot
+    old = _snapshot
+    if signature is None:
+        logger.warning("Config file %s not found. Using default empty config.", CONFIG_FILE)
+        _snapshot = _Snapshot(None, {})
+        return
+    try:
+        raw_configs = _read_config_file()
+    except (OSError, ValueError) as e:
+        if old.signature is None:
+            logger.error("Error loading config file %s: %s. Using empty config.", CONFIG_FILE, e)
+        else:
+            logger.error("Error reloading config file %s: %s. Keeping previous config.", CONFIG_FILE, e)
+        # 记下签名，文件再次变化前不重复解析
+        _snapshot = old.with_signature(signature)
+        return
+    _snapshot = _Snapshot(signature, raw_configs)
+    multi = sum(1 for e in _snapshot.endpoints.values() if len(e) > 1)
+    summary = f"{len(raw_configs)} models" + (f", {multi} with multiple endpoints" if multi else '')
+    if old.signature is None:
+        logger.info("Loaded model configs from %s: %s", CONFIG_FILE, summary)
     else:
-        print(f"Config file {CONFIG_FILE} not found. Using default empty config.")
+        logger.info("Reloaded model configs from %s: %s (%s)", CONFIG_FILE, summary,
+                    _describe_changes(old.configs, _snapshot.configs))
+
+
+def _current():
+    """返回当前快照；距上次检查超过 CONFIG_CHECK_INTERVAL 时先检查文件是否变化"""
+    global _next_check
+    now = time.monotonic()
+    if now < _next_check:
+        return _snapshot
+    with _reload_lock:
+        if now >= _next_check:
+            signature = _file_signature()
+            if signature != _snapshot.signature:
+                _reload(signature)
+            _next_check = time.monotonic() + CONFIG_CHECK_INTERVAL
+    return _snapshot
+
+
+def load_config():
+    """立即从 CONFIG_FILE 重新加载全部模型配置（之后文件变化会自动重新加载）"""
+    global _next_check
+    with _reload_lock:
+        _reload(_file_signature())
+        _next_check = time.monotonic() + CONFIG_CHECK_INTERVAL
+
+def _normalize_endpoints(config):
+    """
+    解析模型的上游端点列表。支持两种格式：
+      {"api_url": ..., "api_key": ...}                          单端点
+      {"endpoints": [{"api_url": ..., "api_key": ..., "name": 可选}, ...]}  多端点
+    端点 id 默认为去掉末尾斜杠的 api_url，同一地址的多个应用需配置不同的 name。
+    """
+    if not isinstance(config, dict):
+        return []
+    raw = config.get('endpoints') or [config]
+    endpoints = []
+    for item in raw:
+        if not isinstance(item, dict) or not item.get('api_url') or not item.get('api_key'):
+            continue
+        api_url = item['api_url'].rstrip('/')
+        endpoints.append({
+            "id": item.get('name') or api_url,
+            "api_url": api_url,
+            "api_key": item['api_key'],
+        })
+    return endpoints
+
 
 def get_model_config(model: str):
-    """返回指定模型的配置，如果不存在则返回空字典"""
-    return _model_configs.get(model, {}).copy()
+    """返回指定模型的配置（只读映射），如果不存在则返回空映射（多端点配置时 api_url/api_key 取第一个端点）"""
+    return _current().configs.get(model, _EMPTY)
+
+
+def get_model_endpoints(model: str) -> tuple:
+    """返回指定模型的全部上游端点（只读）({"id", "api_url", "api_key"}, ...)，未配置时返回空元组"""
+    return _current().endpoints.get(model, ())
 
 def get_all_configs():
-    """返回所有模型的配置"""
-    return _model_configs.copy()
+    """返回所有模型的配置（只读映射）"""
+    return _current().configs
+
+
+def get_configs_for_frontend():
+    """返回可展示给前端的配置摘要，不包含 API 密钥"""
+    snapshot = _current()
+    return {
+        model_id: {
+            "api_url": config.get('api_url'),
+            "api_key_set": bool(config.get('api_key')),
+            "endpoints": [endpoint['id'] for endpoint in snapshot.endpoints[model_id]],
+        }
+        for model_id, config in snapshot.configs.items()
+    }
+
+
+def save_config(model: str, api_url: str, api_key: str):
+    """
+    新增或更新单端点模型的 api_url/api_key 并写回 config.json（原子替换）。
+    其他 worker 在 CONFIG_CHECK_INTERVAL 内检测到文件变化后自动生效。
+
+    Raises:
+        ValueError: 参数不合法，或该模型使用多端点配置（需直接编辑 config.json）。
+    """
+    from .services.locking import file_lock
+
+    model = (model or '').strip()
+    api_url = (api_url or '').strip()
+    api_key = (api_key or '').strip()
+    if not model or not api_url or not api_key:
+        raise ValueError("model、api_url 和 api_key 不能为空")
+    if not api_url.startswith(('http://', 'https://')):
+        raise ValueError("api_url 必须以 http:// 或 https:// 开头")
+
+    with file_lock(CONFIG_LOCK_FILE):
+        raw_configs = _read_config_file() if os.path.exists(CONFIG_FILE) else {}
+        entry = raw_configs.get(model)
+        entry = dict(entry) if isinstance(entry, dict) else {}
+        if entry.get('endpoints'):
+            raise ValueError(f"{model} 配置了多个端点，请直接编辑 config.json")
+        entry['api_url'] = api_url
+        entry['api_key'] = api_key
+        raw_configs[model] = entry
+
+        temp_file = CONFIG_FILE + f'.{os.getpid()}.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(raw_configs, f, ensure_ascii=False, indent=4)
+        os.replace(temp_file, CONFIG_FILE)
+    load_config()
 
 
-load_config()
\ No newline at end of file
+load_config()
@@ -0,0 +1,172 @@
+"""
+日志配置。
+
+各模块使用 logging.getLogger(__name__) 并以 %s 占位符传参，级别未启用时不会格式化消息。
+日志记录先放入有界内存队列，由后台线程格式化并写出，请求线程不等待 I/O；
+队列满时丢弃新记录并计数，不阻塞请求。
+
+环境变量：
+  LOG_LEVEL         日志级别（默认 INFO；DEBUG 会输出完整请求 payload 的截断预览）
+  LOG_FORMAT        text | json（默认 text；json 每行一个对象，extra 字段原样输出）
+  LOG_FIELD_LIMIT   truncate() 截断后的最大字符数（默认 2000）
+  LOG_QUEUE_SIZE    队列容量（默认 10000）
+
+高频事件可在 extra 中指定 sample_rate（0~1），只按比例保留，例如：
+  logger.info("chunk received", extra={"sample_rate": 0.01})
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+LOG_FIELD_LIMIT = int(os.getenv('LOG_FIELD_LIMIT', '2000'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# LogRecord 自带的属性，json 格式下其余属性视为 extra 字段输出
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'sample_rate'}
+
+
+def _shrink(value, limit, depth=0):
+    """截断嵌套结构中的长字符串与长列表"""
+    if isinstance(value, str):
+        return value if len(value) <= limit else f"{value[:limit]}...({len(value)} chars)"
+    if depth > 8:
+        return '...'
+    if isinstance(value, dict):
+        return {k: _shrink(v, limit, depth + 1) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [_shrink(v, limit, depth + 1) for v in value[:20]]
+        if len(value) > 20:
+            items.append(f"...({len(value)} items)")
+        return items
+    return value
+
+
+class truncate:
+    """
+    延迟截断：只有日志真正被格式化时才序列化并截断参数，用于可能很大的 payload。
+
+        logger.debug("payload: %s", truncate(payload))
+    """
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit or LOG_FIELD_LIMIT
+
+    def __str__(self):
+        value = self.value
+        if not isinstance(value, str):
+            try:
+                # 先截断嵌套的长字符串，避免为了输出前几 KB 而序列化整个大对象
+                value = json.dumps(_shrink(value, self.limit), ensure_ascii=False, default=str)
+            except (TypeError, ValueError):
+                value = repr(value)
+        if len(value) <= self.limit:
+            return value
+        return f"{value[:self.limit]}...(truncated, {len(value)} chars)"
+
+    __repr__ = __str__
+
+
+class _SamplingFilter(logging.Filter):
+    """按记录的 sample_rate 属性随机保留"""
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', None)
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出一行 JSON"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    非阻塞的队列 handler：不在调用线程格式化消息（交给后台线程），队列满时丢弃并计数。
+    gunicorn fork 出 worker 后后台线程不会被继承，首次写日志时在当前进程重新启动。
+    """
+
+    def __init__(self, target):
+        super().__init__(queue.Queue(LOG_QUEUE_SIZE))
+        self.target = target
+        self.dropped = 0
+        self._pid = None
+        self._listener = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(LOG_QUEUE_SIZE)
+            self._listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # 默认实现会在调用线程格式化消息；异常信息同样留给后台线程格式化
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                sys.stderr.write(f"logging queue full, {self.dropped} records dropped so far\n")
+
+    def stop(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._pid = None
+
+
+_handler = None
+
+
+def setup_logging():
+    """配置根 logger（可重复调用，只生效一次）"""
+    global _handler
+    if _handler is not None:
+        return
+    target = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'))
+
+    _handler = _AsyncQueueHandler(target)
+    _handler.addFilter(_SamplingFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(_handler)
+    root.setLevel(LOG_LEVEL)
+    # urllib3 的连接池调试信息量大，只保留警告
+    logging.getLogger('urllib3').setLevel(max(logging.WARNING, root.level))
+    atexit.register(_handler.stop)
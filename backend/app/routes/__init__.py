@@ -1,5 +1,8 @@
 from app.routes.chat_routes import chat_bp
 from app.routes.history_routes import history_bp
+from app.routes.analysis_routes import analysis_bp
+from app.routes.config_routes import config_bp
+from app.routes.metrics_routes import metrics_bp
 
 
-__all__ = ['chat_bp', 'history_bp']
+__all__ = ['chat_bp', 'history_bp', 'analysis_bp', 'config_bp', 'metrics_bp']
@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import time
+from flask import Blueprint, request, jsonify
+from werkzeug.utils import secure_filename
+from ..services import xref_service, diff_service, ghidra_service, batch_service, blob_store
+
+logger = logging.getLogger(__name__)
+
+# 创建分析结果查询路由蓝图
+analysis_bp = Blueprint('analysis', __name__, url_prefix='/chat/analysis')
+
+
+def _load_index_and_function(analysis_id, function):
+    """加载索引并解析函数，返回 (index, entry, error_response)"""
+    try:
+        index = xref_service.get_index(analysis_id)
+    except ValueError as e:
+        return None, None, (jsonify({"error": str(e)}), 400)
+    except FileNotFoundError:
+        return None, None, (jsonify({"error": "分析结果不存在，请先执行二进制分析"}), 404)
+    entry = index.resolve(function)
+    if entry is None:
+        return index, None, (jsonify({"error": f"函数 '{function}' 未找到"}), 404)
+    return index, entry, None
+
+
+# 获取函数的全部交叉引用 - /chat/analysis/<id>/xrefs/<function>
+@analysis_bp.route('/<string:analysis_id>/xrefs/<string:function>', methods=['GET'])
+def get_function_xrefs(analysis_id, function):
+    """获取函数的调用者、被调用者、导入API与字符串引用"""
+    index, entry, error = _load_index_and_function(analysis_id, function)
+    if error:
+        return error
+    return jsonify({
+        **index.describe(entry),
+        "callers": index.get_callers(entry),
+        "callees": index.get_callees(entry),
+        "imported_apis": index.imports.get(entry, []),
+        "string_refs": index.strings.get(entry, []),
+    })
+
+
+@analysis_bp.route('/<string:analysis_id>/xrefs/<string:function>/callers', methods=['GET'])
+def get_function_callers(analysis_id, function):
+    """获取调用该函数的函数列表"""
+    index, entry, error = _load_index_and_function(analysis_id, function)
+    if error:
+        return error
+    return jsonify({**index.describe(entry), "callers": index.get_callers(entry)})
+
+
+@analysis_bp.route('/<string:analysis_id>/xrefs/<string:function>/callees', methods=['GET'])
+def get_function_callees(analysis_id, function):
+    """获取该函数调用的函数列表"""
+    index, entry, error = _load_index_and_function(analysis_id, function)
+    if error:
+        return error
+    return jsonify({**index.describe(entry), "callees": index.get_callees(entry)})
+
+
+@analysis_bp.route('/<string:analysis_id>/xrefs/<string:function>/neighborhood', methods=['GET'])
+def get_function_neighborhood(analysis_id, function):
+    """获取函数的k跳调用邻域 (?k=2&direction=both|callers|callees&limit=500)"""
+    index, entry, error = _load_index_and_function(analysis_id, function)
+    if error:
+        return error
+    direction = request.args.get('direction', 'both')
+    if direction not in ('both', 'callers', 'callees'):
+        return jsonify({"error": "direction 必须为 both、callers 或 callees"}), 400
+    try:
+        hops = int(request.args.get('k', 1))
+        limit = int(request.args.get('limit', xref_service.DEFAULT_NEIGHBORHOOD_LIMIT))
+    except ValueError:
+        return jsonify({"error": "k 和 limit 必须为整数"}), 400
+    result = index.neighborhood(entry, hops=hops, direction=direction, limit=limit)
+    return jsonify({**index.describe(entry), **result})
+
+
+@analysis_bp.route('/<string:analysis_id>/apis/<string:api_name>/callers', methods=['GET'])
+def get_api_callers(analysis_id, api_name):
+    """获取引用指定导入API的函数列表"""
+    try:
+        index = xref_service.get_index(analysis_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except FileNotFoundError:
+        return jsonify({"error": "分析结果不存在，请先执行二进制分析"}), 404
+    callers = [index.describe(e) for e in index.api_callers.get(api_name, ())]
+    return jsonify({"api": api_name, "callers": callers})
+
+
+# 版本差异分析 - /chat/analysis/diff
+@analysis_bp.route('/diff', methods=['POST'])
+def diff_analyses_route():
+    """
+    比较两个版本的分析结果。
+    请求体: {"base": 旧分析ID, "target": 新分析ID}
+       或: {"base": 旧分析ID, "filename": 新上传的二进制文件名}
+    后一种情况会先分析新二进制，未变化函数直接复用旧版本的反编译结果。
+    返回的 changed/added 为需要重新交给 LLM 分析的函数，unchanged 可沿用已有结论。
+    """
+    data = request.json or {}
+    base_id = data.get('base')
+    target_id = data.get('target')
+    filename = data.get('filename')
+    if not base_id or not (target_id or filename):
+        return jsonify({"error": "缺少 base 以及 target 或 filename 参数"}), 400
+
+    try:
+        base = diff_service.load_analysis(base_id)
+        if filename:
+            filename = secure_filename(filename)
+            file_path = blob_store.resolve(filename)
+            if not file_path:
+                return jsonify({"error": "文件不存在"}), 404
+            sha256 = blob_store.lookup(filename)
+            target = ghidra_service.run_analysis(
+                file_path,
+                ghidra_service.get_output_path(filename),
+                previous_analysis=xref_service.get_analysis_path(base_id),
+                sha256=sha256
+            )
+            if sha256:
+                blob_store.add_ref(sha256, f"analysis:{filename}")
+            target_id = filename
+        else:
+            target = diff_service.load_analysis(target_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    except ghidra_service.GhidraError as e:
+        return jsonify({"error": str(e), "stderr": e.stderr}), 500
+    except Exception as e:
+        logger.exception("差异分析异常: %s", e)
+        return jsonify({"error": f"差异分析失败: {str(e)}"}), 500
+
+    result = diff_service.diff_analyses(base, target)
+    result["stats"]["reused_decompilation"] = sum(1 for f in target.get('functions', []) if f.get('reused'))
+    return jsonify({"success": True, "base": base_id, "target": target_id, **result})
+
+
+# 在已分析的持久化项目上运行额外的导出脚本 - /chat/analysis/<id>/scripts/<script>
+@analysis_bp.route('/<string:analysis_id>/scripts/<string:script_name>', methods=['POST'])
+def run_followup_script(analysis_id, script_name):
+    """复用已导入的Ghidra项目运行 uploads/analyse/ 下的脚本，脚本通过 OUTPUT_FILE 写出JSON"""
+    filename = secure_filename(analysis_id)
+    script_name = secure_filename(script_name)
+    file_path = blob_store.resolve(filename)
+    script_path = os.path.join(ghidra_service.SCRIPT_DIR, script_name)
+    if not file_path:
+        return jsonify({"error": "文件不存在"}), 404
+    if not script_name.endswith(('.py', '.java')) or not os.path.exists(script_path):
+        return jsonify({"error": f"脚本 '{script_name}' 不存在"}), 404
+
+    output_json = os.path.join(ghidra_service.UPLOAD_DIR, f"{filename}_{os.path.splitext(script_name)[0]}.json")
+    try:
+        started = time.time()
+        reused = ghidra_service.run_script(file_path, script_path, {'OUTPUT_FILE': output_json},
+                                           sha256=blob_store.lookup(filename))
+        # 同名的旧输出不算本次生成的结果（脚本在 -process 下静默失败时不会覆盖它）
+        if not os.path.exists(output_json) or os.path.getmtime(output_json) < started - 1:
+            return jsonify({"error": "脚本未生成输出", "project_reused": reused}), 500
+        with open(output_json, 'r', encoding='utf-8') as f:
+            return jsonify({"success": True, "project_reused": reused, "result": json.load(f)})
+    except ghidra_service.GhidraError as e:
+        return jsonify({"error": str(e), "stderr": e.stderr}), 500
+    except Exception as e:
+        logger.exception("脚本执行异常: %s", e)
+        return jsonify({"error": f"脚本执行失败: {str(e)}"}), 500
+
+
+# 查看持久化的Ghidra项目 - /chat/analysis/projects
+@analysis_bp.route('/projects', methods=['GET'])
+def list_ghidra_projects():
+    """列出项目存储中的Ghidra项目及其磁盘占用"""
+    projects = ghidra_service.list_projects()
+    return jsonify({
+        "projects": projects,
+        "total_bytes": sum(p['size_bytes'] for p in projects),
+        "quota_bytes": ghidra_service.PROJECT_QUOTA_MB * 1024 * 1024,
+    })
+
+
+# 批量分析 - /chat/analysis/batch
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+
+@analysis_bp.route('/batch', methods=['POST'])
+def submit_batch_route():
+    """提交批量分析：multipart 字段 files（多个二进制）和/或 archive（zip/tar 压缩包）"""
+    files, archives = [], []
+    for storage in request.files.getlist('files') + request.files.getlist('archive'):
+        if not storage.filename:
+            continue
+        if storage.filename.lower().endswith(ARCHIVE_EXTENSIONS):
+            archives.append((storage.filename, storage))
+        else:
+            files.append((storage.filename, storage))
+    if not files and not archives:
+        return jsonify({"error": "未找到上传文件"}), 400
+
+    try:
+        manifest = batch_service.submit_batch(files, archives)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.exception("批量分析提交失败: %s", e)
+        return jsonify({"error": f"批量分析提交失败: {str(e)}"}), 500
+    return jsonify({**batch_service.summarize(manifest), "jobs": manifest['jobs']}), 202
+
+
+@analysis_bp.route('/batch/<string:batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    """获取批次进度；全部完成后 jobs 即为各二进制的结果清单（提交进程已退出的任务会被重新提交）"""
+    manifest = batch_service.resume_orphaned_jobs(batch_id)
+    if manifest is None:
+        return jsonify({"error": "批次不存在"}), 404
+    return jsonify({**batch_service.summarize(manifest), "jobs": manifest['jobs']})
@@ -1,11 +1,18 @@
-from flask import Blueprint, request, jsonify, Response, send_file
+from flask import Blueprint, request, jsonify, Response, send_file, make_response
+import functools
 import requests
 import json
+import logging
 import os
+import time
 from werkzeug.utils import secure_filename
 from .. import config as app_config
-from ..services import dify_service, history_service
+from ..services import (dify_service, history_service, triage_service, ghidra_service, upload_service,
+                        blob_store, file_id_cache, upstream_router, metrics)
 from datetime import datetime
+from ..logging_setup import truncate
+
+logger = logging.getLogger(__name__)
 
 # 创建聊天路由蓝图
 chat_bp = Blueprint('chat', __name__, url_prefix='/chat')
@@ -23,113 +30,325 @@ def allowed_file(filename):
     ext = filename.rsplit('.', 1)[1].lower()
     return ext in ALLOWED_EXTENSIONS
 
+def _is_binary_filename(filename):
+    file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    return file_ext in ['exe', 'bin']
+
+
+def _timed_upload(route):
+    """记录上传请求的总耗时（含转发到 Dify）与结果"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            response = make_response(view(*args, **kwargs))
+            metrics.UPLOAD_DURATION_SECONDS.observe(time.time() - started, route=route,
+                                                    outcome='ok' if response.status_code < 400 else 'error')
+            return response
+        return wrapper
+    return decorator
+
+
+def _document_upload_response(dify_result, filename, sha256, model, conversation_id, cached=False):
+    """构造文档上传成功的响应"""
+    dify_conversation_id = dify_service.get_dify_conversation_id(conversation_id, model)
+
+    return jsonify({
+        "success": True,
+        "file_id": dify_result.get('id'),
+        "name": filename,
+        "type": "document",
+        "sha256": sha256,
+        "cached": cached,
+        "dify_info": dify_result,
+        "dify_conversation_id": dify_conversation_id
+    })
+
+
+def _process_saved_upload(file_path, filename, sha256, model, conversation_id, user):
+    """处理已保存到磁盘的上传文件：二进制文件做预分析，其他文件转发到Dify"""
+    metrics.UPLOAD_BYTES.observe(os.path.getsize(file_path),
+                                 kind='binary' if _is_binary_filename(filename) else 'document')
+    # 二进制文件特殊处理 - 不转发到Dify，转存到内容寻址存储并返回保存路径
+    if _is_binary_filename(filename):
+        # 同名但内容不同的文件会登记为别名，之后的分析接口使用返回的 name
+        file_path, registered_name = blob_store.store_file(file_path, filename, sha256)
+        filename = registered_name or filename
+        if conversation_id:
+            blob_store.add_ref(sha256, f"conversation:{model}/{conversation_id}")
+        # 上传时立即进行快速预分析，失败不影响上传结果
+        try:
+            triage = triage_service.triage_file(file_path, sha256=sha256)
+        except triage_service.TriageError as e:
+            logger.warning("预分析跳过 (%s): %s", filename, e)
+            triage = None
+        return jsonify({
+            "success": True,
+            "file_path": file_path,
+            "name": filename,
+            "type": "binary",
+            "sha256": sha256,
+            "triage": triage,
+            "message": "二进制文件已保存"
+        })
+
+    # 非EXE文件原有处理逻辑
+    endpoint = _upload_endpoint(model, conversation_id)
+    if not endpoint:
+        return jsonify({"error": f"{model} API未配置"}), 400
+
+    # 相同内容近期已上传过，直接复用 Dify 的 upload_file_id
+    cached_result = file_id_cache.get(model, endpoint['api_url'], user, sha256)
+    if cached_result:
+        logger.info("文件 %s 命中Dify文件ID缓存: %s", filename, cached_result.get('id'))
+        dify_service.pin_conversation(conversation_id, model, endpoint)
+        return _document_upload_response(cached_result, filename, sha256, model, conversation_id, cached=True)
+
+    dify_response = dify_service.upload_saved_file(model, endpoint, user, filename, file_path)
+    return _finish_document_upload(dify_response, filename, sha256, model, endpoint, conversation_id, user)
+
+
+def _upload_endpoint(model, conversation_id):
+    """文档上传的目标端点：对话已绑定的端点，或按负载选出的端点（上传成功后绑定，Dify 文件ID只在该端点有效）"""
+    _, candidates, _ = dify_service.resolve_endpoints(model, conversation_id)
+    return candidates[0] if candidates else None
+
+
+def _finish_document_upload(dify_response, filename, sha256, model, endpoint, conversation_id, user):
+    """处理 Dify 文件上传响应：失败时返回错误，成功时写入文件ID缓存并绑定对话端点"""
+    if not dify_response.ok:
+        error_message = "上传到Dify失败"
+        try:
+            error_data = dify_response.json()
+            error_message = f"Dify错误: {error_data.get('message', error_data.get('error', '未知错误'))}"
+        except Exception:
+            error_message = f"Dify错误: {dify_response.status_code} {dify_response.reason}"
+        return jsonify({"error": error_message}), dify_response.status_code
+
+    dify_result = dify_response.json()
+    file_id_cache.put(model, endpoint['api_url'], user, sha256, dify_result)
+    dify_service.pin_conversation(conversation_id, model, endpoint)
+    return _document_upload_response(dify_result, filename, sha256, model, conversation_id)
+
+
+def _stream_document_upload(parts, filename, model, conversation_id, user):
+    """
+    将请求中的文档直接流式转发到 Dify，不写临时文件。
+    客户端在文件之前提供了 sha256 且命中缓存时，只读取并校验内容，不再上传。
+    """
+    endpoint = _upload_endpoint(model, conversation_id)
+    if not endpoint:
+        return jsonify({"error": f"{model} API未配置"}), 400
+
+    claimed_sha256 = (parts.fields.get('sha256') or '').lower()
+    cached_result = file_id_cache.get(model, endpoint['api_url'], user, claimed_sha256) if claimed_sha256 else None
+    if cached_result:
+        while parts.read(upload_service.STREAM_CHUNK_SIZE):
+            pass
+        parts.drain()
+        metrics.UPLOAD_BYTES.observe(parts.size, kind='document')
+        if parts.sha256() != claimed_sha256:
+            return jsonify({"error": "文件内容与提供的sha256不一致"}), 400
+        logger.info("文件 %s 命中Dify文件ID缓存: %s", filename, cached_result.get('id'))
+        dify_service.pin_conversation(conversation_id, model, endpoint)
+        return _document_upload_response(cached_result, filename, claimed_sha256, model, conversation_id, cached=True)
+
+    spill_path = upload_service.staging_path(filename)
+    try:
+        dify_response = dify_service.forward_upload(model, endpoint, user, filename, parts, spill_path)
+    finally:
+        if os.path.exists(spill_path):
+            os.remove(spill_path)
+    parts.drain()
+    metrics.UPLOAD_BYTES.observe(parts.size, kind='document')
+    logger.info("文件 %s 已流式转发到Dify (%s bytes)", filename, parts.size)
+    return _finish_document_upload(dify_response, filename, parts.sha256(), model, endpoint, conversation_id, user)
+
+
+def _upstream_unavailable(e):
+    """上游熔断或不可用时立即返回的结构化错误"""
+    response = jsonify({
+        "error": str(e),
+        "code": "upstream_unavailable",
+        "model": e.model,
+        "retry_after": e.retry_after,
+    })
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+
+def _cleanup_document(file_path, filename):
+    """仅清理非EXE文件的临时文件"""
+    if file_path and not _is_binary_filename(filename) and os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+        except Exception as e:
+            logger.error("清理临时文件 '%s' 失败: %s", file_path, e)
+
+
 # 文件上传路由
 @chat_bp.route('/upload', methods=['POST'])
+@_timed_upload('upload')
 def upload_file():
-    """处理文件上传请求。EXE文件将永久保存，其他文件按原有流程处理"""
-    if 'file' not in request.files:
-        return jsonify({"error": "未找到上传文件"}), 400
-
-    file = request.files['file']
-    model = request.form.get('model', 'dify1')
-    conversation_id = request.form.get('conversation_id')
-    user = request.form.get('user', 'default-user')
+    """
+    处理文件上传请求。EXE文件将永久保存，其他文件按原有流程处理。
 
-    if file.filename == '':
-        return jsonify({"error": "未选择文件"}), 400
+    请求体按流增量解析：表单字段（user/model/conversation_id，可选 sha256）位于文件之前时，
+    文档直接流式转发到 Dify，不落盘；字段位于文件之后的旧客户端仍走先写暂存区的流程。
+    """
+    if request.content_length and request.content_length > upload_service.MAX_UPLOAD_SIZE:
+        return jsonify({"error": f"文件超过大小上限 {upload_service.MAX_UPLOAD_SIZE} 字节"}), 413
 
-    if not conversation_id:
-        return jsonify({"error": "未提供对话ID"}), 400
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({"error": "未找到上传文件"}), 400
 
+    file_path = filename = None
     try:
-        # 获取文件扩展名
-        file_ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
-        is_binary_file = file_ext in ['exe', 'bin']
-
-        if not allowed_file(file.filename):
+        parts = upload_service.MultipartStream(request.stream, boundary.encode('latin-1'))
+        while True:
+            field_name = parts.next_file()
+            if field_name is None:
+                return jsonify({"error": "未找到上传文件"}), 400
+            if field_name == 'file':
+                break
+
+        if parts.filename == '':
+            return jsonify({"error": "未选择文件"}), 400
+
+        if not allowed_file(parts.filename):
             return jsonify({"error": f"不支持的文件类型。允许的类型: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
 
-        # 创建上传目录
-        upload_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
-        os.makedirs(upload_dir, exist_ok=True)
-        
         # 安全处理文件名
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(upload_dir, filename)
-        
-        # 保存文件到上传目录
-        file.save(file_path)
-        print(f"文件已保存到: {file_path}")
-
-        # 二进制文件特殊处理 - 不转发到Dify，直接返回保存路径
-        if is_binary_file:
-            return jsonify({
-                "success": True,
-                "file_path": file_path,
-                "name": filename,
-                "type": "binary",
-                "message": "二进制文件已保存"
-            })
-
-        # 非EXE文件原有处理逻辑
-        current_config = app_config.get_model_config(model)
-        api_url = current_config.get('api_url')
-        api_key = current_config.get('api_key')
-
-        if not api_url or not api_key:
-            return jsonify({"error": f"{model} API未配置"}), 400
-
-        base_url = api_url.rstrip('/')
-        dify_files_url = f"{base_url}/files/upload"
-
-        headers = {
-            'Authorization': f'Bearer {api_key}'
-        }
+        filename = secure_filename(parts.filename)
+
+        # 文件之前已收到对话ID，说明元数据已齐全，文档可以直接转发
+        if parts.fields.get('conversation_id') and not _is_binary_filename(filename):
+            return _stream_document_upload(parts, filename, parts.fields.get('model', 'dify1'),
+                                           parts.fields['conversation_id'],
+                                           parts.fields.get('user', 'default-user'))
+
+        # 先写入暂存区，二进制文件随后转存到内容寻址存储
+        file_path = upload_service.staging_path(filename)
+
+        # 边写盘边计算哈希并检查大小上限
+        sha256, size = upload_service.save_stream(parts, file_path)
+        logger.info("文件已保存到: %s (%s bytes)", file_path, size)
+
+        # 读取文件之后的表单字段
+        parts.drain()
+        model = parts.fields.get('model', 'dify1')
+        conversation_id = parts.fields.get('conversation_id')
+        user = parts.fields.get('user', 'default-user')
+        if not conversation_id:
+            os.remove(file_path)
+            file_path = None
+            return jsonify({"error": "未提供对话ID"}), 400
+
+        return _process_saved_upload(file_path, filename, sha256, model, conversation_id, user)
+
+    except upload_service.UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except dify_service.UploadForwardError as e:
+        logger.error("文件转发到Dify失败: %s", e)
+        return jsonify({"error": str(e)}), 502
+    except upstream_router.UpstreamUnavailable as e:
+        return _upstream_unavailable(e)
+    except Exception as e:
+        logger.error("文件上传处理中发生错误: %s", e)
+        return jsonify({"error": f"文件处理错误: {str(e)}"}), 500
+    finally:
+        _cleanup_document(file_path, filename)
 
-        dify_form_data = {
-            'user': user
-        }
-        
-        with open(file_path, 'rb') as f:
-            dify_response = requests.post(
-                dify_files_url,
-                headers=headers,
-                files={'file': (filename, f, "text/plain")},
-                data=dify_form_data,
-                timeout=60
-            )
-
-        if not dify_response.ok:
-            error_message = "上传到Dify失败"
-            try:
-                error_data = dify_response.json()
-                error_message = f"Dify错误: {error_data.get('message', error_data.get('error', '未知错误'))}"
-            except Exception:
-                error_message = f"Dify错误: {dify_response.status_code} {dify_response.reason}"
-            return jsonify({"error": error_message}), dify_response.status_code
-
-        dify_result = dify_response.json()
-        dify_conversation_id = dify_service.get_dify_conversation_id(conversation_id, model)
 
-        return jsonify({
-            "success": True,
-            "file_id": dify_result.get('id'),
-            "name": filename,
-            "type": "document",
-            "dify_info": dify_result,
-            "dify_conversation_id": dify_conversation_id
+# 分块断点续传 - 创建上传会话
+@chat_bp.route('/upload/sessions', methods=['POST'])
+def create_upload_session():
+    """创建分块上传会话，请求体: {filename, size, model, conversation_id, user, sha256(可选)}"""
+    data = request.json or {}
+    filename = data.get('filename', '')
+    if not filename:
+        return jsonify({"error": "未提供文件名"}), 400
+    if not allowed_file(filename):
+        return jsonify({"error": f"不支持的文件类型。允许的类型: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
+    if not data.get('conversation_id'):
+        return jsonify({"error": "未提供对话ID"}), 400
+
+    # 客户端提供了内容哈希且该文档近期已上传过：无需传输数据，直接返回缓存的文件ID
+    model = data.get('model', 'dify1')
+    user = data.get('user', 'default-user')
+    sha256 = (data.get('sha256') or '').lower()
+    endpoint = _upload_endpoint(model, data.get('conversation_id')) if sha256 and not _is_binary_filename(filename) else None
+    if endpoint:
+        cached_result = file_id_cache.get(model, endpoint['api_url'], user, sha256)
+        if cached_result:
+            dify_service.pin_conversation(data.get('conversation_id'), model, endpoint)
+            return _document_upload_response(cached_result, secure_filename(filename), sha256,
+                                             model, data.get('conversation_id'), cached=True)
+
+    try:
+        session = upload_service.create_upload(filename, int(data.get('size', -1)), {
+            "model": model,
+            "conversation_id": data.get('conversation_id'),
+            "user": user,
         })
+        return jsonify(session), 201
+    except (TypeError, ValueError):
+        return jsonify({"error": "无效的文件大小"}), 400
+    except upload_service.UploadError as e:
+        return jsonify({"error": str(e), **e.details}), e.status
+
 
+# 分块断点续传 - 查询进度（断线后据此确定续传偏移）
+@chat_bp.route('/upload/sessions/<string:upload_id>', methods=['GET'])
+def get_upload_session(upload_id):
+    """查询上传会话已接收的字节数"""
+    try:
+        return jsonify(upload_service.get_upload_status(upload_id))
+    except upload_service.UploadError as e:
+        return jsonify({"error": str(e), **e.details}), e.status
+
+
+# 分块断点续传 - 上传数据块，请求体为原始字节，?offset= 为该块的起始偏移
+@chat_bp.route('/upload/sessions/<string:upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """追加一个数据块，直接从请求流写入磁盘"""
+    try:
+        offset = int(request.args.get('offset', -1))
+    except ValueError:
+        return jsonify({"error": "无效的偏移量"}), 400
+    try:
+        session = upload_service.append_chunk(upload_id, offset, request.stream)
+        return jsonify({"upload_id": upload_id, "offset": session['offset'], "size": session['size']})
+    except upload_service.UploadError as e:
+        return jsonify({"error": str(e), **e.details}), e.status
+
+
+# 分块断点续传 - 完成上传并进入后续处理（预分析或转发Dify）
+@chat_bp.route('/upload/sessions/<string:upload_id>/complete', methods=['POST'])
+@_timed_upload('chunked_complete')
+def complete_upload_session(upload_id):
+    """完成分块上传，返回内容哈希以及与普通上传相同的处理结果"""
+    file_path = filename = None
+    try:
+        result = upload_service.complete_upload(upload_id)
+        file_path, filename = result['path'], result['filename']
+        meta = result['metadata']
+        return _process_saved_upload(file_path, filename, result['sha256'],
+                                     meta.get('model', 'dify1'), meta.get('conversation_id'),
+                                     meta.get('user', 'default-user'))
+    except upload_service.UploadError as e:
+        return jsonify({"error": str(e), **e.details}), e.status
+    except dify_service.UploadForwardError as e:
+        logger.error("文件转发到Dify失败: %s", e)
+        return jsonify({"error": str(e)}), 502
+    except upstream_router.UpstreamUnavailable as e:
+        return _upstream_unavailable(e)
     except Exception as e:
-        print(f"文件上传处理中发生错误: {e}")
+        logger.error("完成分块上传时发生错误: %s", e)
         return jsonify({"error": f"文件处理错误: {str(e)}"}), 500
     finally:
-        # 仅清理非EXE文件的临时文件
-        if not is_binary_file and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                print(f"错误：清理临时文件 '{file_path}' 失败: {e}")
+        _cleanup_document(file_path, filename)
 
 # 聊天主路由，用于向dify请求
 @chat_bp.route('', methods=['POST'])
@@ -145,8 +364,8 @@ def chat_with_dify():
     # 从请求中获取文件ID列表 - 前端可能使用 file_ids 或 files 字段
     file_ids = data.get('files', []) or data.get('file_ids', [])
     
-    print(f"聊天路由：接收到的请求数据：{json.dumps(data, ensure_ascii=False)}")
-    print(f"聊天路由：处理的文件ID列表：{file_ids}")
+    logger.debug("聊天路由：接收到的请求数据：%s", truncate(data))
+    logger.debug("聊天路由：处理的文件ID列表：%s", file_ids)
 
     if not query and not file_ids: # 如果没有文本查询也没有文件，则无效
         return jsonify({"error": "缺少query或file_ids参数"}), 400
@@ -154,12 +373,6 @@ def chat_with_dify():
         query = "请基于我上传的文件进行漏洞分析，一步步地思考，包括代码功能，明确的漏洞，代码修复意见等。"
 
     try:
-        current_config = app_config.get_model_config(model)
-        api_url = current_config.get('api_url')
-        api_key = current_config.get('api_key')
-
-        if not api_url or not api_key:
-            return jsonify({"error": f"{model} API未配置"}), 400
 
         # 按照Python示例和Dify API文档准备payload
         payload = {
@@ -197,10 +410,10 @@ def chat_with_dify():
             # 添加格式化后的文件引用到payload
             payload["files"] = formatted_files
         
-        print(f"聊天路由：发送到Dify服务的payload: {json.dumps(payload, ensure_ascii=False)}")
+        logger.debug("聊天路由：发送到Dify服务的payload: %s", truncate(payload))
 
-        # 调用Dify服务层处理与API的交互
-        stream_generator = dify_service.stream_dify_chat(api_url, api_key, payload)
+        # 调用Dify服务层处理与API的交互（立即建立连接，熔断或连接失败时直接返回错误）
+        stream_generator = dify_service.stream_dify_chat(payload)
 
         # 自定义流生成器，用于在流结束后更新本地存储的Dify对话ID
         def custom_stream_generator():
@@ -221,7 +434,7 @@ def chat_with_dify():
                             except json.JSONDecodeError:
                                 pass
                 except Exception as e:
-                    print(f"警告：解析流数据块以获取Dify ID时出错: {e}")
+                    logger.warning("解析流数据块以获取Dify ID时出错: %s", e)
 
                 yield chunk # 将原始数据块传递给客户端
 
@@ -231,18 +444,21 @@ def chat_with_dify():
                  if '_' in original_local_id:
                      try:
                          history_service.update_dify_conversation_id(original_local_id, dify_uuid_received, model)
-                         print(f"信息：更新本地对话 {original_local_id} 的 Dify ID 为 {dify_uuid_received}")
+                         logger.debug("更新本地对话 %s 的 Dify ID 为 %s", original_local_id, dify_uuid_received)
                      except Exception as update_e:
-                         print(f"错误：更新 Dify ID 时失败: {update_e}")
+                         logger.error("更新 Dify ID 时失败: %s", update_e)
 
         return Response(custom_stream_generator(), mimetype='text/event-stream')
 
     except ValueError as e: # 配置或请求数据问题
         return jsonify({"error": str(e)}), 400
+    except upstream_router.UpstreamUnavailable as e: # 上游熔断或无法连接，立即失败
+        logger.warning("聊天路由：%s", e)
+        return _upstream_unavailable(e)
     except requests.exceptions.RequestException as e: # Dify API通信错误
-        print(f"错误：与Dify API通信失败: {e}") # 保留此错误日志
+        logger.error("与Dify API通信失败: %s", e)
         error_message = f"与Dify API通信失败: {str(e)}"
-        status_code = 500
+        status_code = 502
         if e.response is not None:
              status_code = e.response.status_code
              try:
@@ -256,7 +472,7 @@ def chat_with_dify():
 
         return jsonify({"error": error_message}), status_code
     except Exception as e:
-        print(f"聊天处理中发生意外错误: {e}") # 保留此错误日志
+        logger.exception("聊天处理中发生意外错误: %s", e)
         return jsonify({"error": "服务器内部错误"}), 500
 
 
@@ -268,48 +484,78 @@ def analyze_binary():
     if not filename:
         return jsonify({'error': '缺少文件名参数'}), 400
     
-    upload_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
-    file_path = os.path.join(upload_dir, filename)
-    if not os.path.exists(file_path):
+    file_path = blob_store.resolve(filename)
+    if not file_path:
         return jsonify({'error': '文件不存在'}), 404
 
     # 生成Ghidra输出路径
-    output_json = os.path.join(upload_dir, f'{filename}_ghidra.json')
-    ghidra_path = '/disk1/users/laiqj/ghidra_11.3.2_PUBLIC/support/analyzeHeadless'
-    project_dir = os.path.join(upload_dir, 'ghidra_proj')
-    script_path = os.path.join(upload_dir, 'analyse', 'combined_export.py')
-
-    # 确保Ghidra项目目录存在
-    os.makedirs(project_dir, exist_ok=True)
+    output_json = ghidra_service.get_output_path(filename)
 
     # 调用Ghidra headless分析
-    import subprocess, traceback
     try:
-        cmd = [
-            ghidra_path,
-            project_dir,
-            'tmp',
-            '-import', file_path,
-            '-postScript', script_path,
-            '-deleteProject'
-        ]
-        env = os.environ.copy()
-        env['OUTPUT_FILE'] = output_json
-        print(f"调用Ghidra命令: {' '.join(cmd)}")
-        print(f"环境变量OUTPUT_FILE: {output_json}")
-        result = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=600)
-        print(f"Ghidra stdout: {result.stdout}")
-        print(f"Ghidra stderr: {result.stderr}")
-        if result.returncode != 0:
-            return jsonify({'error': 'Ghidra分析失败', 'stderr': result.stderr}), 500
-        if not os.path.exists(output_json):
-            return jsonify({'error': 'Ghidra未生成分析结果'}), 500
-        with open(output_json, 'r', encoding='utf-8') as f:
-            analysis = json.load(f)
+        sha256 = blob_store.lookup(filename)
+        analysis = ghidra_service.run_analysis(file_path, output_json, sha256=sha256)
+        if sha256:
+            blob_store.add_ref(sha256, f"analysis:{filename}")
         return jsonify({'success': True, 'analysis': analysis})
+    except ghidra_service.GhidraError as e:
+        return jsonify({'error': str(e), 'stderr': e.stderr}), 500
     except Exception as e:
-        print(f"分析异常: {e}")
-        print(traceback.format_exc())
+        logger.exception("分析异常: %s", e)
         return jsonify({'error': f'后端分析异常: {str(e)}'}), 500
 
 
+@chat_bp.route('/analyze/triage', methods=['POST'])
+def triage_binary():
+    """对已上传的二进制文件进行快速预分析（不依赖Ghidra）"""
+    data = request.json or {}
+    filename = data.get('filename')
+    if not filename:
+        return jsonify({'error': '缺少文件名参数'}), 400
+
+    file_path = blob_store.resolve(filename)
+    if not file_path:
+        return jsonify({'error': '文件不存在'}), 404
+
+    try:
+        triage = triage_service.triage_file(file_path, sha256=blob_store.lookup(filename))
+        return jsonify({'success': True, 'triage': triage})
+    except triage_service.TriageError as e:
+        return jsonify({'error': f'预分析失败: {str(e)}'}), 400
+    except Exception as e:
+        logger.error("预分析异常: %s", e)
+        return jsonify({'error': f'后端预分析异常: {str(e)}'}), 500
+
+
+@chat_bp.route('/analyze/triage/<string:sha256>', methods=['GET'])
+def get_triage_result(sha256):
+    """按文件SHA-256获取缓存的预分析结果"""
+    triage = triage_service.get_cached_triage(sha256)
+    if triage is None:
+        return jsonify({'error': '未找到预分析结果'}), 404
+    return jsonify({'success': True, 'triage': triage})
+
+
+# 内容寻址存储统计 - /chat/blobs/stats
+@chat_bp.route('/blobs/stats', methods=['GET'])
+def get_blob_stats():
+    """获取上传文件存储的去重统计"""
+    return jsonify(blob_store.stats())
+
+
+# 内容寻址存储垃圾回收 - /chat/blobs/gc
+@chat_bp.route('/blobs/gc', methods=['POST'])
+def collect_blobs():
+    """回收没有文件名、分析或对话引用的Blob"""
+    try:
+        return jsonify({"success": True, **blob_store.gc()})
+    except Exception as e:
+        logger.error("Blob垃圾回收失败: %s", e)
+        return jsonify({"error": f"垃圾回收失败: {str(e)}"}), 500
+
+
+# 上游端点路由状态 - /chat/upstreams
+@chat_bp.route('/upstreams', methods=['GET'])
+def get_upstreams():
+    """获取各模型Dify端点的负载、延迟与熔断状态（当前worker进程的观测）"""
+    return jsonify(upstream_router.get_status())
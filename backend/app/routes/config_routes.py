@@ -1,13 +1,33 @@
 from flask import Blueprint, request, jsonify
+import hmac
+import logging
+import os
 from .. import config as app_config
 
+logger = logging.getLogger(__name__)
+
+# 修改配置需要的管理令牌（请求头 X-Admin-Token）；未设置时禁止通过接口修改配置
+CONFIG_ADMIN_TOKEN = os.getenv('CONFIG_ADMIN_TOKEN', '')
+
 # 创建配置路由蓝图
 config_bp = Blueprint('config', __name__, url_prefix='/config')
 
+
+def _is_admin():
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(CONFIG_ADMIN_TOKEN) and hmac.compare_digest(token.encode('utf-8'), CONFIG_ADMIN_TOKEN.encode('utf-8'))
+
+
 @config_bp.route('', methods=['POST'])
 def configure_dify():
-    """配置Dify API设置"""
-    data = request.json
+    """配置Dify API设置（需要 X-Admin-Token，未配置 CONFIG_ADMIN_TOKEN 时接口禁用）"""
+    if not CONFIG_ADMIN_TOKEN:
+        return jsonify({"error": "配置接口未启用"}), 403
+    if not _is_admin():
+        logger.warning("拒绝未授权的配置修改请求: %s", request.remote_addr)
+        return jsonify({"error": "未授权"}), 401
+
+    data = request.get_json(silent=True) or {}
     model = data.get('model')
     api_url = data.get('api_url')
     api_key = data.get('api_key')
@@ -21,7 +41,7 @@ def configure_dify():
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"配置保存错误: {e}")
+        logger.exception("配置保存错误: %s", e)
         return jsonify({"error": "配置保存失败"}), 500
 
 @config_bp.route('', methods=['GET'])
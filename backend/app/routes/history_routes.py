@@ -1,10 +1,32 @@
-from flask import Blueprint, request, jsonify
-from ..services import history_service
+from flask import Blueprint, request, jsonify, Response, make_response
+import logging
+from ..services import history_service, history_tiering, history_transfer
 from datetime import datetime
+from ..logging_setup import truncate
+
+logger = logging.getLogger(__name__)
 
 # 创建历史记录路由蓝图 - 修改URL前缀为/chat以保持与前端接口一致
 history_bp = Blueprint('history', __name__, url_prefix='/chat')
 
+# --- 条件请求 ---
+# GET 路由返回基于版本计数器的 ETag（见 history_service.get_etag），并要求客户端每次重新验证；
+# If-None-Match 与当前版本一致时直接返回 304，不读取历史文件。
+
+def _not_modified(etag):
+    """客户端缓存仍然有效时返回 304 响应，否则返回 None"""
+    if etag and request.if_none_match.contains_weak(etag):
+        return _with_etag(Response(status=304), etag)
+    return None
+
+def _with_etag(rv, etag):
+    """成功响应附加 ETag；rv 可以是视图函数的任意返回值"""
+    response = make_response(rv)
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 # --- 对话管理路由 ---
 
 # 获取历史记录路由 - 前端使用 /chat/conversations
@@ -13,14 +35,30 @@ def get_conversations_list():
     """获取指定模型的对话列表"""
     # 从查询参数获取 model，如果未提供则默认为 'dify1'
     model = request.args.get('model', 'dify1') 
-    print(f"历史路由: 请求获取模型 '{model}' 的对话列表")
+    logger.debug("历史路由: 请求获取模型 '%s' 的对话列表", model)
+    # 版本号需在读取数据之前获取：期间若有写入，返回的 ETag 只会偏旧，下次请求会重新获取
+    etag = history_service.get_etag(model)
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+    # 指定 limit 或 cursor 时分页返回 {"conversations": [...], "next_cursor": ...}，否则返回完整列表
+    if 'limit' in request.args or 'cursor' in request.args:
+        try:
+            limit = int(request.args.get('limit', 50))
+        except ValueError:
+            return jsonify({"error": "limit 必须是整数"}), 400
+        try:
+            page = history_service.list_conversations_page(model, limit, request.args.get('cursor'))
+            return _with_etag(jsonify(page), etag)
+        except ValueError as e: # 游标无效
+            return jsonify({"error": str(e)}), 400
     try:
         # 将获取到的 model 传递给 history_service
         conversations = history_service.list_conversations(model=model)
-        print(f"历史路由: 返回 {len(conversations)} 个对话")
-        return jsonify(conversations)
+        logger.debug("历史路由: 返回 %s 个对话", len(conversations))
+        return _with_etag(jsonify(conversations), etag)
     except Exception as e:
-        print(f"历史路由错误: 获取模型 '{model}' 的对话列表失败: {e}")
+        logger.error("历史路由错误: 获取模型 '%s' 的对话列表失败: %s", model, e)
         return jsonify({"error": f"无法获取模型 '{model}' 的对话列表"}), 500
 
 # 创建新对话路由 - 前端使用 /chat/conversations
@@ -29,7 +67,7 @@ def create_new_conversation_route():
     """创建新对话路由"""
     data = request.json
     model = data.get('model', 'dify1') # 从请求体获取 model
-    print(f"历史路由: 请求为模型 '{model}' 创建新对话")
+    logger.debug("历史路由: 请求为模型 '%s' 创建新对话", model)
     try:
         conversation_id = history_service.create_new_conversation(model=model)
         # 返回包含ID和默认名称/时间戳的对象，以便前端可以直接使用
@@ -38,10 +76,10 @@ def create_new_conversation_route():
             "name": "聊天助手", # 初始名称
             "timestamp": datetime.utcnow().isoformat() + 'Z' # 提供时间戳
         }
-        print(f"历史路由: 新对话创建成功，ID: {conversation_id}")
+        logger.info("历史路由: 新对话创建成功，ID: %s", conversation_id)
         return jsonify(new_conv_info), 201
     except Exception as e:
-        print(f"历史路由错误: 创建新对话失败 (模型: '{model}'): {e}")
+        logger.error("历史路由错误: 创建新对话失败 (模型: '%s'): %s", model, e)
         return jsonify({"error": f"无法为模型 '{model}' 创建新对话"}), 500
 
 # 获取特定对话的消息历史路由 - 前端使用 /chat/conversations/<id>/messages
@@ -49,18 +87,44 @@ def create_new_conversation_route():
 def get_conversation_history_route(conversation_id):
     """获取特定对话的消息历史"""
     model = request.args.get('model', 'dify1') # 从查询参数获取 model
-    print(f"历史路由: 请求获取对话 '{conversation_id}' (模型: '{model}') 的历史消息")
+    logger.debug("历史路由: 请求获取对话 '%s' (模型: '%s') 的历史消息", conversation_id, model)
+    etag = history_service.get_etag(model, conversation_id)
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+    # 增量模式：after=<消息序号或消息id>、limit=<条数>，只返回客户端尚未获取的消息
+    if 'after' in request.args or 'limit' in request.args:
+        return _with_etag(_get_messages_delta(conversation_id, model), etag)
     try:
         messages = history_service.get_messages(conversation_id=conversation_id, model=model)
-        print(f"历史路由: 返回 {len(messages)} 条消息")
-        return jsonify(messages)
+        logger.debug("历史路由: 返回 %s 条消息", len(messages))
+        return _with_etag(jsonify(messages), etag)
     except FileNotFoundError:
-        print(f"历史路由错误: 对话 '{conversation_id}' (模型: '{model}') 未找到")
+        logger.error("历史路由错误: 对话 '%s' (模型: '%s') 未找到", conversation_id, model)
         return jsonify({"error": "对话未找到"}), 404
     except Exception as e:
-        print(f"历史路由错误: 获取对话 '{conversation_id}' (模型: '{model}') 历史失败: {e}")
+        logger.error("历史路由错误: 获取对话 '%s' (模型: '%s') 历史失败: %s", conversation_id, model, e)
         return jsonify({"error": "无法获取对话历史"}), 500
 
+def _get_messages_delta(conversation_id, model):
+    after = request.args.get('after')
+    if after is not None and after.lstrip('-').isdigit():
+        after = int(after)
+    try:
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify({"error": "limit 必须是整数"}), 400
+    try:
+        page = history_service.get_messages_page(conversation_id, model, after=after, limit=limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error("历史路由错误: 增量获取对话 '%s' (模型: '%s') 消息失败: %s", conversation_id, model, e)
+        return jsonify({"error": "无法获取对话历史"}), 500
+    if page is None:
+        return jsonify({"error": "对话未找到"}), 404
+    return jsonify(page)
+
 # 保存单条消息到特定对话的历史路由 - 前端使用 /chat/conversations/<id>/messages
 @history_bp.route('/conversations/<string:conversation_id>/messages', methods=['POST'])
 def save_message_route(conversation_id):
@@ -70,36 +134,36 @@ def save_message_route(conversation_id):
     model = data.get('model') # 从请求体获取 model
     
     if not message or not isinstance(message, dict):
-        print(f"历史路由错误: 无效的消息数据: {message}")
+        logger.error("历史路由错误: 无效的消息数据: %s", truncate(message))
         return jsonify({"error": "无效的消息数据"}), 400
     if not model:
          # 如果前端没传 model，尝试从 message 中获取，或使用默认值
          model = message.get('model', 'dify1') 
-         print(f"历史路由警告: 请求体缺少 'model'，使用推断/默认值: {model}")
+         logger.warning("历史路由警告: 请求体缺少 'model'，使用推断/默认值: %s", model)
 
-    print(f"历史路由: 请求保存消息到对话 '{conversation_id}' (模型: '{model}')")
+    logger.debug("历史路由: 请求保存消息到对话 '%s' (模型: '%s')", conversation_id, model)
     
     try:
         # 调用 history_service 保存消息
         # 注意：history_service.save_message 会自动添加时间戳
         result = history_service.save_message(conversation_id=conversation_id, message=message, model=model)
         if result:
-            print(f"历史路由: 消息成功保存到对话 '{conversation_id}'")
+            logger.debug("历史路由: 消息成功保存到对话 '%s'", conversation_id)
             return jsonify({"message": "消息保存成功"}), 201
         else:
-            print(f"历史路由错误: 消息保存失败")
+            logger.error("历史路由错误: 消息保存失败")
             return jsonify({"error": "消息保存失败"}), 500
     except ValueError as e: # 可能来自 history_service 的 ID 验证
-        print(f"历史路由错误: 保存消息时出错 (ValueError): {e}")
+        logger.error("历史路由错误: 保存消息时出错 (ValueError): %s", e)
         return jsonify({"error": str(e)}), 400
     except FileNotFoundError:
-         print(f"历史路由错误: 对话 '{conversation_id}' (模型: '{model}') 未找到，无法保存消息")
+         logger.error("历史路由错误: 对话 '%s' (模型: '%s') 未找到，无法保存消息", conversation_id, model)
          return jsonify({"error": "对话未找到，无法保存消息"}), 404
     except IOError as e:
-        print(f"历史路由错误: 保存消息时发生IO错误: {e}")
+        logger.error("历史路由错误: 保存消息时发生IO错误: %s", e)
         return jsonify({"error": "保存消息时发生文件写入错误"}), 500
     except Exception as e:
-        print(f"历史路由错误: 保存消息时发生意外错误: {e}")
+        logger.exception("历史路由错误: 保存消息时发生意外错误: %s", e)
         return jsonify({"error": "服务器内部错误"}), 500
 
 # 重命名对话路由 - 前端使用 /chat/conversations/<id>/name
@@ -115,18 +179,18 @@ def rename_conversation_route(conversation_id):
     if not new_name:
         return jsonify({"error": "缺少新的对话名称 'name'"}), 400
         
-    print(f"历史路由: 请求重命名对话 '{conversation_id}' (模型: '{model}') 为 '{new_name}'")
+    logger.debug("历史路由: 请求重命名对话 '%s' (模型: '%s') 为 '%s'", conversation_id, model, new_name)
     try:
         success = history_service.rename_conversation_name(conversation_id=conversation_id, new_name=new_name, model=model)
         if success:
-            print(f"历史路由: 对话 '{conversation_id}' 重命名成功")
+            logger.info("历史路由: 对话 '%s' 重命名成功", conversation_id)
             return jsonify({"message": "重命名成功"}), 200
         else:
             # rename_conversation_name 内部可能已经处理了文件不存在等情况
-            print(f"历史路由错误: 重命名对话 '{conversation_id}' (模型: '{model}') 失败 (Service层返回False)")
+            logger.error("历史路由错误: 重命名对话 '%s' (模型: '%s') 失败 (Service层返回False)", conversation_id, model)
             return jsonify({"error": "重命名失败"}), 404
     except Exception as e:
-        print(f"历史路由错误: 重命名对话 '{conversation_id}' (模型: '{model}') 时发生异常: {e}")
+        logger.error("历史路由错误: 重命名对话 '%s' (模型: '%s') 时发生异常: %s", conversation_id, model, e)
         return jsonify({"error": "服务器内部错误"}), 500
 
 # 删除对话路由 - 前端使用 /chat/conversations/<id>
@@ -135,15 +199,111 @@ def delete_conversation_route(conversation_id):
     """删除对话路由"""
     # model 应该从查询参数获取，因为 DELETE 请求通常没有 body
     model = request.args.get('model', 'dify1') 
-    print(f"历史路由: 请求删除对话 '{conversation_id}' (模型: '{model}')")
+    logger.debug("历史路由: 请求删除对话 '%s' (模型: '%s')", conversation_id, model)
     try:
         success = history_service.delete_conversation(conversation_id=conversation_id, model=model)
         if success:
-            print(f"历史路由: 对话 '{conversation_id}' 删除成功")
+            logger.info("历史路由: 对话 '%s' 删除成功", conversation_id)
             return jsonify({"message": "删除成功"}), 200
         else:
-            print(f"历史路由错误: 删除对话 '{conversation_id}' (模型: '{model}') 失败 (未找到或无法删除)")
+            logger.error("历史路由错误: 删除对话 '%s' (模型: '%s') 失败 (未找到或无法删除)", conversation_id, model)
             return jsonify({"error": "删除失败，对话未找到或无法删除"}), 404
     except Exception as e:
-        print(f"历史路由错误: 删除对话 '{conversation_id}' (模型: '{model}') 时发生异常: {e}")
-        return jsonify({"error": "服务器内部错误"}), 500 
\ No newline at end of file
+        logger.error("历史路由错误: 删除对话 '%s' (模型: '%s') 时发生异常: %s", conversation_id, model, e)
+        return jsonify({"error": "服务器内部错误"}), 500 
+
+# --- 全文检索 ---
+
+# 搜索历史消息 - /chat/search?q=...&model=...&limit=...&offset=...&sort=relevance|recent
+@history_bp.route('/search', methods=['GET'])
+def search_history_route():
+    """在所有模型（指定 model 时只在该模型）的对话消息与名称中检索，snippet 为 HTML（命中处为 <mark>）"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "缺少搜索内容 'q'"}), 400
+    try:
+        limit = int(request.args.get('limit', 20))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "limit 和 offset 必须是整数"}), 400
+    try:
+        result = history_service.search_history(query, model=request.args.get('model') or None,
+                                                limit=limit, offset=offset,
+                                                sort=request.args.get('sort', 'relevance'))
+        if result is None:
+            return jsonify({"error": "全文检索未启用"}), 503
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error("历史路由错误: 搜索 '%s' 失败: %s", truncate(query), e)
+        return jsonify({"error": "服务器内部错误"}), 500
+
+# --- 批量导出 / 导入 ---
+
+# 流式导出 - /chat/export?model=...&format=ndjson|tar|tar.gz&since=...&until=...&ids=a,b
+@history_bp.route('/export', methods=['GET'])
+def export_conversations_route():
+    """流式导出指定模型的对话，可按创建日期（since/until）或对话 ID（ids，逗号分隔）筛选"""
+    model = request.args.get('model', 'dify1')
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in history_transfer.FORMATS:
+        return jsonify({"error": f"不支持的格式: {fmt}"}), 400
+    ids = [conv_id.strip() for conv_id in request.args.get('ids', '').split(',') if conv_id.strip()]
+    try:
+        records = history_service.export_conversations(model, request.args.get('since'), request.args.get('until'),
+                                                       ids or None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    filename = f"history_{model}_{datetime.now():%Y%m%d_%H%M%S}{history_transfer.extension(fmt)}"
+    logger.info("历史路由: 开始导出模型 '%s' 的对话 (格式: %s)", model, fmt)
+    return Response(history_transfer.encode(records, fmt), mimetype=history_transfer.mimetype(fmt),
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# 批量导入 - /chat/import?model=...&overwrite=true&format=...
+@history_bp.route('/import', methods=['POST'])
+def import_conversations_route():
+    """
+    从请求体流式导入导出的 NDJSON 或 tar（format 未指定时按 Content-Type 判断）。
+    指定 model 时全部导入到该模型；已存在的对话默认跳过，overwrite=true 时覆盖。
+    """
+    fmt = request.args.get('format') or history_transfer.format_for_content_type(request.content_type)
+    if fmt not in history_transfer.FORMATS:
+        return jsonify({"error": f"不支持的格式: {fmt}"}), 400
+    overwrite = request.args.get('overwrite', 'false').lower() in ('true', '1', 'yes')
+    try:
+        stats = history_service.import_conversations(history_transfer.decode(request.stream, fmt),
+                                                     model=request.args.get('model') or None, overwrite=overwrite)
+    except Exception as e:
+        logger.error("历史路由错误: 导入对话失败: %s", e)
+        return jsonify({"error": f"导入失败: {str(e)}"}), 500
+    return jsonify({"success": not (stats["failed"] or stats["truncated"]), **stats})
+
+# --- 冷存储 ---
+
+# 归档统计 - /chat/history/archive/stats
+@history_bp.route('/history/archive/stats', methods=['GET'])
+def get_archive_stats():
+    """获取冷热对话的数量、大小与压缩节省的磁盘空间"""
+    try:
+        return jsonify(history_tiering.stats())
+    except Exception as e:
+        logger.error("历史路由错误: 获取归档统计失败: %s", e)
+        return jsonify({"error": "服务器内部错误"}), 500
+
+# 立即归档空闲对话 - /chat/history/archive
+@history_bp.route('/history/archive', methods=['POST'])
+def archive_idle_conversations():
+    """立即执行一轮归档，可在请求体中用 idle_days 覆盖空闲天数"""
+    data = request.get_json(silent=True) or {}
+    try:
+        idle_days = float(data['idle_days']) if data.get('idle_days') is not None else None
+        if idle_days is not None and idle_days < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify({"error": "idle_days 必须是非负数"}), 400
+    try:
+        return jsonify({"success": True, **history_tiering.run_once(idle_days)})
+    except Exception as e:
+        logger.error("历史路由错误: 归档空闲对话失败: %s", e)
+        return jsonify({"error": f"归档失败: {str(e)}"}), 500
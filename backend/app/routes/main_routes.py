@@ -1,8 +1,11 @@
 from flask import Blueprint
 from flask import send_from_directory
 from flask import current_app
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 # 创建主蓝图
 main_bp = Blueprint('main', __name__)
 
@@ -11,17 +14,29 @@ def init_blueprints(app):
     # 导入蓝图 - 使用绝对导入
     from app.routes.chat_routes import chat_bp
     from app.routes.history_routes import history_bp
+    from app.routes.analysis_routes import analysis_bp
+    from app.routes.config_routes import config_bp
+    from app.routes.metrics_routes import metrics_bp
     
     # 将所有子蓝图注册到Flask应用
     app.register_blueprint(chat_bp)
     app.register_blueprint(history_bp)
+    app.register_blueprint(analysis_bp)
+    app.register_blueprint(config_bp)
+    app.register_blueprint(metrics_bp)
     
-    print("完成所有蓝图注册")
+    logger.info("完成所有蓝图注册")
 
     # 新增：静态文件服务，暴露uploads目录
     import os
     from flask import send_from_directory
     @app.route('/uploads/<path:filename>')
     def serve_uploads(filename):
+        # 上传的二进制保存在内容寻址存储中，按文件名查找对应的Blob
+        from app.services import blob_store
+        sha256 = blob_store.lookup(filename) if '/' not in filename else None
+        if sha256:
+            return send_from_directory(os.path.dirname(blob_store.blob_path(sha256)), sha256,
+                                       as_attachment=True, download_name=filename)
         uploads_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'uploads'))
         return send_from_directory(uploads_dir, filename) 
\ No newline at end of file
@@ -0,0 +1,11 @@
+from flask import Blueprint, Response
+from ..services import metrics
+
+# 创建指标路由蓝图
+metrics_bp = Blueprint('metrics', __name__)
+
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 抓取接口，返回所有 worker 聚合后的指标"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
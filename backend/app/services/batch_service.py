@@ -0,0 +1,356 @@
+"""
+多二进制批量分析服务。
+
+接收多个上传文件或一个压缩包（zip/tar），将其中的二进制文件交给 Ghidra 分析，每个任务限制 JVM 堆内存。
+同时运行的任务数按 CPU 核数与可用内存确定，由所有 worker 进程共享的并发名额（state_backend）控制，
+worker 数量不会成倍放大 JVM 个数。
+批次状态保存在 uploads/batches/<batch_id>/manifest.json，任一 worker 进程都可读取进度；
+提交任务的 worker 退出（如重启）后，查询进度时会把它遗留的排队/运行中任务重新提交。
+"""
+import json
+import logging
+import os
+import shutil
+import tarfile
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from werkzeug.utils import secure_filename
+
+from . import ghidra_service, blob_store, metrics, state_backend, upload_service
+from .locking import file_lock
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
+BATCH_DIR = os.path.join(UPLOAD_DIR, 'batches')
+
+# 每个 Ghidra 任务的 JVM 堆内存与 CPU 核数
+JOB_HEAP_MB = int(os.getenv('GHIDRA_JOB_HEAP_MB', '2048'))
+JOB_CPUS = int(os.getenv('GHIDRA_JOB_CPUS', '2'))
+# JVM 堆以外的进程开销估计（MB）
+JOB_OVERHEAD_MB = 512
+MAX_WORKERS = int(os.getenv('GHIDRA_MAX_WORKERS', '0'))  # 0 表示自动
+MAX_ARCHIVE_MEMBERS = 500
+MAX_MEMBER_SIZE = 512 * 1024 * 1024
+# 跨 worker 共享的分析并发名额；名额在 SLOT_TTL 秒后自动失效，避免进程被杀死后名额泄漏
+SLOT_KEY = 'ghidra:batch'
+SLOT_TTL = 2 * ghidra_service.GHIDRA_TIMEOUT + 60
+SLOT_POLL_INTERVAL = 1.0
+
+_executor = None
+_executor_lock = Lock()
+_pool_size = None
+_queue_depth = 0
+
+
+def _available_memory_mb():
+    """读取可用物理内存（MB），无法获取时返回 None"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_pool_size() -> int:
+    """根据 CPU 核数和可用内存计算并发分析任务数（整台机器，首次调用时计算，之后不随运行中任务占用的内存变化）"""
+    global _pool_size
+    if MAX_WORKERS > 0:
+        return MAX_WORKERS
+    if _pool_size is None:
+        by_cpu = max(1, (os.cpu_count() or 1) // max(1, JOB_CPUS))
+        memory = _available_memory_mb()
+        by_memory = max(1, memory // (JOB_HEAP_MB + JOB_OVERHEAD_MB)) if memory else by_cpu
+        _pool_size = min(by_cpu, by_memory)
+    return _pool_size
+
+
+def _get_executor():
+    # 进程内的线程只负责排队，实际运行的任务数由共享名额限制（见 _acquire_slot）
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            size = get_pool_size()
+            _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='ghidra-batch')
+            logger.info("Batch Service: 创建分析工作池，并发数 %s（每任务堆内存 %sMB）", size, JOB_HEAP_MB)
+        return _executor
+
+
+def _acquire_slot():
+    """等待并占用一个跨 worker 共享的分析名额，返回名额 token"""
+    backend = state_backend.get_backend()
+    while True:
+        token = backend.acquire_slot(SLOT_KEY, get_pool_size(), SLOT_TTL)
+        if token:
+            return token
+        time.sleep(SLOT_POLL_INTERVAL)
+
+
+def get_queue_depth() -> int:
+    """当前进程中排队或运行中的分析任务数"""
+    return _queue_depth
+
+
+# --- Manifest ---
+
+def _manifest_path(batch_id):
+    return os.path.join(BATCH_DIR, batch_id, 'manifest.json')
+
+
+def _manifest_lock(batch_id):
+    """清单的跨进程锁：任务状态更新与遗留任务的接管可能来自不同 worker"""
+    return file_lock(os.path.join(BATCH_DIR, batch_id, 'manifest.lock'))
+
+
+def _worker_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # 进程存在但属于其他用户
+    return True
+
+
+def _write_manifest(manifest):
+    path = _manifest_path(manifest['batch_id'])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _update_job(batch_id, index, **fields):
+    with _manifest_lock(batch_id):
+        manifest = get_manifest(batch_id)
+        manifest['jobs'][index].update(fields)
+        _write_manifest(manifest)
+
+
+def get_manifest(batch_id: str):
+    """读取批次清单，不存在时返回 None"""
+    batch_id = secure_filename(batch_id or '')
+    if not batch_id:
+        return None
+    try:
+        with open(_manifest_path(batch_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def summarize(manifest: dict) -> dict:
+    """汇总批次进度"""
+    counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+    for job in manifest['jobs']:
+        counts[job['status']] = counts.get(job['status'], 0) + 1
+    total = len(manifest['jobs'])
+    finished = counts['done'] + counts['failed']
+    return {
+        "batch_id": manifest['batch_id'],
+        "total": total,
+        **counts,
+        "progress": round(finished / total, 4) if total else 1.0,
+        "complete": finished == total,
+    }
+
+
+# --- Input Handling ---
+
+def _extract_archive(archive_path, dest_dir, prefix, used):
+    """
+    解压 zip/tar 中的普通文件（边解压边计算哈希），返回 (名称, 路径, 哈希) 列表。
+    名称由成员的完整路径扁平化而来（bin/a -> <prefix>_bin_a），清理后仍重名的加序号区分。
+    """
+    extracted = []
+
+    def _target(member_name):
+        name = secure_filename(member_name)
+        if not name:
+            return None, None
+        name = _unique_name(f"{prefix}_{name}", used)
+        return name, os.path.join(dest_dir, name)
+
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist()[:MAX_ARCHIVE_MEMBERS]:
+                if info.is_dir() or info.file_size > MAX_MEMBER_SIZE:
+                    continue
+                name, path = _target(info.filename)
+                if name:
+                    with zf.open(info) as src:
+                        sha256, _ = upload_service.save_stream(src, path, MAX_MEMBER_SIZE)
+                    extracted.append((name, path, sha256))
+    elif tarfile.is_tarfile(archive_path):
+        with tarfile.open(archive_path) as tf:
+            for member in tf.getmembers()[:MAX_ARCHIVE_MEMBERS]:
+                if not member.isfile() or member.size > MAX_MEMBER_SIZE:
+                    continue
+                name, path = _target(member.name)
+                if name:
+                    with tf.extractfile(member) as src:
+                        sha256, _ = upload_service.save_stream(src, path, MAX_MEMBER_SIZE)
+                    extracted.append((name, path, sha256))
+    else:
+        raise ValueError("不支持的压缩包格式（仅支持 zip/tar）")
+    return extracted
+
+
+def _unique_name(name, used):
+    """返回批次内未使用过的名称（重名时在扩展名前加 _2、_3 ...），并登记到 used"""
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in used:
+        n += 1
+        candidate = f"{stem}_{n}{ext}"
+    used.add(candidate)
+    return candidate
+
+
+def _is_executable(path):
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    return magic[:2] == b'MZ' or magic == b'\x7fELF'
+
+
+# --- Public Service Functions ---
+
+def submit_batch(files: list, archives: list = ()) -> dict:
+    """
+    创建批量分析任务。
+
+    Args:
+        files: [(原始文件名, werkzeug FileStorage)]，每个文件作为一个分析任务。
+        archives: 同上，压缩包中的 PE/ELF 文件各作为一个分析任务。
+
+    Returns:
+        dict: 初始批次清单。
+
+    Raises:
+        ValueError: 未找到可分析的二进制文件或压缩包格式不支持。
+    """
+    batch_id = f"batch_{time.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    batch_dir = os.path.join(BATCH_DIR, batch_id)
+    os.makedirs(batch_dir, exist_ok=True)
+
+    # 二进制进入内容寻址存储，分析ID为 <batch_id>_<文件名>，可直接用于交叉引用/差异接口
+    candidates = []
+    used = set()
+    try:
+        for original_name, storage in files:
+            name = _unique_name(f"{batch_id}_{secure_filename(original_name)}", used)
+            sha256, _, path, name = blob_store.store_stream(storage.stream, name)
+            candidates.append((name, path, sha256))
+        for original_name, storage in archives:
+            archive_path = os.path.join(batch_dir, secure_filename(original_name) or 'archive')
+            storage.save(archive_path)
+            try:
+                members = _extract_archive(archive_path, batch_dir, batch_id, used)
+            finally:
+                os.remove(archive_path)
+            for name, path, sha256 in members:
+                if _is_executable(path):
+                    path, name = blob_store.store_file(path, name, sha256)
+                    candidates.append((name, path, sha256))
+                else:
+                    os.remove(path)
+        if not candidates:
+            raise ValueError("未找到可分析的二进制文件")
+    except Exception:
+        # 批次未能创建：删除已登记的文件名，使已转存的 Blob 可被垃圾回收
+        for name, _, _ in candidates:
+            blob_store.remove_name(name)
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        raise
+
+    manifest = {
+        "batch_id": batch_id,
+        "created": time.time(),
+        "pool_size": get_pool_size(),
+        "job_heap_mb": JOB_HEAP_MB,
+        "jobs": [{
+            "analysis_id": name,
+            "sha256": sha256,
+            "status": "queued",
+            "output": os.path.basename(ghidra_service.get_output_path(name)),
+            "error": None,
+            "started": None,
+            "finished": None,
+            "worker": os.getpid(),
+        } for name, _, sha256 in candidates],
+    }
+    with _manifest_lock(batch_id):
+        _write_manifest(manifest)
+
+    for index, (name, path, sha256) in enumerate(candidates):
+        _submit_job(batch_id, index, name, path, sha256)
+    logger.info("Batch Service: 批次 %s 已提交 %s 个分析任务", batch_id, len(candidates))
+    return manifest
+
+
+def resume_orphaned_jobs(batch_id: str):
+    """
+    接管提交进程已退出的排队/运行中任务，在当前进程重新提交，返回最新的批次清单（不存在时返回 None）。
+    """
+    batch_id = secure_filename(batch_id or '')
+    if not batch_id or not os.path.exists(_manifest_path(batch_id)):
+        return None
+    with _manifest_lock(batch_id):
+        manifest = get_manifest(batch_id)
+        if manifest is None:
+            return None
+        orphaned = [index for index, job in enumerate(manifest['jobs'])
+                    if job['status'] in ('queued', 'running') and not _worker_alive(job.get('worker'))]
+        for index in orphaned:
+            manifest['jobs'][index].update(status='queued', started=None, worker=os.getpid())
+        if orphaned:
+            _write_manifest(manifest)
+    for index in orphaned:
+        job = manifest['jobs'][index]
+        _submit_job(batch_id, index, job['analysis_id'], blob_store.blob_path(job['sha256']), job['sha256'])
+    if orphaned:
+        logger.warning("Batch Service: 批次 %s 有 %s 个任务的工作进程已退出，已重新提交", batch_id, len(orphaned))
+    return manifest
+
+
+def _submit_job(batch_id, index, name, path, sha256):
+    _adjust_queue_depth(1)
+    _get_executor().submit(_run_job, batch_id, index, name, path, sha256)
+
+
+def _adjust_queue_depth(delta):
+    global _queue_depth
+    with _executor_lock:
+        _queue_depth += delta
+    metrics.GHIDRA_QUEUE_DEPTH.inc(delta)
+
+
+def _run_job(batch_id, index, name, path, sha256):
+    token = None
+    try:
+        token = _acquire_slot()
+        _update_job(batch_id, index, status='running', started=time.time())
+        analysis = ghidra_service.run_analysis(path, ghidra_service.get_output_path(name),
+                                               heap_mb=JOB_HEAP_MB, max_cpu=JOB_CPUS, sha256=sha256)
+        blob_store.add_ref(sha256, f"analysis:{name}")
+        _update_job(batch_id, index, status='done', finished=time.time(),
+                    functions=len(analysis.get('functions', [])))
+    except Exception as e:
+        logger.error("Batch Service: 任务 %s 分析失败: %s", name, e)
+        _update_job(batch_id, index, status='failed', finished=time.time(), error=str(e))
+    finally:
+        if token:
+            state_backend.get_backend().release_slot(SLOT_KEY, token)
+        _adjust_queue_depth(-1)
@@ -0,0 +1,257 @@
+"""
+内容寻址的去重 Blob 存储。
+
+上传的二进制文件按 SHA-256 存放在 uploads/blobs/<hash[:2]>/<hash[2:4]>/<hash>，
+相同内容只保存一份。catalog.db（SQLite）记录 文件名 -> 哈希 的映射以及每个 Blob 的引用方
+（如 "analysis:<分析ID>"、"conversation:<模型>/<对话ID>"），每次登记只写入一行。
+同名但内容不同的文件不会覆盖已有登记，而是登记为带哈希前缀的别名（见 store_file）。
+最后一个引用方释放时，指向该 Blob 的文件名登记一并删除；
+垃圾回收只删除既没有文件名指向、也没有任何引用方的 Blob。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from werkzeug.utils import secure_filename
+
+from . import metrics, upload_service
+from .locking import file_lock
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
+BLOB_DIR = os.path.join(UPLOAD_DIR, 'blobs')
+CATALOG_DB = os.path.join(BLOB_DIR, 'catalog.db')
+# 旧版本的 JSON 目录，首次打开 catalog.db 时导入并改名为 catalog.json.migrated
+CATALOG_FILE = os.path.join(BLOB_DIR, 'catalog.json')
+# 转存文件与垃圾回收之间的互斥锁
+CATALOG_LOCK = os.path.join(BLOB_DIR, 'catalog.lock')
+# 新写入的 Blob 在宽限期内不会被回收，避免与尚未登记引用的上传竞争（秒）
+GC_GRACE_SECONDS = 3600
+
+_local = threading.local()
+
+
+def blob_path(sha256: str) -> str:
+    """返回哈希对应的分片存储路径"""
+    return os.path.join(BLOB_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+# --- Catalog ---
+
+def _connection():
+    # 每个线程（以及 fork 出的每个 worker 进程）使用独立连接
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid() or _local.path != CATALOG_DB:
+        os.makedirs(BLOB_DIR, exist_ok=True)
+        conn = sqlite3.connect(CATALOG_DB, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, sha256 TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS names_sha256 ON names (sha256)")
+        conn.execute("CREATE TABLE IF NOT EXISTS refs (sha256 TEXT, owner TEXT, "
+                     "PRIMARY KEY (sha256, owner)) WITHOUT ROWID")
+        conn.execute("CREATE INDEX IF NOT EXISTS refs_owner ON refs (owner)")
+        _local.conn, _local.pid, _local.path = conn, os.getpid(), CATALOG_DB
+        _migrate_legacy_catalog()
+    return conn
+
+
+@contextmanager
+def _transaction():
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _migrate_legacy_catalog():
+    """导入旧版本的 catalog.json（多个 worker 同时启动时只有一个会导入）"""
+    if not os.path.exists(CATALOG_FILE):
+        return
+    with _transaction() as conn:
+        if not os.path.exists(CATALOG_FILE):
+            return
+        try:
+            with open(CATALOG_FILE, 'r', encoding='utf-8') as f:
+                catalog = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error("Blob Store: 读取旧目录文件失败: %s", e)
+            return
+        conn.executemany("INSERT OR IGNORE INTO names (name, sha256) VALUES (?, ?)",
+                         catalog.get('names', {}).items())
+        conn.executemany("INSERT OR IGNORE INTO refs (sha256, owner) VALUES (?, ?)",
+                         [(sha256, owner) for sha256, owners in catalog.get('refs', {}).items()
+                          for owner in owners])
+        os.replace(CATALOG_FILE, f"{CATALOG_FILE}.migrated")
+    logger.info("Blob Store: 已导入旧目录文件 %s", CATALOG_FILE)
+
+
+def _alias(name, sha256, counter):
+    """同名不同内容时使用的别名：<主名>_<哈希前 8 位>[_<序号>]<扩展名>"""
+    stem, ext = os.path.splitext(name)
+    suffix = sha256[:8] if counter == 1 else f"{sha256[:8]}_{counter}"
+    return f"{stem}_{suffix}{ext}"
+
+
+def _register_name(conn, name, sha256):
+    """登记 name -> sha256 并返回实际登记的文件名；名字已指向其他内容时改用别名，不覆盖已有登记"""
+    candidate, counter = name, 0
+    while True:
+        row = conn.execute("SELECT sha256 FROM names WHERE name = ?", (candidate,)).fetchone()
+        if row is None:
+            conn.execute("INSERT INTO names (name, sha256) VALUES (?, ?)", (candidate, sha256))
+            return candidate
+        if row[0] == sha256:
+            return candidate
+        counter += 1
+        candidate = _alias(name, sha256, counter)
+
+
+# --- Public Service Functions ---
+
+def store_file(src_path: str, name: str, sha256: str):
+    """
+    将已写入磁盘且已知哈希的文件移入 Blob 存储（内容已存在时直接丢弃源文件），
+    并登记 name -> sha256。name 已指向其他内容时登记为 <主名>_<哈希前 8 位><扩展名>，
+    调用方应使用返回的文件名作为之后分析、预分析等接口的文件标识。
+
+    Returns:
+        tuple: (Blob 路径, 实际登记的文件名；name 为空时为空字符串)
+    """
+    dest = blob_path(sha256)
+    name = secure_filename(name or '')
+
+    # 在转存锁内完成转存与登记，避免与并发的垃圾回收交错
+    with file_lock(CATALOG_LOCK):
+        exists = os.path.exists(dest)
+        metrics.cache_lookup('blob_dedup', exists)
+        if exists:
+            os.remove(src_path)
+            os.utime(dest)
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(src_path, dest)
+        if name:
+            with _transaction() as conn:
+                name = _register_name(conn, name, sha256)
+    return dest, name
+
+
+def store_stream(stream, name: str, max_size: int = None):
+    """
+    将输入流写入 Blob 存储，边写边计算哈希。
+
+    Returns:
+        tuple: (sha256, size, blob 路径, 实际登记的文件名)
+    """
+    staging_dir = os.path.join(BLOB_DIR, 'staging')
+    os.makedirs(staging_dir, exist_ok=True)
+    staging_path = os.path.join(staging_dir, f"{os.getpid()}_{time.time_ns()}")
+    sha256, size = upload_service.save_stream(stream, staging_path, max_size)
+    return (sha256, size, *store_file(staging_path, name, sha256))
+
+
+def lookup(name: str):
+    """返回文件名对应的哈希，未登记返回 None"""
+    name = secure_filename(name or '')
+    if not name:
+        return None
+    row = _connection().execute("SELECT sha256 FROM names WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def resolve(name: str):
+    """
+    按文件名解析上传文件的磁盘路径：优先 Blob 存储，其次兼容旧的 uploads/<name>。
+    不存在时返回 None。
+    """
+    name = secure_filename(name or '')
+    if not name:
+        return None
+    sha256 = lookup(name)
+    if sha256 and os.path.exists(blob_path(sha256)):
+        return blob_path(sha256)
+    legacy = os.path.join(UPLOAD_DIR, name)
+    return legacy if os.path.isfile(legacy) else None
+
+
+def add_ref(sha256: str, owner: str):
+    """登记引用方（如分析或对话）对 Blob 的引用"""
+    _connection().execute("INSERT OR IGNORE INTO refs (sha256, owner) VALUES (?, ?)", (sha256, owner))
+
+
+def release_owner(owner: str) -> int:
+    """
+    释放某个引用方持有的全部引用，返回释放的数量。
+    Blob 的最后一个引用被释放时，同时删除指向它的文件名登记，使其可被垃圾回收。
+    """
+    with _transaction() as conn:
+        hashes = [row[0] for row in conn.execute("SELECT sha256 FROM refs WHERE owner = ?", (owner,))]
+        conn.execute("DELETE FROM refs WHERE owner = ?", (owner,))
+        for sha256 in hashes:
+            if conn.execute("SELECT 1 FROM refs WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone() is None:
+                conn.execute("DELETE FROM names WHERE sha256 = ?", (sha256,))
+    return len(hashes)
+
+
+def remove_name(name: str) -> bool:
+    """删除文件名登记（Blob 本身在无引用后由 gc 回收）"""
+    name = secure_filename(name or '')
+    if not name:
+        return False
+    return _connection().execute("DELETE FROM names WHERE name = ?", (name,)).rowcount > 0
+
+
+def _blob_files():
+    """遍历存储中的 Blob 文件，产出 (哈希, 路径)"""
+    for root, _, files in os.walk(BLOB_DIR):
+        if os.path.abspath(root) == os.path.abspath(BLOB_DIR) or os.path.basename(root) == 'staging':
+            continue
+        for sha256 in files:
+            yield sha256, os.path.join(root, sha256)
+
+
+def gc() -> dict:
+    """删除没有文件名指向且没有引用方的 Blob，返回回收统计"""
+    cutoff = time.time() - GC_GRACE_SECONDS
+    removed, freed = 0, 0
+    with file_lock(CATALOG_LOCK):
+        conn = _connection()
+        live = ({row[0] for row in conn.execute("SELECT sha256 FROM names")}
+                | {row[0] for row in conn.execute("SELECT sha256 FROM refs")})
+        for sha256, path in _blob_files():
+            try:
+                stat = os.stat(path)
+                if sha256 in live or stat.st_mtime > cutoff:
+                    continue
+                os.remove(path)
+                removed += 1
+                freed += stat.st_size
+            except OSError:
+                continue
+    logger.info("Blob Store: 垃圾回收删除 %s 个Blob，释放 %s 字节", removed, freed)
+    return {"removed": removed, "freed_bytes": freed}
+
+
+def stats() -> dict:
+    """返回存储统计：唯一 Blob 数、总字节数、文件名数量"""
+    blobs, total = 0, 0
+    for _, path in _blob_files():
+        try:
+            total += os.path.getsize(path)
+            blobs += 1
+        except OSError:
+            pass
+    conn = _connection()
+    (names,) = conn.execute("SELECT COUNT(*) FROM names").fetchone()
+    (referenced,) = conn.execute("SELECT COUNT(DISTINCT sha256) FROM refs").fetchone()
+    return {"blobs": blobs, "total_bytes": total, "names": names, "referenced_blobs": referenced}
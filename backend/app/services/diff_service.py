@@ -0,0 +1,119 @@
+"""
+二进制版本间的函数级差异分析服务。
+
+以归一化指令序列的稳定哈希匹配两个分析结果中的函数，报告新增、删除和变化的函数；
+未变化的函数可直接沿用旧版本的反编译与 LLM 分析结果。
+注意：归一化规则需与 uploads/analyse/combined_export.py 中的实现保持一致。
+"""
+import hashlib
+import json
+import os
+import re
+
+from . import xref_service
+
+# 大于等于 0x1000 的十六进制常量视为地址（重链接后会变化），较小的立即数保留
+_ADDRESS_RE = re.compile(r'0x[0-9a-fA-F]{4,}')
+# Ghidra 自动生成的、内嵌地址的符号名
+_AUTO_NAME_RE = re.compile(r'\b(FUN|DAT|LAB|PTR|SUB|UNK|thunk_FUN|switchD|caseD|s|u)_[0-9a-fA-F]+\b')
+
+
+def normalize_instruction(code: str) -> str:
+    """去除指令文本中与链接地址相关的部分"""
+    code = _AUTO_NAME_RE.sub(r'\1_#', code)
+    return _ADDRESS_RE.sub('#', code)
+
+
+def function_hash(func: dict) -> str:
+    """返回函数的稳定哈希；优先使用导出器计算的 instruction_hash"""
+    if func.get('instruction_hash'):
+        return func['instruction_hash']
+    lines = [normalize_instruction(item.get('code', ''))
+             for item in func.get('disassembly', []) if 'code' in item]
+    if not lines:
+        # 无反汇编的旧导出，退回到归一化的反编译代码
+        lines = [normalize_instruction(line.strip()) for line in func.get('c_code', '').splitlines() if line.strip()]
+    return hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def _is_auto_name(name):
+    return bool(_AUTO_NAME_RE.fullmatch(name or ''))
+
+
+def _summary(func, func_hash):
+    return {"name": func.get('name'), "entry_point": func.get('entry_point'), "hash": func_hash}
+
+
+def diff_analyses(base: dict, target: dict) -> dict:
+    """
+    比较两个分析结果的函数集合。
+
+    匹配顺序：先按指令哈希精确匹配（同哈希多候选时优先同名），
+    再按非自动生成的函数名匹配（视为已变化）。
+
+    Returns:
+        dict: added / removed / changed / unchanged 列表及统计信息。
+    """
+    base_funcs = [(f, function_hash(f)) for f in base.get('functions', [])]
+    target_funcs = [(f, function_hash(f)) for f in target.get('functions', [])]
+
+    base_by_hash = {}
+    for item in base_funcs:
+        base_by_hash.setdefault(item[1], []).append(item)
+
+    matched_base = set()
+    unchanged, pending = [], []
+    for func, func_hash in target_funcs:
+        candidates = [c for c in base_by_hash.get(func_hash, ()) if id(c[0]) not in matched_base]
+        if not candidates:
+            pending.append((func, func_hash))
+            continue
+        same_name = [c for c in candidates if c[0].get('name') == func.get('name')]
+        old_func = (same_name or candidates)[0][0]
+        matched_base.add(id(old_func))
+        unchanged.append({"name": func.get('name'), "entry_point": func.get('entry_point'),
+                          "base_name": old_func.get('name'), "base_entry_point": old_func.get('entry_point'),
+                          "hash": func_hash})
+
+    base_by_name = {f.get('name'): (f, h) for f, h in base_funcs
+                    if id(f) not in matched_base and not _is_auto_name(f.get('name'))}
+    changed, added = [], []
+    for func, func_hash in pending:
+        old = base_by_name.pop(func.get('name'), None) if not _is_auto_name(func.get('name')) else None
+        if old is None:
+            added.append(_summary(func, func_hash))
+            continue
+        matched_base.add(id(old[0]))
+        changed.append({"name": func.get('name'), "entry_point": func.get('entry_point'),
+                        "base_entry_point": old[0].get('entry_point'),
+                        "hash": func_hash, "base_hash": old[1]})
+
+    removed = [_summary(f, h) for f, h in base_funcs if id(f) not in matched_base]
+    return {
+        "added": added,
+        "removed": removed,
+        "changed": changed,
+        "unchanged": unchanged,
+        "stats": {
+            "base_functions": len(base_funcs),
+            "target_functions": len(target_funcs),
+            "added": len(added),
+            "removed": len(removed),
+            "changed": len(changed),
+            "unchanged": len(unchanged),
+        },
+    }
+
+
+def load_analysis(analysis_id: str) -> dict:
+    """按分析ID读取 Ghidra 分析结果
+
+    Raises:
+        ValueError: 分析ID无效。
+        FileNotFoundError: 分析结果不存在。
+    """
+    path = xref_service.get_analysis_path(analysis_id)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"分析结果不存在: {analysis_id}")
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
@@ -1,11 +1,33 @@
 import requests
 import json
+import logging
 from flask import Response
 import os
+import random
+import time
+import uuid
+
+import urllib3
+
+from .. import config as app_config
+from . import history_service, metrics, upstream_router
+from ..logging_setup import truncate
+
+logger = logging.getLogger(__name__)
+
+# 连接超时与读取超时（秒）：连接阶段快速失败，读取超时为两次数据之间的最长等待
+CONNECT_TIMEOUT = float(os.getenv('DIFY_CONNECT_TIMEOUT', '5'))
+CHAT_READ_TIMEOUT = float(os.getenv('DIFY_READ_TIMEOUT', '120'))
+UPLOAD_READ_TIMEOUT = 60
+# 单次请求的最大尝试次数（含首次）与退避参数（秒）
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF_BASE = 0.2
+RETRY_BACKOFF_MAX = 2.0
+
 
 def get_dify_conversation_id(conversation_id, model):
     """
-    从本地历史记录文件中获取 Dify 对话 ID。
+    从本地历史记录的元数据中获取 Dify 对话 ID。
 
     Args:
         conversation_id: 本地对话 ID (日期格式)。
@@ -15,78 +37,173 @@ def get_dify_conversation_id(conversation_id, model):
         str or None: Dify 对话 ID，如果未找到或发生错误则返回 None。
     """
     if not conversation_id:
-        print("Dify Service: 未提供本地对话ID，将创建新对话")
+        logger.debug("Dify Service: 未提供本地对话ID，将创建新对话")
         return None
 
-    try:
-        history_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'history')
-        model_dir = os.path.join(history_dir, model)
-        print(f"Dify Service: 查找对话ID {conversation_id} 的Dify ID，模型: {model}")
-
-        # 基础安全检查，防止路径遍历
-        if '..' in conversation_id or '/' in conversation_id or '\\' in conversation_id:
-            print(f"警告：无效的本地对话ID格式 '{conversation_id}'")
-            return None
-
-        filepath = os.path.join(model_dir, f"{conversation_id}.json")
-        print(f"Dify Service: 尝试读取历史文件: {filepath}")
-
-        if not os.path.exists(filepath):
-            print(f"Dify Service: 历史文件不存在: {filepath}，将创建新对话")
-            return None # 文件不存在，表示没有对应的 Dify ID
-
-        with open(filepath, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-            print(f"Dify Service: 成功读取历史文件，包含 {len(history)} 条记录")
-
-        # Dify ID 存储在历史记录的第一个元素（元数据）中
-        if history and isinstance(history[0], dict):
-            dify_id = history[0].get('dify_conversation_id')
-            print(f"Dify Service: 从历史记录中获取到 Dify ID: {dify_id}")
-            return dify_id
-        else:
-            print(f"Dify Service: 历史记录结构异常，无法找到元数据")
-            return None
-    except FileNotFoundError:
-        print(f"Dify Service: 找不到历史文件: {filepath}")
-        return None # 明确处理文件找不到的情况
-    except json.JSONDecodeError as json_err:
-        print(f"Dify Service: 历史文件JSON解析错误: {json_err}")
-        return None
-    except Exception as e:
-        print(f"错误：获取 Dify 对话 ID 时失败 (对话: {conversation_id}, 模型: {model}): {e}")
+    metadata = history_service.get_conversation_metadata(conversation_id, model)
+    if not metadata:
+        logger.debug("Dify Service: 对话 %s 无历史元数据 (模型: %s)，将创建新对话", conversation_id, model)
         return None
+    dify_id = metadata.get('dify_conversation_id')
+    logger.debug("Dify Service: 从历史记录中获取到 Dify ID: %s", dify_id)
+    return dify_id
 
-def stream_dify_chat(api_url, api_key, payload):
-    """处理流式接口调用，向Dify发送请求并流式返回结果"""
-    
-    # 确保URL格式正确
-    base_url = api_url.rstrip('/')
-    dify_chat_url = f"{base_url}/chat-messages"
-    
+
+def resolve_endpoints(model, conversation_id):
+    """
+    确定对话可用的上游端点。
+
+    已绑定端点的对话只返回绑定的端点；没有绑定记录但已有 Dify 对话 ID 的旧对话
+    视为属于第一个端点（即原单端点配置）。绑定的端点已从配置中移除时重新选择，
+    此时原 Dify 对话 ID 不再可用。
+
+    Returns:
+        tuple: (对话元数据或 None, 按优先级排序的候选端点列表, 绑定端点是否仍有效)
+    """
+    metadata = None
+    if conversation_id and not conversation_id.startswith('temp-'):
+        metadata = history_service.get_conversation_metadata(conversation_id, model)
+    pinned = None
+    if metadata:
+        pinned = metadata.get('dify_endpoint')
+        if not pinned and metadata.get('dify_conversation_id'):
+            endpoints = app_config.get_model_endpoints(model)
+            pinned = endpoints[0]['id'] if endpoints else None
+    candidates = upstream_router.candidates(model, pinned)
+    pinned_valid = bool(pinned and candidates and candidates[0]['id'] == pinned)
+    if pinned and not pinned_valid:
+        logger.warning("Dify Service: 对话 %s 绑定的端点 %s 已不在配置中，重新选择端点", conversation_id, pinned)
+    return metadata, candidates, pinned_valid
+
+
+def pin_conversation(conversation_id, model, endpoint):
+    """请求在某端点成功后，将尚未绑定的对话绑定到该端点"""
+    if not conversation_id or conversation_id.startswith('temp-'):
+        return
+    metadata = history_service.get_conversation_metadata(conversation_id, model)
+    if metadata and metadata.get('dify_endpoint') != endpoint['id']:
+        history_service.set_conversation_endpoint(conversation_id, endpoint['id'], model)
+
+
+def is_connect_failure(exc) -> bool:
+    """是否为连接建立阶段的失败（请求尚未发出，可以安全重试）"""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(exc, requests.exceptions.ConnectionError):
+        return False
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+
+def _backoff(attempt):
+    """带完全抖动的指数退避等待时间（秒）"""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _open_chat_stream(model, candidates, dify_payload):
+    """
+    建立到 Dify 的流式聊天请求。
+
+    熔断中的端点直接跳过。连接阶段失败时以抖动退避重试（未绑定的对话转移到下一个端点），
+    总尝试次数不超过 RETRY_ATTEMPTS；读取阶段的失败不重试（请求可能已被处理）。
+    5xx 计为端点失败并转移到下一个端点，最后一个端点仍返回 5xx 时把该响应交给调用方处理。
+
+    Returns:
+        tuple: (端点, requests.Response, 熔断器放行凭据 upstream_router.Permit)
+
+    Raises:
+        upstream_router.UpstreamUnavailable: 所有端点熔断或连接失败。
+        requests.exceptions.RequestException: 读取阶段失败（如等待响应超时）。
+    """
+    attempts = 0
+    index = 0
+    last_error = None
+    while index < len(candidates) and attempts < RETRY_ATTEMPTS:
+        endpoint = candidates[index]
+        is_last = index == len(candidates) - 1
+        permit = upstream_router.acquire(model, endpoint['id'])
+        if not permit:
+            index += 1
+            continue
+        if attempts:
+            time.sleep(_backoff(attempts))
+        attempts += 1
+
+        dify_chat_url = f"{endpoint['api_url']}/chat-messages"
+        headers = {
+            'Authorization': f"Bearer {endpoint['api_key']}",
+            'Content-Type': 'application/json'
+        }
+        started = time.time()
+        try:
+            response = requests.post(
+                dify_chat_url,
+                headers=headers,
+                json=dify_payload,
+                stream=True,
+                timeout=(CONNECT_TIMEOUT, CHAT_READ_TIMEOUT)
+            )
+        except requests.exceptions.RequestException as e:
+            upstream_router.record_failure(model, endpoint['id'])
+            upstream_router.release(model, endpoint['id'], permit)
+            logger.warning("Dify Service: 调用端点 %s 失败 (%s): %s", endpoint['id'], dify_chat_url, e)
+            if not is_connect_failure(e):
+                raise
+            last_error = e
+            # 连接失败：还有其他候选端点时转移，否则重试当前端点
+            if not is_last:
+                index += 1
+            continue
+
+        if response.status_code >= 500:
+            upstream_router.record_failure(model, endpoint['id'])
+            if not is_last:
+                logger.warning("Dify Service: 端点 %s 返回 %s，尝试下一个端点", endpoint['id'], response.status_code)
+                response.close()
+                upstream_router.release(model, endpoint['id'], permit)
+                index += 1
+                continue
+        else:
+            upstream_router.record_success(model, endpoint['id'], time.time() - started)
+        return endpoint, response, permit
+
+    wait = upstream_router.retry_after(model, [endpoint['id'] for endpoint in candidates])
+    if last_error is not None:
+        raise upstream_router.UpstreamUnavailable(model, max(wait, 1), f"连接失败 ({last_error})")
+    raise upstream_router.UpstreamUnavailable(model, wait, "熔断中")
+
+
+def stream_dify_chat(payload):
+    """
+    向Dify发送聊天请求，返回流式输出响应内容的生成器。
+
+    连接在调用时立即建立，因此熔断或连接失败会直接抛出异常，调用方可以立即返回结构化错误；
+    Dify 返回的业务错误仍以 SSE error 事件的形式在生成器中输出。
+    目标端点由 resolve_endpoints 决定：已绑定的对话固定发往其端点，
+    新对话按负载与延迟选择端点并在失败时转移到下一个，成功后绑定。
+
+    Raises:
+        ValueError: 模型未配置端点。
+        upstream_router.UpstreamUnavailable: 端点熔断或无法连接。
+        requests.exceptions.RequestException: 等待响应时失败。
+    """
     # 获取必要参数
     local_conversation_id = payload.get('conversation_id', '')
     model = payload.get('model', '')
-    
+
+    metadata, candidates, pinned_valid = resolve_endpoints(model, local_conversation_id)
+    if not candidates:
+        raise ValueError(f"{model} API未配置")
+
     # 标准化payload
-    # 如果已有Dify对话ID，使用它；否则使用空字符串让Dify创建新对话
+    # 如果已有Dify对话ID（且仍在其所属端点上），使用它；否则使用空字符串让Dify创建新对话
     dify_conversation_id = ''
-    
-    # 如果提供了本地对话ID且不是临时ID，查询对应的Dify ID
-    if local_conversation_id and not local_conversation_id.startswith('temp-'):
-        print(f"Dify Service: 处理本地对话ID: {local_conversation_id}, 模型: {model}")
-        try:
-            dify_conversation_id = get_dify_conversation_id(local_conversation_id, model)
-            if dify_conversation_id:
-                print(f"Dify Service: 查询对应的Dify对话ID: {dify_conversation_id}")
-                print(f"Dify Service: 使用已存在的Dify对话ID: {dify_conversation_id}")
-            else:
-                print(f"Dify Service: 未找到对应的Dify对话ID，将创建新对话")
-        except Exception as e:
-            print(f"Dify Service: 查询Dify对话ID时出错: {e}")
-            # 错误时使用空ID，让Dify创建新对话
-            dify_conversation_id = ''
-    
+    if metadata and pinned_valid and metadata.get('dify_conversation_id'):
+        dify_conversation_id = metadata['dify_conversation_id']
+        logger.debug("Dify Service: 使用已存在的Dify对话ID: %s (端点: %s)", dify_conversation_id, candidates[0]['id'])
+    elif local_conversation_id:
+        logger.debug("Dify Service: 未找到对应的Dify对话ID，将创建新对话")
+
     # 构建发送到Dify的payload
     # "inputs": {"task": payload.get('model', 'dify1')},
     dify_payload = {
@@ -103,34 +220,30 @@ def stream_dify_chat(api_url, api_key, payload):
     # 文件处理 - 直接使用payload中的files字段，确保格式与Python脚本完全一致
     files = payload.get('files', [])
     if files:
-        print(f"Dify Service: 收到文件ID列表: {files}")
+        logger.debug("Dify Service: 收到文件ID列表: %s", files)
         # 直接将文件引用数组添加到payload
         dify_payload["files"] = files
-    
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json'
-    }
-    
-    try:
-        # 打印最终发送的 payload (去除敏感信息)
-        log_payload = {k: v for k, v in dify_payload.items() if k != 'api_key'}
-        print(f"Dify Service: 发送最终 Payload 到 {dify_chat_url}: {json.dumps(log_payload, ensure_ascii=False)}")
 
-        # 发送请求到 Dify
-        response = requests.post(
-            dify_chat_url,
-            headers=headers,
-            json=dify_payload,
-            stream=True,
-            timeout=120
-        )
+    # payload 可能包含大段反编译代码，只在 DEBUG 级别输出截断后的内容（不含 API 密钥）
+    logger.debug("Dify Service: 发送最终 Payload 到模型 %s: %s", model, truncate(dify_payload))
+
+    # 发送请求到 Dify
+    started = time.time()
+    endpoint, response, permit = _open_chat_stream(model, candidates, dify_payload)
+    return _relay_chat_stream(model, local_conversation_id, endpoint, response, permit, started)
+
 
+def _relay_chat_stream(model, local_conversation_id, endpoint, response, permit, started):
+    """转发 Dify 的流式响应，结束时释放端点的在途名额"""
+    outcome = 'error'
+    first_chunk = True
+    metrics.DIFY_STREAMS_IN_FLIGHT.inc(model=model)
+    try:
         # 检查 HTTP 错误状态
         if not response.ok:
             try:
                 error_json = response.json()
-                print(f"Dify Service: API 错误响应: {error_json}")
+                logger.error("Dify Service: API 错误响应: %s", error_json)
                 
                 # 返回一个包含错误信息的事件，让前端能够正确显示
                 error_text = "Dify API错误"
@@ -147,12 +260,12 @@ def stream_dify_chat(api_url, api_key, payload):
                 yield f"data: {{\"event\": \"error\", \"message\": \"{error_text}\"}}\n\n".encode('utf-8')
                 
                 # 如果已返回错误事件，就不要再抛出异常了
-                print(f"Dify Service: 已发送错误事件到前端: {error_text}")
+                logger.warning("Dify Service: 已发送错误事件到前端: %s", error_text)
                 return
                 
             except Exception as json_err:
-                print(f"Dify Service: 解析API错误响应失败: {json_err}")
-                print(f"Dify Service: API 返回非 JSON 错误: {response.text[:500]}...")
+                logger.error("Dify Service: 解析API错误响应失败: %s", json_err)
+                logger.error("Dify Service: API 返回非 JSON 错误: %s", truncate(response.text, 500))
                 # 生成通用错误事件
                 error_text = f"服务器错误，状态码: {response.status_code}"
                 yield f"data: {{\"event\": \"error\", \"message\": \"{error_text}\"}}\n\n".encode('utf-8')
@@ -161,13 +274,179 @@ def stream_dify_chat(api_url, api_key, payload):
         # 只有在没有发送错误事件的情况下才继续
         response.raise_for_status()
 
+        # 新对话绑定到本次成功的端点，后续消息与上传都发往该端点
+        pin_conversation(local_conversation_id, model, endpoint)
+
         # 流式返回响应内容
+        outcome = 'aborted'  # 客户端中途断开时生成器在 yield 处退出
         for chunk in response.iter_content(chunk_size=None):
             if chunk:
+                if first_chunk:
+                    first_chunk = False
+                    metrics.DIFY_TTFB_SECONDS.observe(time.time() - started, model=model, endpoint=endpoint['id'])
                 yield chunk
+        outcome = 'ok'
 
     except requests.exceptions.RequestException as e:
-        print(f"Dify Service: 调用 Dify API 时出错 ({dify_chat_url}): {e}")
+        outcome = 'error'
+        upstream_router.record_failure(model, endpoint['id'])
+        logger.error("Dify Service: 调用 Dify API 时出错 (模型 %s): %s", model, e)
         error_text = f"调用Dify API时出错: {str(e)}"
         yield f"data: {{\"event\": \"error\", \"message\": \"{error_text}\"}}\n\n".encode('utf-8')
-        raise
\ No newline at end of file
+        raise
+    finally:
+        response.close()
+        upstream_router.release(model, endpoint['id'], permit)
+        metrics.DIFY_STREAMS_IN_FLIGHT.dec(model=model)
+        metrics.DIFY_STREAM_DURATION_SECONDS.observe(time.time() - started, model=model, outcome=outcome)
+
+
+# --- 文件上传 ---
+
+# 流式转发时保留在内存中的重放缓冲区上限（字节），超出后失败将无法重试
+UPLOAD_REPLAY_BUFFER_SIZE = int(os.getenv('DIFY_UPLOAD_REPLAY_BUFFER', str(16 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadForwardError(Exception):
+    """文件转发到 Dify 失败且无法重试"""
+
+
+def _multipart_body(boundary, user, filename, chunks):
+    """生成发送到 Dify 的 multipart 请求体，文件内容逐块产出"""
+    yield (f'--{boundary}\r\nContent-Disposition: form-data; name="user"\r\n\r\n{user}\r\n'
+           f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+           f'Content-Type: text/plain\r\n\r\n').encode('utf-8')
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+    yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+
+def upload_file(model, endpoint, user, filename, chunks):
+    """
+    以分块传输编码将文件上传到端点的 /files/upload，并向熔断器报告结果。
+
+    Args:
+        endpoint: 目标端点 {"id", "api_url", "api_key"}。
+        chunks: 产出文件内容的可迭代对象，边读边发送，不在内存或磁盘中整体缓存。
+
+    Returns:
+        requests.Response: Dify 的响应（调用方检查状态码）。
+
+    Raises:
+        upstream_router.UpstreamUnavailable: 端点熔断中。
+        requests.exceptions.RequestException: 请求失败。
+    """
+    permit = upstream_router.acquire(model, endpoint['id'])
+    if not permit:
+        raise upstream_router.UpstreamUnavailable(model, upstream_router.retry_after(model, [endpoint['id']]), "熔断中")
+    boundary = uuid.uuid4().hex
+    headers = {
+        'Authorization': f"Bearer {endpoint['api_key']}",
+        'Content-Type': f'multipart/form-data; boundary={boundary}',
+    }
+    try:
+        response = requests.post(
+            f"{endpoint['api_url'].rstrip('/')}/files/upload",
+            headers=headers,
+            data=_multipart_body(boundary, user, filename, chunks),
+            timeout=(CONNECT_TIMEOUT, UPLOAD_READ_TIMEOUT)
+        )
+    except requests.exceptions.RequestException:
+        upstream_router.record_failure(model, endpoint['id'])
+        raise
+    finally:
+        upstream_router.release(model, endpoint['id'], permit)
+    if response.status_code >= 500:
+        upstream_router.record_failure(model, endpoint['id'])
+    else:
+        # 上传耗时取决于文件大小，不计入延迟统计
+        upstream_router.record_success(model, endpoint['id'])
+    return response
+
+
+def _iter_file(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def upload_saved_file(model, endpoint, user, filename, path):
+    """
+    上传已保存在磁盘上的文件。连接中断时以抖动退避重试（请求体不完整的上传不会被 Dify 接受，
+    重试是安全的）；等待响应超时不重试。
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        if attempt:
+            time.sleep(_backoff(attempt))
+        try:
+            return upload_file(model, endpoint, user, filename, _iter_file(path))
+        except requests.exceptions.ConnectionError as e:
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise upstream_router.UpstreamUnavailable(
+                    model, upstream_router.retry_after(model, [endpoint['id']]) or 1, f"连接失败 ({e})") from e
+            logger.warning("Dify Service: 上传 %s 连接失败，第 %s 次重试: %s", filename, attempt + 1, e)
+
+
+def forward_upload(model, endpoint, user, filename, source, spill_path):
+    """
+    将客户端上传流直接转发到 Dify，不写临时文件。
+
+    读取过的数据在内存中保留不超过 UPLOAD_REPLAY_BUFFER_SIZE 字节用于重放。连接失败时，
+    若缓冲区仍完整，则把缓冲区与剩余输入写入 spill_path 后从磁盘重试；否则无法重试。
+
+    Args:
+        endpoint: 目标端点 {"id", "api_url", "api_key"}。
+        source: 提供 read(n) 的输入流（如 upload_service.MultipartStream）。
+        spill_path: 需要重试时落盘的路径，调用方负责删除。
+
+    Returns:
+        requests.Response: Dify 的响应。
+
+    Raises:
+        UploadForwardError: 连接失败且数据已无法重放。
+        upstream_router.UpstreamUnavailable: 端点熔断中或重试后仍无法连接。
+        UploadError 等: 读取输入流时的错误原样抛出。
+    """
+    replay = bytearray()
+    state = {"replayable": True, "source_error": None}
+
+    def _chunks():
+        while True:
+            try:
+                chunk = source.read(UPLOAD_CHUNK_SIZE)
+            except Exception as e:
+                state['source_error'] = e
+                raise
+            if not chunk:
+                return
+            if state['replayable']:
+                if len(replay) + len(chunk) <= UPLOAD_REPLAY_BUFFER_SIZE:
+                    replay.extend(chunk)
+                else:
+                    state['replayable'] = False
+                    replay.clear()
+            yield chunk
+
+    try:
+        return upload_file(model, endpoint, user, filename, _chunks())
+    except requests.exceptions.ConnectionError as e:
+        if state['source_error'] is not None:
+            raise state['source_error']
+        if not state['replayable']:
+            raise UploadForwardError(f"转发到Dify时连接中断，文件超过重放缓冲区，请重新上传: {e}") from e
+        logger.warning("Dify Service: 转发 %s 连接失败，写入磁盘后重试: %s", filename, e)
+
+    with open(spill_path, 'wb') as f:
+        f.write(replay)
+        replay.clear()
+        while True:
+            chunk = source.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+    return upload_saved_file(model, endpoint, user, filename, spill_path)
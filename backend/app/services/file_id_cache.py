@@ -0,0 +1,77 @@
+"""
+Dify upload_file_id 缓存。
+
+同一用户向同一模型（同一 Dify 地址）重复上传相同内容的文档时，直接返回之前的
+upload_file_id，跳过上游传输。Dify 的文件只能被上传它的终端用户使用，因此缓存键包含 user。
+缓存保存在 uploads/dify_file_cache.json，多个 worker 进程共享；过期时间应与 Dify 的文件保留期一致。
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+
+from . import metrics
+from .locking import file_lock
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
+CACHE_FILE = os.path.join(UPLOAD_DIR, 'dify_file_cache.json')
+CACHE_LOCK = os.path.join(UPLOAD_DIR, 'dify_file_cache.lock')
+# 缓存有效期（秒），默认 24 小时
+CACHE_TTL = int(os.getenv('DIFY_FILE_CACHE_TTL', str(24 * 3600)))
+
+_cache = (None, {})  # (mtime_ns, entries)
+
+
+def _cache_key(model, api_url, user, sha256):
+    raw = f"{model}|{(api_url or '').rstrip('/')}|{user}|{sha256}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _read_entries():
+    global _cache
+    try:
+        mtime = os.stat(CACHE_FILE).st_mtime_ns
+    except OSError:
+        return {}
+    if _cache[0] == mtime:
+        return _cache[1]
+    try:
+        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error("File ID Cache: 读取缓存文件失败: %s", e)
+        return {}
+    _cache = (mtime, entries)
+    return entries
+
+
+def get(model: str, api_url: str, user: str, sha256: str):
+    """返回缓存的 Dify 上传结果（含 id），未命中或已过期返回 None"""
+    if not sha256:
+        return None
+    entry = _read_entries().get(_cache_key(model, api_url, user, sha256))
+    if not entry or entry.get('expires', 0) < time.time():
+        metrics.cache_lookup('dify_file_id', False)
+        return None
+    metrics.cache_lookup('dify_file_id', True)
+    return entry['result']
+
+
+def put(model: str, api_url: str, user: str, sha256: str, result: dict):
+    """记录 Dify 上传结果，同时清理已过期的条目"""
+    global _cache
+    if not sha256 or not result or not result.get('id'):
+        return
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    now = time.time()
+    with file_lock(CACHE_LOCK):
+        _cache = (None, {})
+        entries = {k: v for k, v in _read_entries().items() if v.get('expires', 0) >= now}
+        entries[_cache_key(model, api_url, user, sha256)] = {"result": result, "expires": now + CACHE_TTL}
+        tmp_path = f"{CACHE_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, CACHE_FILE)
@@ -0,0 +1,231 @@
+"""
+Ghidra headless 分析服务：封装 analyzeHeadless 调用与分析结果读取。
+
+导入并自动分析后的 Ghidra 项目按二进制 SHA-256 持久保存在 uploads/ghidra_proj/<hash>/，
+后续导出（重新分析、额外脚本）使用 -process 复用已分析的程序，跳过导入与自动分析。
+项目目录受磁盘配额约束，超出时按最近使用时间（LRU）淘汰；每个项目由文件锁
+uploads/ghidra_proj/<hash>.lock 保护（锁文件位于项目目录之外，淘汰项目时不会被一并删除），
+避免并发任务同时打开同一项目。
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+from . import metrics, triage_service
+from .locking import file_lock
+from ..logging_setup import truncate
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
+GHIDRA_PATH = os.getenv('GHIDRA_HEADLESS', '/disk1/users/laiqj/ghidra_11.3.2_PUBLIC/support/analyzeHeadless')
+PROJECT_DIR = os.path.join(UPLOAD_DIR, 'ghidra_proj')
+SCRIPT_DIR = os.path.join(UPLOAD_DIR, 'analyse')
+SCRIPT_PATH = os.path.join(SCRIPT_DIR, 'combined_export.py')
+GHIDRA_TIMEOUT = 600
+PROJECT_NAME = 'project'
+# 项目存储的磁盘配额（MB），超出后淘汰最久未使用的项目
+PROJECT_QUOTA_MB = int(os.getenv('GHIDRA_PROJECT_QUOTA_MB', '10240'))
+
+_META_FILE = 'meta.json'
+_LOCK_SUFFIX = '.lock'
+
+
+class GhidraError(Exception):
+    """Ghidra 分析失败"""
+
+    def __init__(self, message, stderr=''):
+        super().__init__(message)
+        self.stderr = stderr
+
+
+def get_output_path(filename: str) -> str:
+    """返回二进制文件对应的 Ghidra 分析结果路径"""
+    return os.path.join(UPLOAD_DIR, f'{filename}_ghidra.json')
+
+
+# --- Project Store ---
+
+def _project_path(sha256):
+    return os.path.join(PROJECT_DIR, sha256)
+
+
+def _lock_path(sha256):
+    return os.path.join(PROJECT_DIR, sha256 + _LOCK_SUFFIX)
+
+
+def _read_meta(project_path):
+    try:
+        with open(os.path.join(project_path, _META_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _write_meta(project_path, meta):
+    with open(os.path.join(project_path, _META_FILE), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def list_projects() -> list:
+    """列出已持久化的 Ghidra 项目（按最近使用时间倒序）"""
+    projects = []
+    if not os.path.isdir(PROJECT_DIR):
+        return projects
+    for entry in os.scandir(PROJECT_DIR):
+        if not entry.is_dir():
+            continue
+        meta = _read_meta(entry.path)
+        if meta is None:
+            continue
+        projects.append({
+            "sha256": entry.name,
+            "program": meta.get('program'),
+            "created": meta.get('created'),
+            "last_used": meta.get('last_used', 0),
+            "size_bytes": _dir_size(entry.path),
+        })
+    projects.sort(key=lambda p: p['last_used'], reverse=True)
+    return projects
+
+
+def enforce_quota(keep: str = None):
+    """按 LRU 淘汰项目直到总大小低于配额；正在被使用（已加锁）的项目和 keep 不会被淘汰"""
+    quota = PROJECT_QUOTA_MB * 1024 * 1024
+    projects = list_projects()
+    total = sum(p['size_bytes'] for p in projects)
+    for project in reversed(projects):
+        if total <= quota:
+            break
+        if project['sha256'] == keep:
+            continue
+        path = _project_path(project['sha256'])
+        with file_lock(_lock_path(project['sha256']), blocking=False) as acquired:
+            if not acquired:
+                continue
+            # 先删除元数据，使项目在删除过程中被视为不存在
+            try:
+                os.remove(os.path.join(path, _META_FILE))
+            except OSError:
+                pass
+            shutil.rmtree(path, ignore_errors=True)
+        total -= project['size_bytes']
+        logger.info("Ghidra Service: 超出配额，已淘汰项目 %s (%s bytes)", project['sha256'], project['size_bytes'])
+
+
+def _run_headless(args, env):
+    cmd = [GHIDRA_PATH] + args
+    logger.info("调用Ghidra命令: %s", ' '.join(cmd))
+    mode = 'import' if '-import' in args else 'process'
+    started = time.time()
+    try:
+        result = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=GHIDRA_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        metrics.GHIDRA_RUN_SECONDS.observe(time.time() - started, mode=mode, outcome='timeout')
+        raise
+    logger.debug("Ghidra stdout: %s", truncate(result.stdout))
+    logger.debug("Ghidra stderr: %s", truncate(result.stderr))
+    outcome = 'ok' if result.returncode == 0 else 'error'
+    metrics.GHIDRA_RUN_SECONDS.observe(time.time() - started, mode=mode, outcome=outcome)
+    if result.returncode != 0:
+        raise GhidraError('Ghidra分析失败', result.stderr)
+    return result
+
+
+def run_script(file_path: str, script_path: str, env_overrides: dict = None, sha256: str = None,
+               heap_mb: int = None, max_cpu: int = None):
+    """
+    在二进制文件对应的持久化项目上运行 Ghidra 脚本。
+
+    项目不存在时导入并自动分析（一次性开销），之后以 -process -noanalysis 复用。
+
+    Args:
+        file_path: 二进制文件路径。
+        script_path: 要执行的 Ghidra 脚本路径。
+        env_overrides: 传递给脚本的环境变量（如 OUTPUT_FILE）。
+        sha256: 已知的文件哈希（可选）。
+        heap_mb: JVM 最大堆内存（MB，可选），通过 _JAVA_OPTIONS 覆盖 analyzeHeadless 的默认值。
+        max_cpu: 自动分析可使用的最大 CPU 核数（可选，对应 -max-cpu）。
+
+    Returns:
+        bool: 本次是否复用了已存在的项目。
+
+    Raises:
+        GhidraError: Ghidra 执行失败。
+    """
+    sha256 = sha256 or triage_service.compute_sha256(file_path)
+    project_path = _project_path(sha256)
+    env = os.environ.copy()
+    env.update(env_overrides or {})
+    if heap_mb:
+        env['_JAVA_OPTIONS'] = f"{env.get('_JAVA_OPTIONS', '')} -Xmx{int(heap_mb)}m".strip()
+    extra_args = ['-max-cpu', str(int(max_cpu))] if max_cpu else []
+
+    with file_lock(_lock_path(sha256)):
+        meta = _read_meta(project_path)
+        reused = meta is not None
+        if reused:
+            args = [project_path, PROJECT_NAME, '-process', meta['program'],
+                    '-noanalysis', '-readOnly', '-postScript', script_path]
+            _run_headless(args + extra_args, env)
+        else:
+            # 清理上次失败导入残留的项目文件（项目目录可能刚被配额淘汰）
+            os.makedirs(project_path, exist_ok=True)
+            for name in os.listdir(project_path):
+                target = os.path.join(project_path, name)
+                shutil.rmtree(target) if os.path.isdir(target) else os.remove(target)
+            args = [project_path, PROJECT_NAME, '-import', file_path, '-postScript', script_path]
+            _run_headless(args + extra_args, env)
+            meta = {"program": os.path.basename(file_path), "created": time.time()}
+        meta['last_used'] = time.time()
+        _write_meta(project_path, meta)
+
+    if not reused:
+        enforce_quota(keep=sha256)
+    return reused
+
+
+def run_analysis(file_path: str, output_json: str, previous_analysis: str = None,
+                 heap_mb: int = None, max_cpu: int = None, sha256: str = None) -> dict:
+    """
+    调用 Ghidra headless 分析二进制文件并返回导出的分析结果。
+
+    Args:
+        file_path: 二进制文件路径。
+        output_json: 分析结果输出路径。
+        previous_analysis: 旧版本的分析结果路径（可选），未变化的函数将复用其反编译结果。
+        heap_mb: JVM 最大堆内存（MB，可选）。
+        max_cpu: 自动分析可使用的最大 CPU 核数（可选）。
+        sha256: 已知的文件哈希（可选）。
+
+    Returns:
+        dict: combined_export.py 导出的分析结果。
+
+    Raises:
+        GhidraError: Ghidra 执行失败或未生成结果。
+    """
+    env = {'OUTPUT_FILE': output_json}
+    if previous_analysis:
+        env['PREVIOUS_ANALYSIS'] = previous_analysis
+    logger.debug("环境变量OUTPUT_FILE: %s", output_json)
+    started = time.time()
+    run_script(file_path, SCRIPT_PATH, env, sha256=sha256, heap_mb=heap_mb, max_cpu=max_cpu)
+    # 同名的旧结果文件不算本次生成的结果
+    if not os.path.exists(output_json) or os.path.getmtime(output_json) < started - 1:
+        raise GhidraError('Ghidra未生成分析结果')
+    with open(output_json, 'r', encoding='utf-8') as f:
+        return json.load(f)
@@ -1,51 +1,72 @@
-import json
+import base64
 import os
-import glob
 import uuid
 from datetime import datetime
 import logging
 from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
 
-# 配置日志
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from . import blob_store, history_store, search_index, state_backend
+from .history_store import validate_conversation_id
+from ..logging_setup import truncate
 
-# 根目录下创建模型子目录
-HISTORY_DIR = os.path.join(os.path.dirname(__file__), '..', '..' ,'history')
-if not os.path.exists(HISTORY_DIR):
+logger = logging.getLogger(__name__)
+
+# 实际读写由 history_store 中的存储对象完成（HISTORY_BACKEND=file|sqlite），本模块负责校验、规范化与版本号
+
+# 分页接口单页的最大条数
+MAX_PAGE_SIZE = 200
+
+def _store():
+    return history_store.get_store()
+
+def _new_metadata(conversation_id: str, model: str) -> dict:
+    """对话缺失或内容无效时重建用的元数据"""
+    return {
+        "creation_time": datetime.utcnow().isoformat() + 'Z',
+        "model": model,
+        "conversation_id": conversation_id,
+        "dify_conversation_id": None
+    }
+
+# --- 版本号 ---
+# 每次写入或删除对话时递增该对话及所属模型对话列表的计数器（保存在 state_backend，worker 间共享），
+# 路由据此生成 ETag，判断客户端缓存是否仍然有效时无需读取历史记录。
+
+def _version_key(model: str, conversation_id: str = None) -> str:
+    return f"hv:{model}" if conversation_id is None else f"hv:{model}/{conversation_id}"
+
+def _bump_version(model: str, conversation_id: str):
     try:
-        os.makedirs(HISTORY_DIR)
-        print(f"Created history directory: {HISTORY_DIR}")
-    except OSError as e:
-        print(f"Error creating history directory {HISTORY_DIR}: {e}")
+        backend = state_backend.get_backend()
+        backend.incr(_version_key(model, conversation_id))
+        backend.incr(_version_key(model))
+    except Exception as e:
+        logger.error("History Service Error: 更新版本号失败 %s/%s: %s", model, conversation_id, e)
 
-# 为每个模型创建子目录
-def ensure_model_directory(model):
-    """确保模型的历史目录存在"""
-    model_dir = os.path.join(HISTORY_DIR, model)
-    if not os.path.exists(model_dir):
-        try:
-            os.makedirs(model_dir)
-            print(f"Created history directory for model {model}: {model_dir}")
-        except OSError as e:
-            print(f"Error creating history directory for model {model}: {e}")
-    return model_dir
-
-# 确保默认模型目录存在
-model_ids = [f'dify{i}' for i in range(1, 11)] # 生成 dify1 到 dify10
-for model in model_ids:
-    ensure_model_directory(model)
-
-# --- Internal Helper --- 
-def _get_history_filepath(conversation_id: str, model: str = 'dify1') -> str:
-    """Returns the full path for a conversation's history file."""
-    # Basic validation/sanitization (prevent path traversal)
-    if not conversation_id or '..' in conversation_id or '/' in conversation_id or '\\' in conversation_id:
-        raise ValueError("Invalid conversation ID format.")
-    
-    # 获取模型目录
-    model_dir = ensure_model_directory(model)
-    return os.path.join(model_dir, f"{conversation_id}.json")
+# --- 全文索引 ---
+# 保存、重命名、删除后同步更新 search_index；索引失败只记录日志，不影响历史记录本身（可用 reindex_history.py 重建）
+
+def _update_search_index(action: str, model: str, conversation_id: str, *args):
+    try:
+        index = search_index.get_index()
+        if index is not None:
+            getattr(index, action)(model, conversation_id, *args)
+    except Exception as e:
+        logger.error("History Service Error: 更新搜索索引失败 %s/%s: %s", model, conversation_id, e)
+
+def get_etag(model: str, conversation_id: str = None):
+    """
+    对话（未指定 conversation_id 时为模型的对话列表）当前版本的 ETag 值（不含引号），只查询计数器。
+    计数器不可用时返回 None（不使用条件请求）。绕过本模块直接修改历史记录不会改变 ETag。
+    """
+    try:
+        backend = state_backend.get_backend()
+        scope = 'list' if conversation_id is None else 'conv'
+        return f"{backend.epoch}-{scope}-{backend.get_counter(_version_key(model, conversation_id))}"
+    except Exception as e:
+        logger.error("History Service Error: 读取版本号失败 %s/%s: %s", model, conversation_id, e)
+        return None
 
 def _extract_conversation_name(history):
     """从历史记录中提取对话名称，优先使用第一条用户消息，跳过元数据"""
@@ -89,32 +110,14 @@ def create_new_conversation(model: str = 'dify1') -> str:
         str: 新创建的对话ID
     """
     try:
-        # 首先确保模型目录存在
-        model_dir = ensure_model_directory(model)
-        if not os.path.exists(model_dir):
-            print(f"目录创建失败，尝试再次创建: {model_dir}")
-            try:
-                os.makedirs(model_dir, exist_ok=True)
-            except Exception as mkdir_error:
-                raise IOError(f"无法创建模型目录 {model_dir}: {mkdir_error}") 
-                
-        # 检查目录是否可写
-        if not os.access(model_dir, os.W_OK):
-            raise IOError(f"模型目录 {model_dir} 没有写入权限")
-                
+        store = _store()
         # 生成基于日期的对话ID
         date_str = datetime.now().strftime("%Y%m%d")
-        # 获取当天已有的对话数量，用于生成序号
-        existing_files = glob.glob(os.path.join(model_dir, f"{date_str}*.json"))
-        
-        # 创建序号后缀
-        suffix = len(existing_files) + 1
+        # 原子地分配当天的序号（多个 worker 同时创建也不会重复）
+        suffix = store.next_sequence(model, date_str)
         # 生成最终的对话ID
         conversation_id = f"{date_str}_{suffix}_{uuid.uuid4().hex[:8]}"
         
-        # 创建空的历史记录文件
-        filepath = _get_history_filepath(conversation_id, model)
-        
         # 添加元数据
         metadata = {
             "creation_time": datetime.utcnow().isoformat() + 'Z',
@@ -124,27 +127,23 @@ def create_new_conversation(model: str = 'dify1') -> str:
             "custom_name": "聊天助手" # 默认对话名称
         }
         
-        # 创建包含元数据的空历史记录
-        try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump([metadata], f, ensure_ascii=False, indent=2)
-            print(f"History Service: 成功创建新对话，ID: {conversation_id}，文件: {filepath}")
-        except IOError as file_error:
-            raise IOError(f"写入对话文件失败 {filepath}: {file_error}")
-        
+        # 创建只包含元数据的对话
+        store.create(model, conversation_id, metadata)
+        _bump_version(model, conversation_id)
+        logger.info("History Service: 成功创建新对话，ID: %s（模型: %s）", conversation_id, model)
         return conversation_id
     
     except Exception as e:
-        print(f"History Service Error: 创建新对话失败: {e}")
+        logger.error("History Service Error: 创建新对话失败: %s", e)
         # 如果创建失败，返回基于UUID的备用ID
         fallback_id = f"new_{uuid.uuid4().hex}"
-        print(f"History Service: 使用备用ID: {fallback_id}")
+        logger.warning("History Service: 使用备用ID: %s", fallback_id)
         return fallback_id
 
 def save_message(conversation_id: str, message: dict, model: str = 'dify1'):
     """
-    Appends a message to the conversation's history file (identified by date-based ID).
-    Creates the file if it doesn't exist (should normally exist).
+    Appends a message to the conversation's history (identified by date-based ID).
+    Creates the conversation if it doesn't exist (should normally exist).
 
     Args:
         conversation_id: The date-based ID of the conversation.
@@ -153,7 +152,7 @@ def save_message(conversation_id: str, message: dict, model: str = 'dify1'):
     """
     # 确保消息格式正确 - 支持'sender'或'role'作为消息发送者标识
     if not isinstance(message, dict):
-        print(f"History Service Error: 消息不是字典格式，无法保存 - {message}")
+        logger.error("History Service Error: 消息不是字典格式，无法保存 - %s", truncate(message))
         return False
     
     # 处理前端可能使用 role 字段来标识发送者 (如 'user', 'assistant') 的情况
@@ -163,11 +162,11 @@ def save_message(conversation_id: str, message: dict, model: str = 'dify1'):
     
     # 确保必要字段存在
     if 'sender' not in message:
-        print(f"History Service Error: 消息缺少 sender 字段，无法保存 - {message}")
+        logger.error("History Service Error: 消息缺少 sender 字段，无法保存 - %s", truncate(message))
         return False
     
     if 'text' not in message:
-        print(f"History Service Error: 消息缺少 text 字段，无法保存 - {message}")
+        logger.error("History Service Error: 消息缺少 text 字段，无法保存 - %s", truncate(message))
         return False
         
     # 添加 timestamp 到消息，如果消息中已有，则保留原有的
@@ -183,267 +182,385 @@ def save_message(conversation_id: str, message: dict, model: str = 'dify1'):
         del message_with_timestamp['isError']
 
     try:
-        filepath = _get_history_filepath(conversation_id, model)
-        history = []
-        
-        # 读取现有历史记录
-        if os.path.exists(filepath):
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    history = json.load(f)
-                    if not isinstance(history, list):
-                        print(f"Warning: History file {filepath} is not a list. Overwriting with metadata + new message.")
-                        # 创建包含元数据的列表，如果文件内容无效
-                        metadata = {
-                            "creation_time": datetime.utcnow().isoformat() + 'Z',
-                            "model": model,
-                            "conversation_id": conversation_id,
-                            "dify_conversation_id": None 
-                        }
-                        history = [metadata]
-            except json.JSONDecodeError:
-                print(f"Warning: Could not decode JSON from {filepath}. Overwriting with metadata + new message.")
-                metadata = {
-                    "creation_time": datetime.utcnow().isoformat() + 'Z',
-                    "model": model,
-                    "conversation_id": conversation_id,
-                    "dify_conversation_id": None 
-                }
-                history = [metadata]
-            except Exception as read_err:
-                 print(f"Error reading history file {filepath}, cannot append: {read_err}")
-                 return False
+        validate_conversation_id(conversation_id)
+        # 跳过重复消息（存储返回 None，否则返回消息序号）
+        seq = _store().append_message(model, conversation_id, message_with_timestamp,
+                                      _new_metadata(conversation_id, model))
+        if seq is not None:
+            _bump_version(model, conversation_id)
+            _update_search_index('index_message', model, conversation_id, seq, message_with_timestamp)
+            logger.debug("History Service: 成功保存消息到对话 %s (模型: %s)", conversation_id, model)
         else:
-            print(f"Warning: History file {filepath} not found. Creating new file with metadata.")
-            metadata = {
-                "creation_time": datetime.utcnow().isoformat() + 'Z',
-                "model": model,
-                "conversation_id": conversation_id,
-                "dify_conversation_id": None 
-            }
-            history = [metadata]
-
-        # 跳过重复消息
-        is_duplicate = False
-        for existing_msg in history:
-            if (isinstance(existing_msg, dict) and
-                existing_msg.get('sender') == message_with_timestamp.get('sender') and
-                existing_msg.get('text') == message_with_timestamp.get('text')):
-                print(f"History Service: Skipping duplicate message for {conversation_id}")
-                is_duplicate = True
-                break
-                
-        if not is_duplicate:
-            # 追加新消息
-            history.append(message_with_timestamp)
-            
-            # 写回文件
-            try:
-                # 确保目录存在 (以防万一)
-                model_dir = os.path.dirname(filepath)
-                if not os.path.exists(model_dir):
-                    os.makedirs(model_dir)
-                    
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    json.dump(history, f, ensure_ascii=False, indent=2)
-                print(f"History Service: 成功保存消息到对话 {conversation_id} (模型: {model})")
-                return True
-            except OSError as write_err:
-                 print(f"History Service Error: 无法写入文件 {filepath}. {write_err}")
-                 return False
-
-    except ValueError as e: # 来自 _get_history_filepath
-        print(f"History Service Error: {e}")
+            logger.debug("History Service: Skipping duplicate message for %s", conversation_id)
+        return True
+    except ValueError as e: # 来自 validate_conversation_id
+        logger.error("History Service Error: %s", e)
+        return False
+    except OSError as write_err:
+        logger.error("History Service Error: 无法写入对话 %s. %s", conversation_id, write_err)
         return False
     except Exception as e:
-        print(f"History Service Error: 保存消息时发生意外错误: {e}")
+        logger.error("History Service Error: 保存消息时发生意外错误: %s", e)
         return False
-        
-    return True
 
 def update_dify_conversation_id(local_id: str, dify_id: str, model: str = 'dify1'):
-    """更新本地历史文件，记录 Dify 返回的真实会话 ID"""
+    """更新本地历史记录，记录 Dify 返回的真实会话 ID"""
     if not local_id or not dify_id:
-        print("Update Dify ID Error: Missing local_id or dify_id")
+        logger.error("Update Dify ID Error: Missing local_id or dify_id")
         return
         
     try:
-        filepath = _get_history_filepath(local_id, model)
-        if not os.path.exists(filepath):
-            print(f"Update Dify ID Warning: File not found {filepath}, cannot update.")
-            # 如果文件不存在，可能意味着初始创建失败，或者已经被意外删除
-            # 此时无法更新 Dify ID，后续保存消息可能会重建文件（不含Dify ID）
+        validate_conversation_id(local_id)
+        store = _store()
+        if not store.exists(model, local_id):
+            logger.warning("Update Dify ID Warning: Conversation %s not found, cannot update.", local_id)
+            # 如果对话不存在，可能意味着初始创建失败，或者已经被意外删除
+            # 此时无法更新 Dify ID，后续保存消息可能会重建对话（不含Dify ID）
             return
 
-        history = []
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-            if not isinstance(history, list) or not history:
-                print(f"Update Dify ID Warning: File {filepath} is empty or not a list. Cannot update Dify ID.")
-                return 
-        except Exception as read_err:
-            print(f"Update Dify ID Error: Failed to read file {filepath}: {read_err}")
+        # 如果没有找到元数据条目（理论上不应该，除非文件被手动修改），放弃更新
+        if not store.update_metadata(model, local_id, {'dify_conversation_id': dify_id}, op='update_dify_id'):
+            logger.warning("Update Dify ID Warning: Metadata entry not found in %s. Cannot set Dify ID.", local_id)
             return
+        _bump_version(model, local_id)
+        logger.debug("History Service: Updated Dify ID in %s to %s", local_id, dify_id)
 
-        # 查找或创建元数据条目来更新 Dify ID
-        metadata_updated = False
-        for item in history:
-            if isinstance(item, dict) and 'creation_time' in item and 'conversation_id' in item:
-                item['dify_conversation_id'] = dify_id
-                metadata_updated = True
-                break # 假设只有一个元数据条目
-        
-        # 如果没有找到元数据条目（理论上不应该，除非文件被手动修改）
-        # 可以选择插入一个新的元数据条目，或者放弃更新
-        if not metadata_updated:
-            print(f"Update Dify ID Warning: Metadata entry not found in {filepath}. Cannot set Dify ID.")
-            # 为了健壮性，可以考虑添加一个元数据条目，但这可能不符合预期
-            # metadata_entry = {"dify_conversation_id": dify_id}
-            # history.insert(0, metadata_entry) # 插入到开头
-            return # 暂时选择不更新
-
-        # 写回更新后的历史记录
-        try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-            print(f"History Service: Updated Dify ID in {local_id} to {dify_id}")
-        except OSError as write_err:
-            print(f"Update Dify ID Error: Failed to write updated file {filepath}: {write_err}")
-
-    except ValueError as e: # 来自 _get_history_filepath
-        print(f"Update Dify ID Error: {e}")
+    except ValueError as e: # 来自 validate_conversation_id
+        logger.error("Update Dify ID Error: %s", e)
+    except Exception as e:
+        logger.error("Update Dify ID Error: Unexpected error: %s", e)
+
+def get_conversation_metadata(conversation_id: str, model: str = 'dify1'):
+    """返回对话的元数据（历史记录的第一个元素），对话不存在或无元数据时返回 None"""
+    try:
+        validate_conversation_id(conversation_id)
+    except ValueError as e:
+        logger.error("History Service Error: %s", e)
+        return None
+    try:
+        return _store().get_metadata(model, conversation_id)
     except Exception as e:
-        print(f"Update Dify ID Error: Unexpected error: {e}")
+        logger.error("History Service Error: Could not read metadata of %s: %s", conversation_id, e)
+        return None
+
+def set_conversation_endpoint(conversation_id: str, endpoint_id: str, model: str = 'dify1') -> bool:
+    """
+    将对话绑定到指定的 Dify 端点。改绑到其他端点时清空原有的 Dify 对话 ID
+    （该 ID 只在原端点有效）。
+    """
+    try:
+        validate_conversation_id(conversation_id)
+        store = _store()
+        metadata = store.get_metadata(model, conversation_id)
+        if metadata is None:
+            if store.exists(model, conversation_id):
+                logger.warning("Set Endpoint Warning: Metadata entry not found in %s.", conversation_id)
+            return False
+
+        if metadata.get('dify_endpoint') == endpoint_id:
+            return True
+        updates = {'dify_endpoint': endpoint_id}
+        if metadata.get('dify_endpoint'):
+            updates['dify_conversation_id'] = None
+        if not store.update_metadata(model, conversation_id, updates, op='set_endpoint'):
+            return False
+        _bump_version(model, conversation_id)
+        logger.info("History Service: 对话 %s 绑定到端点 %s", conversation_id, endpoint_id)
+        return True
+    except ValueError as e:
+        logger.error("Set Endpoint Error: %s", e)
+        return False
+    except Exception as e:
+        logger.error("Set Endpoint Error: Unexpected error: %s", e)
+        return False
 
 def rename_conversation_name(conversation_id: str, new_name: str, model: str = 'dify1'):
-    """更新存储在历史文件元数据中的对话名称"""
+    """更新存储在对话元数据中的对话名称"""
     if not conversation_id or not new_name:
-        print("Rename Name Error: Missing conversation_id or new_name")
+        logger.error("Rename Name Error: Missing conversation_id or new_name")
         return False
     
     new_name = new_name.strip()
     if not new_name: # 不允许空名称
-        print("Rename Name Error: New name cannot be empty after stripping whitespace")
+        logger.error("Rename Name Error: New name cannot be empty after stripping whitespace")
         return False
         
     try:
-        filepath = _get_history_filepath(conversation_id, model)
-        if not os.path.exists(filepath):
-            print(f"Rename Name Error: File not found {filepath}")
+        validate_conversation_id(conversation_id)
+        store = _store()
+        if not store.exists(model, conversation_id):
+            logger.error("Rename Name Error: Conversation %s not found", conversation_id)
             return False
 
-        history = []
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-            if not isinstance(history, list) or not history:
-                print(f"Rename Name Error: File {filepath} is empty or not a list.")
-                return False 
-        except Exception as read_err:
-            print(f"Rename Name Error: Failed to read file {filepath}: {read_err}")
+        # 更新元数据中的 custom_name；没有元数据是异常情况，不应该发生
+        if not store.update_metadata(model, conversation_id, {'custom_name': new_name}, op='rename'):
+            logger.error("Rename Name Error: Metadata entry not found in %s. Cannot set custom name.", conversation_id)
             return False
+        _bump_version(model, conversation_id)
+        _update_search_index('set_name', model, conversation_id, new_name)
+        logger.info("History Service: Updated custom name in %s to '%s'", conversation_id, new_name)
+        return True
 
-        # 查找元数据条目并更新 custom_name
-        metadata_updated = False
-        for item in history:
-            if isinstance(item, dict) and 'creation_time' in item and 'conversation_id' in item:
-                item['custom_name'] = new_name # 添加或更新自定义名称字段
-                metadata_updated = True
-                break 
-        
-        if not metadata_updated:
-            print(f"Rename Name Error: Metadata entry not found in {filepath}. Cannot set custom name.")
-            # 如果没有元数据，这是一个异常情况，不应该发生
-            return False
-
-        # 写回更新后的历史记录
-        try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-            print(f"History Service: Updated custom name in {conversation_id} to '{new_name}'")
-            return True
-        except OSError as write_err:
-            print(f"Rename Name Error: Failed to write updated file {filepath}: {write_err}")
-            return False
-
-    except ValueError as e: # 来自 _get_history_filepath
-        print(f"Rename Name Error: Invalid ID format. {e}")
+    except ValueError as e: # 来自 validate_conversation_id
+        logger.error("Rename Name Error: Invalid ID format. %s", e)
         return False
     except Exception as e:
-        print(f"Rename Name Error: Unexpected error: {e}")
+        logger.error("Rename Name Error: Unexpected error: %s", e)
         return False
 
 def get_messages(conversation_id: str, model: str = 'dify1') -> list:
     """Reads and returns the list of messages for a conversation, excluding metadata."""
     try:
-        filepath = _get_history_filepath(conversation_id, model)
-        if os.path.exists(filepath):
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    history = json.load(f)
-                    if not isinstance(history, list):
-                        return [] # Or raise error?
-                        
-                    # 过滤掉元数据条目
-                    actual_messages = [msg for msg in history 
-                                       if not (isinstance(msg, dict) and 
-                                               ('creation_time' in msg or 'dify_conversation_id' in msg))]
-                    return actual_messages
-                    
-            except (json.JSONDecodeError, Exception) as e:
-                print(f"History Service Error: Could not read or parse {filepath}: {e}")
-                return [] # Return empty list on error
-        else:
-            return [] # No history found
+        validate_conversation_id(conversation_id)
+        messages = _store().get_messages(model, conversation_id)
+        return messages if messages is not None else [] # No history found
     except ValueError as e:
-         print(f"History Service Error: {e}")
-         return []
+        logger.error("History Service Error: %s", e)
+        return []
+    except Exception as e:
+        logger.error("History Service Error: Could not read or parse %s: %s", conversation_id, e)
+        return [] # Return empty list on error
+
+def _conversation_summary(timestamp: int, conv_id: str, name, model: str) -> dict:
+    return {
+        "id": conv_id,
+        "name": name or "聊天助手", # 没有自定义名称时使用默认名称
+        "timestamp": timestamp,
+        "model": model
+    }
 
 def list_conversations(model: str = 'dify1') -> list:
-    """Lists available conversations based on history files for a specific model."""
-    conversations = []
+    """Lists available conversations for a specific model, most recently active first."""
     try:
-        model_dir = ensure_model_directory(model)
-        history_files = glob.glob(os.path.join(model_dir, '*.json'))
-        
-        for filepath in history_files:
-            try:
-                conv_id = os.path.splitext(os.path.basename(filepath))[0]
-                mtime = os.path.getmtime(filepath)
-                
-                conv_name = "聊天助手" # 默认名称
-                
-                # 尝试读取文件以获取自定义名称
-                try:
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        history = json.load(f)
-                        if history and isinstance(history[0], dict):
-                            custom_name = history[0].get('custom_name')
-                            if custom_name:
-                                conv_name = custom_name # 使用自定义名称
-                except Exception as read_err:
-                    print(f"Warning: Could not read file {filepath} to get custom name: {read_err}")
-                
-                conversations.append({
-                    "id": conv_id, 
-                    "name": conv_name,
-                    "timestamp": int(mtime * 1000),
-                    "model": model
-                })
-            except Exception as e:
-                print(f"History Service: Error processing file {filepath}: {e}")
-                continue 
-        
-        conversations.sort(key=lambda x: x['timestamp'], reverse=True)
-        
+        return [_conversation_summary(timestamp, conv_id, name, model)
+                for timestamp, conv_id, name in _store().list_conversations(model)]
     except Exception as e:
-        print(f"History Service Error: Could not list conversations for model {model}: {e}")
+        logger.error("History Service Error: Could not list conversations for model %s: %s", model, e)
+        return []
 
-    return conversations
+def _encode_cursor(timestamp: int, conv_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp}:{conv_id}".encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, conv_id = raw.split(':', 1)
+        return int(timestamp), conv_id
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("无效的分页游标")
+
+def list_conversations_page(model: str = 'dify1', limit: int = 50, cursor: str = None) -> dict:
+    """
+    按最后活动时间倒序分页列出对话。cursor 为上一页返回的 next_cursor（不透明字符串），
+    按 (时间戳, 对话ID) 定位，翻页期间新建或删除对话不会导致重复或跳过其余对话。
+
+    Returns:
+        dict: {"conversations": [...], "next_cursor": str 或 None（没有更多）}
+
+    Raises:
+        ValueError: 游标无效。
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    before = _decode_cursor(cursor) if cursor else None
+    # 多取一条，用于判断是否还有下一页
+    rows = _store().list_conversations(model, limit=limit + 1, before=before)
+    page = rows[:limit]
+    return {
+        "conversations": [_conversation_summary(timestamp, conv_id, name, model)
+                          for timestamp, conv_id, name in page],
+        "next_cursor": _encode_cursor(page[-1][0], page[-1][1]) if len(rows) > limit else None,
+    }
+
+def get_messages_page(conversation_id: str, model: str = 'dify1', after=None, limit: int = None):
+    """
+    增量读取消息：返回位置在 after 之后的最多 limit 条消息（不含元数据）。
+    after 可以是消息序号（int，从 0 开始，与 get_messages 返回列表的下标一致）或消息 id（str），
+    为 None 时从第一条开始。文件存储借助消息偏移索引、SQLite 存储借助序号索引，只读取所需的消息。
+
+    Returns:
+        dict: {"messages": [...], "total": 消息总数, "next_after": 最后一条返回消息的序号,
+               "has_more": 是否还有更多}；对话不存在时返回 None。
+
+    Raises:
+        ValueError: 对话 ID 格式无效，或 after 指定的消息 id 不存在。
+    """
+    validate_conversation_id(conversation_id)
+    limit = MAX_PAGE_SIZE if limit is None else max(1, min(int(limit), MAX_PAGE_SIZE))
+    return _store().get_messages_page(model, conversation_id, after, limit)
+
+def search_history(query: str, model: str = None, limit: int = 20, offset: int = 0, sort: str = 'relevance'):
+    """
+    全文检索所有模型（或指定模型）的对话消息与名称，参数与结果格式见 search_index.SearchIndex.search。
+    全文索引关闭时返回 None；查询为空或参数无效时抛出 ValueError。
+    """
+    index = search_index.get_index()
+    if index is None:
+        return None
+    return index.search(query, model=model, limit=limit, offset=offset, sort=sort, store=_store())
+
+# --- 批量导出 / 导入 ---
+# 记录格式与编解码见 history_transfer；导出逐个读取对话，导入按批写入，内存占用与总量无关
+
+# 每批导入的对话数：SQLite 存储每批一个事务，搜索索引每批更新一次
+IMPORT_BATCH_SIZE = int(os.getenv('HISTORY_IMPORT_BATCH', '100'))
+# 导入结果中最多附带的错误描述条数
+MAX_IMPORT_ERRORS = 20
+
+def _validate_model(model):
+    """模型名会用作目录名，规则与对话 ID 相同"""
+    if not isinstance(model, str) or not model or '..' in model or '/' in model or '\\' in model:
+        raise ValueError("Invalid model name.")
+
+def _parse_date(value):
+    """YYYYMMDD 或 YYYY-MM-DD 转为 YYYYMMDD，未指定时返回 None"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value.replace('-', ''), '%Y%m%d').strftime('%Y%m%d')
+    except ValueError:
+        raise ValueError(f"无效的日期: {value}（应为 YYYYMMDD 或 YYYY-MM-DD）")
+
+def export_conversations(model: str = 'dify1', since: str = None, until: str = None, conversation_ids=None):
+    """
+    返回逐个读取对话的记录迭代器，用于流式导出（已归档的对话直接解压读取，不还原）。
+    参数在调用时立即校验，无效时抛出 ValueError；对话在迭代时才读取，读取失败的对话记录日志后跳过。
+
+    Args:
+        model: 模型名称
+        since / until: 按对话 ID 中的创建日期筛选（包含两端），YYYYMMDD 或 YYYY-MM-DD
+        conversation_ids: 只导出这些对话（不存在的跳过）
+    """
+    _validate_model(model)
+    since, until = _parse_date(since), _parse_date(until)
+    for conversation_id in conversation_ids or ():
+        validate_conversation_id(conversation_id)
+    return _iter_export(model, since, until, conversation_ids)
+
+def _iter_export(model, since, until, conversation_ids):
+    store = _store()
+    for conversation_id in conversation_ids or store.conversation_ids(model):
+        if since or until:
+            day = conversation_id[:8]
+            if not day.isdigit() or (since and day < since) or (until and day > until):
+                continue
+        try:
+            data = store.export_conversation(model, conversation_id)
+        except Exception as e:
+            logger.error("History Service Error: 导出对话 %s/%s 失败: %s", model, conversation_id, e)
+            continue
+        if data is None:
+            continue
+        yield {
+            "model": model,
+            "conversation_id": conversation_id,
+            "metadata": data["metadata"],
+            "messages": data["messages"],
+            "updated_at": data["timestamp"],
+        }
+
+def _normalize_import(record, model):
+    """校验一条导入记录，返回 (model, conversation_id, metadata, messages, timestamp)；无效时抛出 ValueError"""
+    if isinstance(record, ValueError): # 解码失败
+        raise record
+    if not isinstance(record, dict):
+        raise ValueError("record must be a JSON object")
+    model = model or record.get('model')
+    _validate_model(model)
+    conversation_id = record.get('conversation_id')
+    if not isinstance(conversation_id, str):
+        raise ValueError("missing conversation_id")
+    validate_conversation_id(conversation_id)
+    messages = record.get('messages') or []
+    if not isinstance(messages, list) or not all(isinstance(message, dict) for message in messages):
+        raise ValueError("messages must be a list of objects")
+    metadata = record.get('metadata')
+    if metadata is None:
+        metadata = _new_metadata(conversation_id, model)
+    elif not isinstance(metadata, dict):
+        raise ValueError("metadata must be an object")
+    else:
+        # 导入到其他模型时元数据随之更新；缺少 creation_time 的元数据在文件存储中会被当作消息
+        metadata = {"creation_time": datetime.utcnow().isoformat() + 'Z', **metadata,
+                    "model": model, "conversation_id": conversation_id}
+    timestamp = record.get('updated_at')
+    if timestamp is not None and (type(timestamp) is not int or timestamp < 0):
+        raise ValueError("updated_at must be a millisecond timestamp")
+    return model, conversation_id, metadata, messages, timestamp
+
+def import_conversations(entries, model: str = None, overwrite: bool = False, batch_size: int = None) -> dict:
+    """
+    批量导入 history_transfer.decode 产出的 (位置, 记录)。
+
+    每 batch_size 个对话写入一次存储（SQLite 存储为一个事务），随后更新版本号与搜索索引。
+    同一次导入中重复出现的对话 ID 只保留第一条；目标中已存在的对话默认跳过，overwrite=True 时覆盖。
+    无效记录计入 invalid 后继续；数据流中途损坏时，之前读取的对话照常写入。
+
+    Args:
+        model: 导入到指定模型（默认使用各记录中的 model）
+
+    Returns:
+        dict: {"imported", "messages", "skipped", "duplicates", "invalid", "failed",
+               "truncated"（数据流是否中途损坏）, "errors"（前 MAX_IMPORT_ERRORS 条错误描述）}
+    """
+    stats = {"imported": 0, "messages": 0, "skipped": 0, "duplicates": 0, "invalid": 0, "failed": 0,
+             "truncated": False, "errors": []}
+    batch_size = max(1, batch_size or IMPORT_BATCH_SIZE)
+    seen = set()
+    batch = []
+
+    def error(where, e):
+        if len(stats["errors"]) < MAX_IMPORT_ERRORS:
+            stats["errors"].append(f"{where}: {e}")
+
+    def flush(items):
+        try:
+            written = _store().import_conversations(items, overwrite=overwrite)
+        except Exception as e:
+            stats["failed"] += len(items)
+            error(f"batch of {len(items)}", e)
+            logger.error("History Service Error: 批量导入 %s 个对话失败: %s", len(items), e)
+            return
+        imported = [item for item, ok in zip(items, written) if ok]
+        stats["imported"] += len(imported)
+        stats["skipped"] += len(items) - len(imported)
+        stats["messages"] += sum(len(item[3]) for item in imported)
+        for item_model, conversation_id, *_ in imported:
+            _bump_version(item_model, conversation_id)
+        try:
+            index = search_index.get_index()
+            if index is not None and imported:
+                index.index_conversations([(item_model, conversation_id, metadata.get('custom_name'), messages)
+                                           for item_model, conversation_id, metadata, messages, _ in imported])
+        except Exception as e:
+            logger.error("History Service Error: 更新搜索索引失败（%s 个导入的对话）: %s", len(imported), e)
+
+    try:
+        for where, record in entries:
+            try:
+                item = _normalize_import(record, model)
+            except ValueError as e:
+                stats["invalid"] += 1
+                error(where, e)
+                continue
+            if item[:2] in seen:
+                stats["duplicates"] += 1
+                continue
+            seen.add(item[:2])
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+    except Exception as e: # 数据流损坏或中断
+        error("stream", e)
+        logger.error("History Service Error: 导入数据流读取失败: %s", e)
+        stats["truncated"] = True
+    if batch:
+        flush(batch)
+    logger.info("History Service: 导入完成 %s", {key: value for key, value in stats.items() if key != 'errors'})
+    return stats
 
 def delete_conversation(conversation_id: str, model: str = 'dify1') -> bool:
-    """删除指定模型的会话历史记录文件
+    """删除指定模型的会话历史记录
 
     Args:
         conversation_id: 会话ID
@@ -453,20 +570,26 @@ def delete_conversation(conversation_id: str, model: str = 'dify1') -> bool:
         bool: 删除是否成功
     """
     try:
-        filepath = _get_history_filepath(conversation_id, model)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            print(f"History Service: Deleted conversation file: {filepath}")
+        validate_conversation_id(conversation_id)
+        if _store().delete(model, conversation_id):
+            logger.info("History Service: Deleted conversation %s (model: %s)", conversation_id, model)
+            _bump_version(model, conversation_id)
+            _update_search_index('remove_conversation', model, conversation_id)
+            # 释放该对话对上传文件的引用，使其可被垃圾回收
+            try:
+                blob_store.release_owner(f"conversation:{model}/{conversation_id}")
+            except Exception as release_err:
+                logger.warning("History Service Warning: 释放上传文件引用失败: %s", release_err)
             return True
         else:
-            print(f"History Service: Conversation file not found: {filepath}")
+            logger.warning("History Service: Conversation not found: %s (model: %s)", conversation_id, model)
             return False
     except ValueError as e:
-        print(f"History Service Error: {e}")
+        logger.error("History Service Error: %s", e)
         return False
     except OSError as e:
-        print(f"History Service Error: Could not delete file {filepath}. {e}")
+        logger.error("History Service Error: Could not delete conversation %s. %s", conversation_id, e)
         return False
     except Exception as e:
-        print(f"History Service Error: An unexpected error occurred deleting conversation: {e}")
-        return False 
\ No newline at end of file
+        logger.error("History Service Error: An unexpected error occurred deleting conversation: %s", e)
+        return False 
@@ -0,0 +1,1161 @@
+"""
+对话历史的存储实现。
+
+history_service 的公开函数负责参数校验、消息规范化与版本号，实际读写交给这里的存储对象。
+两种实现接口相同：
+
+  FileHistoryStore    每个对话一个 JSON 文件（history/<模型>/<年>/<月>/<对话ID>.json，旁边是消息偏移索引 .idx）。默认
+  SQLiteHistoryStore  所有对话保存在一个 SQLite 数据库（WAL 模式），追加消息只插入一行，
+                      列表与分页走索引，多个 worker 同时写同一个对话不会丢失更新
+
+通过环境变量 HISTORY_BACKEND=file|sqlite 选择，SQLite 数据库路径为 HISTORY_DB_PATH（默认 history/history.db）。
+已有的文件历史可用 backend/migrate_history.py 导入 SQLite（见 migrate）。
+文件存储另有冷存储：长时间未活动的对话被压缩保存，访问时自动解压（见 FileHistoryStore.archive_idle、history_tiering）。
+
+存储接口（model 与 conversation_id 已由调用方校验）：
+  create(model, conversation_id, metadata)
+  exists(model, conversation_id) -> bool
+  get_metadata(model, conversation_id) -> dict | None
+  update_metadata(model, conversation_id, updates, op) -> bool           对话或元数据不存在时返回 False
+  append_message(model, conversation_id, message, metadata) -> int|None  返回消息序号，重复消息返回 None；对话不存在时以 metadata 新建
+  get_messages(model, conversation_id) -> list | None                     不含元数据
+  get_messages_page(model, conversation_id, after, limit) -> dict | None  见 history_service.get_messages_page
+  list_conversations(model, limit=None, before=None) -> [(毫秒时间戳, 对话ID, 自定义名称或 None)]
+  next_sequence(model, day) -> int                                      原子地分配 day（YYYYMMDD）的下一个对话序号（跨进程）
+  delete(model, conversation_id) -> bool
+  models() / conversation_ids(model) / export_conversation(...) / import_conversation(...)   迁移用
+  import_conversations(items, overwrite) -> [bool]                       批量导入，见 history_service.import_conversations
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from . import metrics
+from .locking import file_lock
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 根目录下创建模型子目录
+HISTORY_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'history')
+HISTORY_BACKEND = os.getenv('HISTORY_BACKEND', 'file')
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', os.path.join(HISTORY_DIR, 'history.db'))
+
+# 消息偏移索引文件的后缀（不以 .json 结尾，不会被当作对话文件）
+INDEX_SUFFIX = '.idx'
+# 读取元数据时每次从文件开头读取的字节数（不够时加倍）
+HEAD_READ_SIZE = 8192
+
+# 对话序号的计数文件（每个月目录一个）与锁文件（每个模型一个）；不以 .json 结尾，不会被当作对话文件
+SEQUENCE_FILE = '.sequence'
+SEQUENCE_LOCK = '.sequence.lock'
+
+# 对话读-改-写的文件锁目录（每个模型一个）：按对话 ID 哈希分到固定数量的锁文件，锁文件数量不随对话增长
+CONVERSATION_LOCK_DIR = '.locks'
+CONVERSATION_LOCK_STRIPES = 256
+
+# 冷存储压缩格式对应的文件后缀
+ARCHIVE_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+# 默认创建目录的模型：dify1 到 dify10
+DEFAULT_MODELS = [f'dify{i}' for i in range(1, 11)]
+
+# 逐条序列化历史记录（复用同一个编码器，避免每条消息重新构造）
+_ENCODER = json.JSONEncoder(ensure_ascii=False, indent=2)
+
+
+def validate_conversation_id(conversation_id: str):
+    """对话 ID 会用作文件名，拒绝空值与路径分隔符（防止路径穿越）"""
+    if not conversation_id or '..' in conversation_id or '/' in conversation_id or '\\' in conversation_id:
+        raise ValueError("Invalid conversation ID format.")
+
+
+def _is_metadata_entry(item):
+    """历史文件中的元数据条目（包含 creation_time 或 dify_conversation_id 的字典）"""
+    return isinstance(item, dict) and ('creation_time' in item or 'dify_conversation_id' in item)
+
+
+def _is_duplicate(history, message) -> bool:
+    """发送者与内容都相同的消息视为重复（前端重试时会重复提交）"""
+    return any(isinstance(item, dict) and item.get('sender') == message.get('sender')
+               and item.get('text') == message.get('text') for item in history)
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+# --- 对话 ID ---
+# history_service 生成的对话 ID 为 <YYYYMMDD>_<当天序号>_<随机串>；文件存储按 ID 中的年月分目录，
+# 由 ID 即可直接算出路径。其他格式的 ID（如创建失败时的 new_<uuid>）仍保存在模型目录下。
+
+_DATED_ID = re.compile(r'(\d{4})(\d{2})\d{2}_(\d+)_')
+
+
+def _shard(conversation_id: str):
+    """对话所在的分片目录 (年, 月)，不是日期开头的 ID 返回 None"""
+    match = _DATED_ID.match(conversation_id)
+    return (match.group(1), match.group(2)) if match else None
+
+
+def _sequence_of(conversation_id: str, day: str) -> int:
+    """day 当天创建的对话 ID 中的序号，其他 ID 返回 0"""
+    match = _DATED_ID.match(conversation_id)
+    return int(match.group(3)) if match and conversation_id.startswith(day) else 0
+
+
+def relative_path(model: str, conversation_id: str) -> str:
+    """对话文件相对于历史根目录的路径（以 / 分隔，导出的 tar 使用相同结构）"""
+    return '/'.join((model, *(_shard(conversation_id) or ()), f"{conversation_id}.json"))
+
+
+# --- 文件存储 ---
+
+def _read_history(filepath: str, op: str):
+    """读取并解析历史文件（记录读取耗时与文件大小）"""
+    started = time.perf_counter()
+    with open(filepath, 'r', encoding='utf-8') as f:
+        history = json.load(f)
+        size = os.fstat(f.fileno()).st_size
+    metrics.HISTORY_READ_SECONDS.observe(time.perf_counter() - started, op=op)
+    metrics.HISTORY_FILE_BYTES.observe(size, direction='read')
+    return history
+
+def _write_history(filepath: str, history, op: str):
+    """
+    序列化并写入历史文件（记录写入耗时与文件大小）。先写临时文件再原子替换，读取方不会看到写了一半的文件；
+    同时写出各消息的字节偏移索引（见 _write_index）。输出格式与 json.dump(indent=2) 相同。
+    """
+    started = time.perf_counter()
+    pieces = [b'[']
+    offset = 1
+    entries = []
+    for i, item in enumerate(history):
+        prefix = b'\n  ' if i == 0 else b',\n  '
+        data = _ENCODER.encode(item).replace('\n', '\n  ').encode('utf-8')
+        offset += len(prefix)
+        if not _is_metadata_entry(item):
+            entries.append([offset, offset + len(data), item.get('id') if isinstance(item, dict) else None])
+        pieces.append(prefix)
+        pieces.append(data)
+        offset += len(data)
+    pieces.append(b'\n]' if history else b']')
+
+    temp_file = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        f = open(temp_file, 'wb')
+    except FileNotFoundError:
+        # 新月份的分片目录
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        f = open(temp_file, 'wb')
+    with f:
+        f.writelines(pieces)
+        f.flush()
+        st = os.fstat(f.fileno())
+    os.replace(temp_file, filepath)
+    _write_index(filepath, st, entries)
+    metrics.HISTORY_WRITE_SECONDS.observe(time.perf_counter() - started, op=op)
+    metrics.HISTORY_FILE_BYTES.observe(st.st_size, direction='write')
+
+# --- 消息偏移索引 ---
+# 每个历史文件旁有一个 <对话ID>.idx，记录各条消息在文件中的字节范围与消息 id，
+# 以及写入时文件的大小和修改时间；两者与当前文件一致时索引有效，分页读取只需读取所需的字节范围。
+# 索引缺失或过期（旧版本写入、手工编辑）时扫描一次文件重建。
+
+def _index_path(filepath: str) -> str:
+    return os.path.splitext(filepath)[0] + INDEX_SUFFIX
+
+def _write_index(filepath: str, st, entries):
+    index = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "messages": entries}
+    index_path = _index_path(filepath)
+    temp_file = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_file, index_path)
+    except OSError as e:
+        # 索引只是加速手段，写入失败时下次读取会重建
+        logger.warning("History Service: 写入消息索引失败 %s: %s", index_path, e)
+
+def _load_index(filepath: str, st):
+    """读取与文件状态 st 匹配的索引，缺失或过期时返回 None"""
+    try:
+        with open(_index_path(filepath), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('size') != st.st_size or index.get('mtime_ns') != st.st_mtime_ns:
+        return None
+    return index
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+def _scan_entries(raw: bytes):
+    """
+    扫描整个历史文件，返回顶层数组各元素的 (起始字节, 结束字节, 解析结果)。
+    用于重建索引，只在索引缺失或过期时调用。
+    """
+    text = raw.decode('utf-8')
+    decoder = json.JSONDecoder()
+    pos = _WHITESPACE.match(text, 0).end()
+    if text[pos:pos + 1] != '[':
+        raise ValueError("history file is not a JSON array")
+    pos = _WHITESPACE.match(text, pos + 1).end()
+    items = []
+    if text[pos:pos + 1] == ']':
+        return items
+    byte_pos, char_pos = 0, 0
+    while True:
+        value, end = decoder.raw_decode(text, pos)
+        # 字符位置换算为字节位置（增量编码，整体 O(n)）
+        byte_pos += len(text[char_pos:pos].encode('utf-8'))
+        start_byte = byte_pos
+        byte_pos += len(text[pos:end].encode('utf-8'))
+        char_pos = end
+        items.append((start_byte, byte_pos, value))
+        pos = _WHITESPACE.match(text, end).end()
+        if text[pos:pos + 1] == ',':
+            pos = _WHITESPACE.match(text, pos + 1).end()
+        elif text[pos:pos + 1] == ']':
+            return items
+        else:
+            raise ValueError(f"unexpected character at {pos} in history file")
+
+def _read_first_entry(filepath: str, op: str):
+    """
+    只解析历史文件的第一个元素（元数据），按需逐步读取文件开头，不读取整个文件（压缩文件只解压开头）。
+    文件为空数组或不是数组时返回 None。
+    """
+    started = time.perf_counter()
+    decoder = json.JSONDecoder()
+    data = b''
+    with _open_history(filepath) as f:
+        read_size = HEAD_READ_SIZE
+        while True:
+            chunk = f.read(read_size)
+            data += chunk
+            # 末尾可能截断在多字节字符中间，忽略即可：截断处之前的内容足以解析时才会成功
+            text = data.decode('utf-8', errors='ignore')
+            pos = _WHITESPACE.match(text, 0).end()
+            if text[pos:pos + 1] not in ('[', ''):
+                entry = None
+                break
+            pos = _WHITESPACE.match(text, pos + 1).end()
+            if text[pos:pos + 1] == ']':
+                entry = None
+                break
+            try:
+                entry, _ = decoder.raw_decode(text, pos)
+                break
+            except ValueError:
+                if not chunk:
+                    raise
+                read_size *= 2
+    metrics.HISTORY_READ_SECONDS.observe(time.perf_counter() - started, op=op)
+    metrics.HISTORY_FILE_BYTES.observe(len(data), direction='read')
+    return entry
+
+# --- 冷存储压缩 ---
+# 归档的对话为 <对话ID>.json 加压缩后缀；zstd 需要安装可选依赖 zstandard，未安装时只能使用 gzip。
+
+def _conversation_id_from_name(name: str):
+    """目录项对应的对话 ID（.json 或归档文件），其他文件返回 None"""
+    if name.endswith('.json'):
+        return name[:-len('.json')]
+    for suffix in ARCHIVE_SUFFIXES.values():
+        if name.endswith('.json' + suffix):
+            return name[:-len('.json' + suffix)]
+    return None
+
+def _archive_codec(path: str):
+    for codec, suffix in ARCHIVE_SUFFIXES.items():
+        if path.endswith('.json' + suffix):
+            return codec
+    return None
+
+def _compress(raw: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstd 压缩需要安装 zstandard")
+        return zstandard.ZstdCompressor(level=10).compress(raw)
+    return gzip.compress(raw, compresslevel=6)
+
+def _open_history(path: str):
+    """以二进制方式打开历史文件，归档文件返回解压流"""
+    codec = _archive_codec(path)
+    if codec == 'gzip':
+        return gzip.open(path, 'rb')
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("读取 zstd 归档需要安装 zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+def _original_size(path: str) -> int:
+    """归档文件解压后的大小：gzip 取文件尾的 ISIZE（对话文件远小于 4GB），zstd 取帧头的内容长度"""
+    with open(path, 'rb') as f:
+        if _archive_codec(path) == 'zstd':
+            return zstandard.frame_content_size(f.read(18)) if zstandard is not None else 0
+        f.seek(-4, os.SEEK_END)
+        return int.from_bytes(f.read(4), 'little')
+
+def split_history(history):
+    """拆分历史文件内容（或导出的 tar 中的对话文件）为 (元数据或 None, 消息列表)"""
+    if not isinstance(history, list):
+        return None, []
+    metadata = history[0] if history and isinstance(history[0], dict) and 'creation_time' in history[0] else None
+    return metadata, [item for item in history if not _is_metadata_entry(item)]
+
+
+class FileHistoryStore:
+    """
+    每个对话一个 JSON 数组文件：第一个元素为元数据，其后为消息；文件修改时间即最后活动时间。
+    文件按对话 ID 中的创建年月分目录（<模型>/<年>/<月>/，见 _shard），旧版本平铺在模型目录下的文件在启动时移入。
+    当天的对话序号在模型目录的 SEQUENCE_LOCK 锁内分配，计数保存在各月目录的 SEQUENCE_FILE。
+    追加消息、更新元数据等读-改-写操作在对话锁（_conversation_lock）内进行，多个 worker 并发写入同一对话不会丢失。
+    长时间没有活动的对话可由 archive_idle 压缩为 <对话ID>.json.gz（或 .json.zst），保留原修改时间，
+    列表与元数据读取直接解压文件开头；读取消息或写入时自动解压还原为 .json（见 _rehydrate）。
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        if not os.path.exists(root):
+            try:
+                os.makedirs(root)
+                logger.info("Created history directory: %s", root)
+            except OSError as e:
+                logger.error("Error creating history directory %s: %s", root, e)
+        # 确保默认模型目录存在
+        for model in DEFAULT_MODELS:
+            self.ensure_model_directory(model)
+        for model in self.models():
+            self._move_to_shards(model)
+
+    def ensure_model_directory(self, model):
+        """确保模型的历史目录存在"""
+        model_dir = os.path.join(self.root, model)
+        if not os.path.exists(model_dir):
+            try:
+                os.makedirs(model_dir)
+                logger.info("Created history directory for model %s: %s", model, model_dir)
+            except OSError as e:
+                logger.error("Error creating history directory for model %s: %s", model, e)
+        return model_dir
+
+    def _path(self, model: str, conversation_id: str) -> str:
+        validate_conversation_id(conversation_id)
+        return os.path.join(self.ensure_model_directory(model), *(_shard(conversation_id) or ()),
+                            f"{conversation_id}.json")
+
+    def _conversation_lock(self, model: str, conversation_id: str):
+        """对话的跨进程写锁（锁文件不随对话删除，避免等待中的写入锁住已被删除的文件）"""
+        stripe = int(hashlib.md5(conversation_id.encode('utf-8')).hexdigest()[:8], 16) % CONVERSATION_LOCK_STRIPES
+        return file_lock(os.path.join(self.root, model, CONVERSATION_LOCK_DIR, f"{stripe:02x}"))
+
+    def _move_to_shards(self, model):
+        """把平铺在模型目录下的日期 ID 对话（及其 .idx、归档文件）移入年月分片目录；多个 worker 同时执行时互不影响"""
+        model_dir = os.path.join(self.root, model)
+        moved = 0
+        with os.scandir(model_dir) as it:
+            entries = [entry for entry in it if entry.is_file()]
+        for entry in entries:
+            shard = _shard(entry.name)
+            is_conversation_file = (_conversation_id_from_name(entry.name) is not None
+                                    or entry.name.endswith(INDEX_SUFFIX))
+            if shard is None or not is_conversation_file:
+                continue
+            target = os.path.join(model_dir, *shard, entry.name)
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # 不覆盖分片目录中已有的文件
+                os.link(entry.path, target)
+                os.remove(entry.path)
+                moved += 1
+            except FileNotFoundError:
+                continue  # 已被其他 worker 移走
+            except FileExistsError:
+                logger.warning("History Store: %s 已存在，保留 %s 待人工处理", target, entry.path)
+            except OSError as e:
+                logger.error("History Store: 移动 %s 失败: %s", entry.path, e)
+        if moved:
+            logger.info("History Store: 已把模型 %s 的 %s 个文件移入年月分片目录", model, moved)
+
+    def _model_files(self, model_dir):
+        """模型目录及其年月分片目录下的所有文件（DirEntry）"""
+        with os.scandir(model_dir) as it:
+            entries = list(it)
+        for entry in entries:
+            if entry.is_file():
+                yield entry
+            elif entry.is_dir() and entry.name.isdigit():
+                with os.scandir(entry.path) as months:
+                    month_dirs = [month.path for month in months if month.is_dir() and month.name.isdigit()]
+                for month_dir in month_dirs:
+                    with os.scandir(month_dir) as it:
+                        yield from (item for item in it if item.is_file())
+
+    def _archived_path(self, filepath: str):
+        """对话的压缩文件路径，未归档时返回 None"""
+        for suffix in ARCHIVE_SUFFIXES.values():
+            if os.path.exists(filepath + suffix):
+                return filepath + suffix
+        return None
+
+    def _rehydrate(self, filepath: str) -> bool:
+        """
+        把已归档的对话解压还原为 .json（保留原修改时间，对话列表顺序不变），并刷新索引文件的修改时间
+        作为最近访问标记，避免刚读取的对话在下一轮归档中又被压缩。对话不存在时返回 False。
+        """
+        if os.path.exists(filepath):
+            return True
+        archived = self._archived_path(filepath)
+        if archived is None:
+            return False
+        started = time.perf_counter()
+        try:
+            with _open_history(archived) as f:
+                raw = f.read()
+            mtime_ns = os.stat(archived).st_mtime_ns
+        except FileNotFoundError:
+            # 其他 worker 刚完成还原
+            return os.path.exists(filepath)
+        temp_file = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(raw)
+        os.utime(temp_file, ns=(mtime_ns, mtime_ns))
+        try:
+            # 以硬链接发布：目标已存在（其他 worker 已还原并可能已写入）时不覆盖
+            os.link(temp_file, filepath)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_file)
+        st = os.stat(filepath)
+        if _load_index(filepath, st) is None:
+            _write_index(filepath, st, [[start, end, value.get('id') if isinstance(value, dict) else None]
+                                        for start, end, value in _scan_entries(raw)
+                                        if not _is_metadata_entry(value)])
+        else:
+            os.utime(_index_path(filepath))
+        try:
+            os.remove(archived)
+        except FileNotFoundError:
+            pass
+        metrics.HISTORY_REHYDRATE_SECONDS.observe(time.perf_counter() - started, codec=_archive_codec(archived))
+        logger.info("History Store: 已解压归档对话 %s（%s 字节）", filepath, len(raw))
+        return True
+
+    def create(self, model, conversation_id, metadata):
+        model_dir = self.ensure_model_directory(model)
+        if not os.path.exists(model_dir):
+            logger.warning("目录创建失败，尝试再次创建: %s", model_dir)
+            try:
+                os.makedirs(model_dir, exist_ok=True)
+            except Exception as mkdir_error:
+                raise IOError(f"无法创建模型目录 {model_dir}: {mkdir_error}")
+        # 检查目录是否可写
+        if not os.access(model_dir, os.W_OK):
+            raise IOError(f"模型目录 {model_dir} 没有写入权限")
+
+        filepath = self._path(model, conversation_id)
+        try:
+            _write_history(filepath, [metadata], 'create')
+        except IOError as file_error:
+            raise IOError(f"写入对话文件失败 {filepath}: {file_error}")
+
+    def exists(self, model, conversation_id):
+        filepath = self._path(model, conversation_id)
+        return os.path.exists(filepath) or self._archived_path(filepath) is not None
+
+    def get_metadata(self, model, conversation_id):
+        filepath = self._path(model, conversation_id)
+        try:
+            # 只解析文件开头的元数据，长对话也无需读取整个文件
+            first = _read_first_entry(filepath, 'metadata')
+        except FileNotFoundError:
+            # 已归档的对话只解压开头，不还原
+            archived = self._archived_path(filepath)
+            if archived is None:
+                return None
+            try:
+                first = _read_first_entry(archived, 'metadata')
+            except FileNotFoundError:
+                return None
+        return first if isinstance(first, dict) and 'creation_time' in first else None
+
+    def update_metadata(self, model, conversation_id, updates, op='update_metadata'):
+        filepath = self._path(model, conversation_id)
+        with self._conversation_lock(model, conversation_id):
+            if not self._rehydrate(filepath):
+                return False
+            try:
+                history = _read_history(filepath, op)
+            except FileNotFoundError:
+                return False
+            metadata, _ = split_history(history)
+            if metadata is None:
+                return False
+            metadata.update(updates)
+            _write_history(filepath, history, op)
+            return True
+
+    def append_message(self, model, conversation_id, message, metadata):
+        filepath = self._path(model, conversation_id)
+        with self._conversation_lock(model, conversation_id):
+            return self._append_message(filepath, message, metadata)
+
+    def _append_message(self, filepath, message, metadata):
+        if self._rehydrate(filepath):
+            try:
+                history = _read_history(filepath, 'save_message')
+                if not isinstance(history, list):
+                    logger.warning("Warning: History file %s is not a list. Overwriting with metadata + new message.", filepath)
+                    history = [metadata]
+            except json.JSONDecodeError:
+                logger.warning("Warning: Could not decode JSON from %s. Overwriting with metadata + new message.", filepath)
+                history = [metadata]
+        else:
+            logger.warning("Warning: History file %s not found. Creating new file with metadata.", filepath)
+            history = [metadata]
+
+        if _is_duplicate(history, message):
+            return None
+        seq = sum(1 for item in history if not _is_metadata_entry(item))
+        history.append(message)
+        _write_history(filepath, history, 'save_message')
+        return seq
+
+    def get_messages(self, model, conversation_id):
+        filepath = self._path(model, conversation_id)
+        try:
+            history = _read_history(filepath, 'get_messages')
+        except FileNotFoundError:
+            if not self._rehydrate(filepath):
+                return None
+            history = _read_history(filepath, 'get_messages')
+        return split_history(history)[1]
+
+    def get_messages_page(self, model, conversation_id, after, limit):
+        filepath = self._path(model, conversation_id)
+        started = time.perf_counter()
+        try:
+            f = open(filepath, 'rb')
+        except FileNotFoundError:
+            if not self._rehydrate(filepath):
+                return None
+            f = open(filepath, 'rb')
+        with f:
+            # 基于同一个打开的文件读取，期间文件被替换也不会读到不一致的内容
+            st = os.fstat(f.fileno())
+            index = _load_index(filepath, st)
+            raw = None
+            if index is None:
+                raw = f.read()
+                entries = [[start, end, value.get('id') if isinstance(value, dict) else None]
+                           for start, end, value in _scan_entries(raw) if not _is_metadata_entry(value)]
+                _write_index(filepath, st, entries)
+            else:
+                entries = index['messages']
+
+            if after is None:
+                start = 0
+            elif isinstance(after, int):
+                start = max(after + 1, 0)
+            else:
+                matches = [i for i, entry in enumerate(entries) if entry[2] == after]
+                if not matches:
+                    raise ValueError(f"消息 {after} 不存在")
+                start = matches[-1] + 1
+            selected = entries[start:start + limit]
+
+            messages = []
+            if selected:
+                base = selected[0][0]
+                if raw is None:
+                    f.seek(base)
+                    chunk = f.read(selected[-1][1] - base)
+                else:
+                    chunk = raw[base:selected[-1][1]]
+                messages = [json.loads(chunk[s - base:e - base]) for s, e, _ in selected]
+        metrics.HISTORY_READ_SECONDS.observe(time.perf_counter() - started, op='get_messages_page')
+        return {
+            "messages": messages,
+            "total": len(entries),
+            "next_after": start + len(selected) - 1,
+            "has_more": start + len(selected) < len(entries),
+        }
+
+    def _conversation_files(self, model):
+        """
+        按最后活动时间（文件修改时间）倒序返回 [(毫秒时间戳, 对话ID, 路径)]，只读取目录项，不打开文件。
+        已归档的对话路径为压缩文件；归档过程中两者同时存在时取 .json。
+        """
+        model_dir = self.ensure_model_directory(model)
+        found = {}
+        for entry in self._model_files(model_dir):
+            conversation_id = _conversation_id_from_name(entry.name)
+            if conversation_id is None:
+                continue
+            if conversation_id in found and not entry.name.endswith('.json'):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue  # 刚被删除或还原
+            found[conversation_id] = (int(mtime * 1000), conversation_id, entry.path)
+        entries = list(found.values())
+        entries.sort(reverse=True)
+        return entries
+
+    def list_conversations(self, model, limit=None, before=None):
+        entries = self._conversation_files(model)
+        if before is not None:
+            entries = [entry for entry in entries if (entry[0], entry[1]) < before]
+        if limit is not None:
+            entries = entries[:limit]
+        result = []
+        for timestamp, conversation_id, filepath in entries:
+            name = None
+            # 只解析元数据以获取自定义名称
+            try:
+                first = _read_first_entry(filepath, 'list')
+                if isinstance(first, dict):
+                    name = first.get('custom_name')
+            except FileNotFoundError:
+                # 扫描目录后刚被归档或还原
+                metadata = self.get_metadata(model, conversation_id)
+                name = metadata.get('custom_name') if metadata else None
+            except Exception as read_err:
+                logger.warning("Warning: Could not read file %s to get custom name: %s", filepath, read_err)
+            result.append((timestamp, conversation_id, name))
+        return result
+
+    def next_sequence(self, model, day):
+        model_dir = self.ensure_model_directory(model)
+        month_dir = os.path.join(model_dir, day[:4], day[4:6])
+        counter_file = os.path.join(month_dir, SEQUENCE_FILE)
+        with file_lock(os.path.join(model_dir, SEQUENCE_LOCK)):
+            try:
+                with open(counter_file, 'r', encoding='utf-8') as f:
+                    counters = json.load(f)
+            except FileNotFoundError:
+                counters = {}
+            if day in counters:
+                value = counters[day] + 1
+            else:
+                # 当天第一次分配（或计数文件丢失）：从已有对话中最大的序号继续，只扫描一次该月目录
+                value = 1 + max((_sequence_of(name, day) for name in self._names(month_dir)), default=0)
+            counters[day] = value
+            os.makedirs(month_dir, exist_ok=True)
+            temp_file = f"{counter_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(counters, f)
+            os.replace(temp_file, counter_file)
+        return value
+
+    @staticmethod
+    def _names(directory):
+        try:
+            with os.scandir(directory) as it:
+                return [entry.name for entry in it]
+        except FileNotFoundError:
+            return []
+
+    def delete(self, model, conversation_id):
+        filepath = self._path(model, conversation_id)
+        removed = False
+        for path in [filepath] + [filepath + suffix for suffix in ARCHIVE_SUFFIXES.values()]:
+            try:
+                os.remove(path)
+                removed = True
+            except FileNotFoundError:
+                pass
+        if removed:
+            try:
+                os.remove(_index_path(filepath))
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def models(self):
+        try:
+            return sorted(entry.name for entry in os.scandir(self.root) if entry.is_dir())
+        except FileNotFoundError:
+            return []
+
+    def conversation_ids(self, model):
+        return [conversation_id for _, conversation_id, _ in self._conversation_files(model)]
+
+    def export_conversation(self, model, conversation_id):
+        """返回 {"metadata", "messages", "timestamp"}，对话不存在时返回 None；文件不是数组时抛出 ValueError"""
+        filepath = self._path(model, conversation_id)
+        # 已归档的对话直接解压读取，不还原
+        for path in (filepath, self._archived_path(filepath)):
+            if path is None:
+                continue
+            try:
+                with _open_history(path) as f:
+                    history = json.loads(f.read())
+                timestamp = int(os.stat(path).st_mtime * 1000)
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            return None
+        if not isinstance(history, list):
+            raise ValueError(f"history file {filepath} is not a JSON array")
+        metadata, messages = split_history(history)
+        return {"metadata": metadata, "messages": messages, "timestamp": timestamp}
+
+    def import_conversation(self, model, conversation_id, metadata, messages, timestamp=None):
+        """写入（覆盖）整个对话，timestamp 为最后活动时间（毫秒）"""
+        filepath = self._path(model, conversation_id)
+        with self._conversation_lock(model, conversation_id):
+            _write_history(filepath, ([metadata] if metadata is not None else []) + list(messages), 'import')
+            if timestamp is not None:
+                os.utime(filepath, ns=(timestamp * 1_000_000, timestamp * 1_000_000))
+            for suffix in ARCHIVE_SUFFIXES.values():
+                try:
+                    os.remove(filepath + suffix)
+                except FileNotFoundError:
+                    pass
+
+    def import_conversations(self, items, overwrite=False):
+        """
+        批量写入 items 中的 (model, conversation_id, metadata, messages, timestamp)，返回每项是否写入
+        （已存在且 overwrite=False 时跳过）。每个对话各自原子写入。
+        """
+        results = []
+        for model, conversation_id, metadata, messages, timestamp in items:
+            if not overwrite and self.exists(model, conversation_id):
+                results.append(False)
+                continue
+            self.import_conversation(model, conversation_id, metadata, messages, timestamp)
+            results.append(True)
+        return results
+
+    # --- 冷存储 ---
+
+    def archive_idle(self, cutoff: float, codec: str = 'gzip', models=None, limit=None) -> dict:
+        """
+        压缩最后写入与最近还原都早于 cutoff（Unix 时间戳）的对话，最多 limit 个。
+
+        Returns:
+            dict: {"archived": 个数, "bytes_before": 原大小合计, "bytes_after": 压缩后合计, "failed": 失败个数}
+        """
+        result = {"archived": 0, "bytes_before": 0, "bytes_after": 0, "failed": 0}
+        for model in models or self.models():
+            for _, conversation_id, filepath in reversed(self._conversation_files(model)):
+                if limit is not None and result["archived"] >= limit:
+                    return result
+                if not filepath.endswith('.json'):
+                    continue
+                try:
+                    st = os.stat(filepath)
+                    try:
+                        last_access = os.stat(_index_path(filepath)).st_mtime
+                    except FileNotFoundError:
+                        last_access = 0
+                    if max(st.st_mtime, last_access) >= cutoff:
+                        continue
+                    size = self._archive_file(filepath, st, codec)
+                    if size is None:
+                        continue
+                    result["archived"] += 1
+                    result["bytes_before"] += st.st_size
+                    result["bytes_after"] += size
+                except OSError as e:
+                    result["failed"] += 1
+                    logger.error("History Store: 归档对话 %s 失败: %s", filepath, e)
+        return result
+
+    def _archive_file(self, filepath: str, st, codec: str):
+        """压缩单个历史文件，返回压缩后大小；期间文件被写入时放弃并返回 None"""
+        with open(filepath, 'rb') as f:
+            raw = f.read()
+        archived = filepath + ARCHIVE_SUFFIXES[codec]
+        temp_file = f"{archived}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(_compress(raw, codec))
+        # 压缩文件保留原修改时间，对话列表的顺序与时间戳不变
+        os.utime(temp_file, ns=(st.st_mtime_ns, st.st_mtime_ns))
+        os.replace(temp_file, archived)
+
+        # 先把 .json 改名再确认它仍是刚才压缩的那个文件：若期间有写入（历史文件总是整体替换，inode 会变），
+        # 放回原处并删除压缩文件，绝不删除未压缩进归档的内容
+        moved = f"{filepath}.{os.getpid()}.{threading.get_ident()}.archiving"
+        os.rename(filepath, moved)
+        moved_st = os.stat(moved)
+        if (moved_st.st_ino, moved_st.st_mtime_ns, moved_st.st_size) == (st.st_ino, st.st_mtime_ns, st.st_size):
+            os.remove(moved)
+            return os.stat(archived).st_size
+        try:
+            os.link(moved, filepath)
+            os.remove(moved)
+            os.remove(archived)
+        except FileExistsError:
+            # 改名期间有读取请求从旧的压缩文件还原了对话：保留较新的文件供人工处理
+            logger.error("History Store: 归档 %s 时发生并发写入，较新的内容保存在 %s", filepath, moved)
+        return None
+
+    def archive_stats(self, models=None) -> dict:
+        """统计未压缩与已归档对话的数量和大小（原大小从压缩文件头/尾读取，不解压）"""
+        stats = {"hot": {"conversations": 0, "bytes": 0},
+                 "archived": {"conversations": 0, "bytes": 0, "original_bytes": 0}}
+        for model in models or self.models():
+            for _, _, filepath in self._conversation_files(model):
+                try:
+                    size = os.stat(filepath).st_size
+                    if filepath.endswith('.json'):
+                        stats["hot"]["conversations"] += 1
+                        stats["hot"]["bytes"] += size
+                    else:
+                        stats["archived"]["conversations"] += 1
+                        stats["archived"]["bytes"] += size
+                        stats["archived"]["original_bytes"] += _original_size(filepath)
+                except OSError:
+                    continue
+        archived = stats["archived"]
+        stats["saved_bytes"] = archived["original_bytes"] - archived["bytes"]
+        stats["compression_ratio"] = round(archived["original_bytes"] / archived["bytes"], 2) if archived["bytes"] else None
+        return stats
+
+
+# --- SQLite 存储 ---
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS conversations (
+        id INTEGER PRIMARY KEY,
+        model TEXT NOT NULL,
+        conversation_id TEXT NOT NULL,
+        metadata TEXT,
+        name TEXT,
+        updated_at INTEGER NOT NULL,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (model, conversation_id)
+    )""",
+    # 对话列表按最后活动时间倒序分页
+    "CREATE INDEX IF NOT EXISTS conversations_recent ON conversations (model, updated_at, conversation_id)",
+    # seq 为消息在对话中的序号（从 0 开始，与 get_messages 返回列表的下标一致）
+    """CREATE TABLE IF NOT EXISTS messages (
+        conversation INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        message_id TEXT,
+        dedupe_key TEXT NOT NULL,
+        body TEXT NOT NULL,
+        PRIMARY KEY (conversation, seq)
+    )""",
+    "CREATE INDEX IF NOT EXISTS messages_dedupe ON messages (conversation, dedupe_key)",
+    "CREATE INDEX IF NOT EXISTS messages_id ON messages (conversation, message_id)",
+    # 每个模型每天已分配的最大对话序号
+    """CREATE TABLE IF NOT EXISTS sequences (
+        model TEXT NOT NULL,
+        day TEXT NOT NULL,
+        value INTEGER NOT NULL,
+        PRIMARY KEY (model, day)
+    )""",
+)
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def _dedupe_key(message) -> str:
+    """发送者与内容的摘要，重复检查只需比较摘要相同的消息"""
+    key = json.dumps([message.get('sender'), message.get('text')], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class SQLiteHistoryStore:
+    """
+    所有对话保存在一个 SQLite 数据库：conversations 表每个对话一行（元数据为 JSON），messages 表每条消息一行。
+    写操作在 BEGIN IMMEDIATE 事务中完成，跨进程原子；读操作在只读事务中完成，看到一致的快照。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._transaction() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    def _connection(self):
+        # 每个线程（以及 fork 出的每个 worker 进程）使用独立连接
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self, op=None, read_only=False):
+        """写事务（BEGIN IMMEDIATE）或只读事务；指定 op 时记录耗时"""
+        started = time.perf_counter()
+        conn = self._connection()
+        conn.execute("BEGIN" if read_only else "BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        if op is not None:
+            histogram = metrics.HISTORY_READ_SECONDS if read_only else metrics.HISTORY_WRITE_SECONDS
+            histogram.observe(time.perf_counter() - started, op=op)
+
+    @staticmethod
+    def _row(conn, model, conversation_id, columns='id'):
+        return conn.execute(f"SELECT {columns} FROM conversations WHERE model = ? AND conversation_id = ?",
+                            (model, conversation_id)).fetchone()
+
+    @staticmethod
+    def _insert_conversation(conn, model, conversation_id, metadata, timestamp, message_count=0):
+        return conn.execute(
+            "INSERT INTO conversations (model, conversation_id, metadata, name, updated_at, message_count) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (model, conversation_id, None if metadata is None else _dumps(metadata),
+             metadata.get('custom_name') if isinstance(metadata, dict) else None, timestamp, message_count),
+        ).lastrowid
+
+    def create(self, model, conversation_id, metadata):
+        with self._transaction('create') as conn:
+            self._insert_conversation(conn, model, conversation_id, metadata, _now_ms())
+
+    def exists(self, model, conversation_id):
+        return self._row(self._connection(), model, conversation_id) is not None
+
+    def get_metadata(self, model, conversation_id):
+        started = time.perf_counter()
+        row = self._row(self._connection(), model, conversation_id, 'metadata')
+        metrics.HISTORY_READ_SECONDS.observe(time.perf_counter() - started, op='metadata')
+        if row is None or row[0] is None:
+            return None
+        metadata = json.loads(row[0])
+        return metadata if isinstance(metadata, dict) and 'creation_time' in metadata else None
+
+    def update_metadata(self, model, conversation_id, updates, op='update_metadata'):
+        with self._transaction(op) as conn:
+            row = self._row(conn, model, conversation_id, 'id, metadata')
+            metadata = json.loads(row[1]) if row and row[1] is not None else None
+            if not isinstance(metadata, dict) or 'creation_time' not in metadata:
+                return False
+            metadata.update(updates)
+            conn.execute("UPDATE conversations SET metadata = ?, name = ?, updated_at = ? WHERE id = ?",
+                         (_dumps(metadata), metadata.get('custom_name'), _now_ms(), row[0]))
+        return True
+
+    def append_message(self, model, conversation_id, message, metadata):
+        key = _dedupe_key(message)
+        body = _dumps(message)
+        now = _now_ms()
+        with self._transaction('save_message') as conn:
+            row = self._row(conn, model, conversation_id, 'id, message_count')
+            if row is None:
+                logger.warning("Warning: Conversation %s/%s not found. Creating it with metadata.",
+                               model, conversation_id)
+                pk, count = self._insert_conversation(conn, model, conversation_id, metadata, now), 0
+            else:
+                pk, count = row
+                for (existing,) in conn.execute(
+                        "SELECT body FROM messages WHERE conversation = ? AND dedupe_key = ?", (pk, key)):
+                    if _is_duplicate([json.loads(existing)], message):
+                        return None
+            conn.execute("INSERT INTO messages (conversation, seq, message_id, dedupe_key, body) "
+                         "VALUES (?, ?, ?, ?, ?)", (pk, count, message.get('id'), key, body))
+            conn.execute("UPDATE conversations SET message_count = ?, updated_at = ? WHERE id = ?",
+                         (count + 1, now, pk))
+        return count
+
+    def get_messages(self, model, conversation_id):
+        with self._transaction('get_messages', read_only=True) as conn:
+            row = self._row(conn, model, conversation_id)
+            if row is None:
+                return None
+            bodies = [body for (body,) in conn.execute(
+                "SELECT body FROM messages WHERE conversation = ? ORDER BY seq", (row[0],))]
+        # 拼成一个数组一次解析，比逐条解析快
+        return json.loads('[' + ','.join(bodies) + ']')
+
+    def get_messages_page(self, model, conversation_id, after, limit):
+        with self._transaction('get_messages_page', read_only=True) as conn:
+            row = self._row(conn, model, conversation_id, 'id, message_count')
+            if row is None:
+                return None
+            pk, total = row
+            if after is None:
+                start = 0
+            elif isinstance(after, int):
+                start = max(after + 1, 0)
+            else:
+                (seq,) = conn.execute("SELECT MAX(seq) FROM messages WHERE conversation = ? AND message_id = ?",
+                                      (pk, after)).fetchone()
+                if seq is None:
+                    raise ValueError(f"消息 {after} 不存在")
+                start = seq + 1
+            bodies = [body for (body,) in conn.execute(
+                "SELECT body FROM messages WHERE conversation = ? AND seq >= ? ORDER BY seq LIMIT ?",
+                (pk, start, limit))]
+        return {
+            "messages": json.loads('[' + ','.join(bodies) + ']'),
+            "total": total,
+            "next_after": start + len(bodies) - 1,
+            "has_more": start + len(bodies) < total,
+        }
+
+    def list_conversations(self, model, limit=None, before=None):
+        sql = "SELECT updated_at, conversation_id, name FROM conversations WHERE model = ?"
+        params = [model]
+        if before is not None:
+            sql += " AND (updated_at, conversation_id) < (?, ?)"
+            params.extend(before)
+        sql += " ORDER BY updated_at DESC, conversation_id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        started = time.perf_counter()
+        rows = self._connection().execute(sql, params).fetchall()
+        metrics.HISTORY_READ_SECONDS.observe(time.perf_counter() - started, op='list')
+        return rows
+
+    def next_sequence(self, model, day):
+        with self._transaction('allocate') as conn:
+            row = conn.execute("SELECT value FROM sequences WHERE model = ? AND day = ?", (model, day)).fetchone()
+            if row is not None:
+                value = row[0] + 1
+            else:
+                # 当天第一次分配（如刚从文件存储迁移）：从已有对话中最大的序号继续
+                value = 1 + max((_sequence_of(conversation_id, day) for (conversation_id,) in conn.execute(
+                    "SELECT conversation_id FROM conversations WHERE model = ? AND conversation_id >= ? "
+                    "AND conversation_id < ?", (model, day, day + '\uffff'))), default=0)
+            conn.execute("INSERT OR REPLACE INTO sequences (model, day, value) VALUES (?, ?, ?)", (model, day, value))
+        return value
+
+    def delete(self, model, conversation_id):
+        with self._transaction('delete') as conn:
+            row = self._row(conn, model, conversation_id)
+            if row is None:
+                return False
+            conn.execute("DELETE FROM messages WHERE conversation = ?", (row[0],))
+            conn.execute("DELETE FROM conversations WHERE id = ?", (row[0],))
+        return True
+
+    def models(self):
+        return [model for (model,) in self._connection().execute(
+            "SELECT DISTINCT model FROM conversations ORDER BY model")]
+
+    def conversation_ids(self, model):
+        return [conversation_id for (conversation_id,) in self._connection().execute(
+            "SELECT conversation_id FROM conversations WHERE model = ? "
+            "ORDER BY updated_at DESC, conversation_id DESC", (model,))]
+
+    def export_conversation(self, model, conversation_id):
+        with self._transaction('export', read_only=True) as conn:
+            row = self._row(conn, model, conversation_id, 'id, metadata, updated_at')
+            if row is None:
+                return None
+            bodies = [body for (body,) in conn.execute(
+                "SELECT body FROM messages WHERE conversation = ? ORDER BY seq", (row[0],))]
+        return {"metadata": None if row[1] is None else json.loads(row[1]),
+                "messages": json.loads('[' + ','.join(bodies) + ']'),
+                "timestamp": row[2]}
+
+    def import_conversation(self, model, conversation_id, metadata, messages, timestamp=None):
+        with self._transaction('import') as conn:
+            self._replace_conversation(conn, model, conversation_id, metadata, messages, timestamp)
+
+    def import_conversations(self, items, overwrite=False):
+        """批量导入（接口同 FileHistoryStore.import_conversations），整批在一个事务中写入"""
+        results = []
+        with self._transaction('import_batch') as conn:
+            for model, conversation_id, metadata, messages, timestamp in items:
+                if not overwrite and self._row(conn, model, conversation_id) is not None:
+                    results.append(False)
+                    continue
+                self._replace_conversation(conn, model, conversation_id, metadata, messages, timestamp)
+                results.append(True)
+        return results
+
+    def _replace_conversation(self, conn, model, conversation_id, metadata, messages, timestamp):
+        row = self._row(conn, model, conversation_id)
+        if row is not None:
+            conn.execute("DELETE FROM messages WHERE conversation = ?", (row[0],))
+            conn.execute("DELETE FROM conversations WHERE id = ?", (row[0],))
+        pk = self._insert_conversation(conn, model, conversation_id, metadata,
+                                       _now_ms() if timestamp is None else timestamp, len(messages))
+        conn.executemany(
+            "INSERT INTO messages (conversation, seq, message_id, dedupe_key, body) VALUES (?, ?, ?, ?, ?)",
+            ((pk, seq, message.get('id') if isinstance(message, dict) else None,
+              _dedupe_key(message) if isinstance(message, dict) else '', _dumps(message))
+             for seq, message in enumerate(messages)))
+
+
+def migrate(source, target, models=None, overwrite=False, progress=None):
+    """
+    把 source 中的对话逐个复制到 target（保留元数据、消息顺序与最后活动时间）。
+    target 中已存在的对话默认跳过，overwrite=True 时覆盖；无法解析的对话记录错误后跳过。
+    progress(model, 已处理数) 每处理 1000 个对话调用一次。
+
+    Returns:
+        dict: {"conversations", "messages", "skipped", "failed"}
+    """
+    stats = {"conversations": 0, "messages": 0, "skipped": 0, "failed": 0}
+    for model in models or source.models():
+        for done, conversation_id in enumerate(source.conversation_ids(model), 1):
+            try:
+                validate_conversation_id(conversation_id)
+                if not overwrite and target.exists(model, conversation_id):
+                    stats["skipped"] += 1
+                    continue
+                data = source.export_conversation(model, conversation_id)
+                if data is None:
+                    continue  # 迁移期间被删除
+                target.import_conversation(model, conversation_id, data["metadata"], data["messages"],
+                                           data["timestamp"])
+                stats["conversations"] += 1
+                stats["messages"] += len(data["messages"])
+            except Exception as e:
+                stats["failed"] += 1
+                logger.error("History Migration: 迁移对话 %s/%s 失败: %s", model, conversation_id, e)
+            if progress is not None and done % 1000 == 0:
+                progress(model, done)
+    return stats
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """返回当前进程使用的历史存储（按 HISTORY_BACKEND 懒加载）"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if HISTORY_BACKEND == 'sqlite':
+                _store = SQLiteHistoryStore(HISTORY_DB_PATH)
+            else:
+                _store = FileHistoryStore(HISTORY_DIR)
+            logger.info("History Store: 使用 %s", type(_store).__name__)
+        return _store
+
+
+def set_store(store):
+    """替换历史存储（迁移、基准测试或自定义部署时注入其他实现）"""
+    global _store
+    with _store_lock:
+        _store = store
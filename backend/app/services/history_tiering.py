@@ -0,0 +1,105 @@
+"""
+对话历史的冷存储分层。
+
+超过 HISTORY_ARCHIVE_AFTER_DAYS 天没有写入（也没有因读取被解压）的对话会被压缩（HISTORY_ARCHIVE_CODEC：
+gzip，或安装了 zstandard 时的 zstd），get_messages 等读取时自动解压还原，活跃对话始终保持未压缩。
+
+每个 worker 进程在处理第一个请求时启动后台线程，每 HISTORY_ARCHIVE_INTERVAL 秒执行一次；
+通过非阻塞文件锁保证同一时间只有一个 worker 在归档。HISTORY_ARCHIVE_AFTER_DAYS=0 关闭自动归档
+（仍可通过 POST /chat/history/archive 手动执行）。目前只有文件存储支持分层，SQLite 存储跳过。
+"""
+import logging
+import os
+import threading
+import time
+
+from flask import request
+
+from . import history_store
+from .history_store import zstandard
+from .locking import file_lock
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
+ARCHIVE_LOCK = os.path.join(UPLOAD_DIR, 'history_archive.lock')
+HISTORY_ARCHIVE_AFTER_DAYS = float(os.getenv('HISTORY_ARCHIVE_AFTER_DAYS', '7'))
+HISTORY_ARCHIVE_CODEC = os.getenv('HISTORY_ARCHIVE_CODEC', 'gzip')
+HISTORY_ARCHIVE_INTERVAL = float(os.getenv('HISTORY_ARCHIVE_INTERVAL', '3600'))
+# 每轮最多归档的对话数，避免一次占用磁盘 IO 过久
+HISTORY_ARCHIVE_BATCH = int(os.getenv('HISTORY_ARCHIVE_BATCH', '1000'))
+
+_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+
+
+def _codec():
+    if HISTORY_ARCHIVE_CODEC == 'zstd' and zstandard is None:
+        logger.warning("History Tiering: 未安装 zstandard，改用 gzip 压缩")
+        return 'gzip'
+    return HISTORY_ARCHIVE_CODEC if HISTORY_ARCHIVE_CODEC in history_store.ARCHIVE_SUFFIXES else 'gzip'
+
+
+def run_once(idle_days: float = None, limit: int = None) -> dict:
+    """
+    归档一轮空闲对话。其他 worker 正在归档时直接返回 {"skipped": "busy"}，
+    当前存储不支持分层时返回 {"skipped": "unsupported"}。
+    """
+    store = history_store.get_store()
+    if not hasattr(store, 'archive_idle'):
+        return {"skipped": "unsupported"}
+    idle_days = HISTORY_ARCHIVE_AFTER_DAYS if idle_days is None else idle_days
+    with file_lock(ARCHIVE_LOCK, blocking=False) as acquired:
+        if not acquired:
+            return {"skipped": "busy"}
+        started = time.perf_counter()
+        codec = _codec()
+        result = store.archive_idle(time.time() - idle_days * 86400, codec=codec,
+                                    limit=HISTORY_ARCHIVE_BATCH if limit is None else limit)
+    result["codec"] = codec
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    if result["archived"] or result["failed"]:
+        logger.info("History Tiering: 归档 %s 个对话，%s -> %s 字节，失败 %s，耗时 %.1f 秒",
+                    result["archived"], result["bytes_before"], result["bytes_after"], result["failed"],
+                    result["seconds"])
+    return result
+
+
+def stats() -> dict:
+    """当前的冷热分布与节省的磁盘空间"""
+    store = history_store.get_store()
+    if not hasattr(store, 'archive_stats'):
+        return {"supported": False}
+    return {"supported": True, "archive_after_days": HISTORY_ARCHIVE_AFTER_DAYS, **store.archive_stats()}
+
+
+def _loop():
+    while True:
+        time.sleep(HISTORY_ARCHIVE_INTERVAL)
+        try:
+            run_once()
+        except Exception as e:
+            logger.error("History Tiering: 归档失败: %s", e)
+
+
+def _ensure_scheduler():
+    """每个进程（fork 后的 worker 各自）第一次处理请求时启动后台归档线程"""
+    global _scheduler_pid
+    if _scheduler_pid == os.getpid():
+        return
+    with _scheduler_lock:
+        if _scheduler_pid == os.getpid():
+            return
+        _scheduler_pid = os.getpid()
+    threading.Thread(target=_loop, name='history-tiering', daemon=True).start()
+
+
+def init_app(app):
+    """HISTORY_ARCHIVE_AFTER_DAYS 大于 0 时启用自动归档"""
+    if HISTORY_ARCHIVE_AFTER_DAYS <= 0:
+        return
+
+    @app.before_request
+    def _tiering_before_request():
+        if request.method != 'OPTIONS':
+            _ensure_scheduler()
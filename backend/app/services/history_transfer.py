@@ -0,0 +1,136 @@
+"""
+对话历史批量导出 / 导入的流式编解码。
+
+导出记录（history_service.export_conversations 产出）与导入记录的格式相同：
+    {"model", "conversation_id", "metadata", "messages", "updated_at"（最后活动时间，毫秒）}
+
+支持的格式：
+  ndjson   每行一个对话记录
+  tar      每个对话一个 <模型>/<年>/<月>/<对话ID>.json 成员（与文件存储的目录结构相同），内容为元数据 + 消息的数组，
+           修改时间为最后活动时间，解压到 history/ 即可直接使用
+  tar.gz   gzip 压缩的 tar
+
+编码与解码都逐个对话处理，内存占用只与单个对话的大小有关。
+"""
+import io
+import json
+import os
+import tarfile
+
+from .history_store import relative_path, split_history
+
+FORMATS = {
+    'ndjson': ('application/x-ndjson', '.ndjson'),
+    'tar': ('application/x-tar', '.tar'),
+    'tar.gz': ('application/gzip', '.tar.gz'),
+}
+
+
+def mimetype(fmt: str) -> str:
+    return FORMATS[fmt][0]
+
+
+def extension(fmt: str) -> str:
+    return FORMATS[fmt][1]
+
+
+def format_for_content_type(content_type: str) -> str:
+    """根据导入请求的 Content-Type 推断格式（无法识别时按 ndjson 处理）"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in ('application/gzip', 'application/x-gzip', 'application/x-gtar'):
+        return 'tar.gz'
+    if content_type == 'application/x-tar':
+        return 'tar'
+    return 'ndjson'
+
+
+class _ChunkBuffer:
+    """tarfile 的流式输出目标：收集写入的数据，由生成器按对话取出"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def encode(records, fmt: str):
+    """把对话记录编码为指定格式，逐块产出 bytes"""
+    if fmt == 'ndjson':
+        for record in records:
+            yield (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        return
+
+    buffer = _ChunkBuffer()
+    with tarfile.open(fileobj=buffer, mode='w|gz' if fmt == 'tar.gz' else 'w|', format=tarfile.PAX_FORMAT) as tar:
+        for record in records:
+            history = ([record["metadata"]] if record["metadata"] is not None else []) + record["messages"]
+            data = json.dumps(history, ensure_ascii=False).encode('utf-8')
+            info = tarfile.TarInfo(relative_path(record['model'], record['conversation_id']))
+            info.size = len(data)
+            info.mtime = record["updated_at"] / 1000 if record.get("updated_at") else 0
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+    yield buffer.drain()
+
+
+def decode(stream, fmt: str):
+    """
+    从可读的二进制流中逐个解码对话记录，产出 (位置描述, 记录)；某一项无法解析时记录为 ValueError，
+    由调用方计入失败并继续处理后续内容。
+    """
+    if fmt == 'ndjson':
+        yield from _decode_ndjson(stream)
+    else:
+        yield from _decode_tar(stream)
+
+
+def _decode_ndjson(stream):
+    # werkzeug 的请求流是无缓冲的 RawIOBase，readline 会逐字节读取
+    if isinstance(stream, io.RawIOBase):
+        stream = io.BufferedReader(stream, buffer_size=1 << 16)
+    for line_number, line in enumerate(iter(stream.readline, b''), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            record = ValueError(f"invalid JSON: {e}")
+        yield f"line {line_number}", record
+
+
+def _decode_tar(stream):
+    with tarfile.open(fileobj=stream, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith('.json'):
+                continue
+            where = member.name
+            parts = member.name.split('/')
+            if len(parts) < 2:
+                yield where, ValueError("member must be <model>/[<year>/<month>/]<conversation_id>.json")
+                continue
+            try:
+                history = json.loads(tar.extractfile(member).read())
+            except ValueError as e:
+                yield where, ValueError(f"invalid JSON: {e}")
+                continue
+            if not isinstance(history, list):
+                yield where, ValueError("conversation file is not a JSON array")
+                continue
+            metadata, messages = split_history(history)
+            yield where, {
+                "model": parts[0],
+                "conversation_id": os.path.splitext(parts[-1])[0],
+                "metadata": metadata,
+                "messages": messages,
+                "updated_at": int(member.mtime * 1000) if member.mtime else None,
+            }
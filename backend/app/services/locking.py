@@ -0,0 +1,67 @@
+"""
+跨进程文件锁（gunicorn 多 worker 之间共享），Linux 使用 fcntl，Windows 使用 msvcrt。
+"""
+import errno
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _acquire(fd, blocking):
+    if fcntl is not None:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, flags)
+            return True
+        except BlockingIOError:
+            return False
+    # LK_LOCK 只重试约 10 秒就抛出 OSError（EDEADLOCK），阻塞模式下持续重试直到获取，
+    # 不能让调用方在未加锁的情况下进入临界区
+    mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+    while True:
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            msvcrt.locking(fd, mode, 1)
+            return True
+        except OSError as e:
+            if not blocking:
+                return False
+            if e.errno not in (errno.EDEADLOCK, errno.EACCES):
+                raise
+
+
+def _release(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def file_lock(lock_path: str, blocking: bool = True):
+    """
+    获取排他文件锁。
+
+    Args:
+        lock_path: 锁文件路径（不存在时自动创建）。
+        blocking: 为 False 时不等待，获取失败则 yield False；为 True 时一直等待到获取为止，总是 yield True。
+
+    Yields:
+        bool: 是否成功获取锁。
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    acquired = False
+    try:
+        acquired = _acquire(fd, blocking)
+        yield acquired
+    finally:
+        if acquired:
+            _release(fd)
+        os.close(fd)
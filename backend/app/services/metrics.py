@@ -0,0 +1,380 @@
+"""
+Prometheus 文本格式的运行指标。
+
+每个进程在内存中累计指标，由后台线程每 METRICS_FLUSH_INTERVAL 秒（有变化时）把快照写入
+uploads/metrics/<pid>.json。/metrics 请求可能落在任意一个 gunicorn worker 上，
+渲染时读取所有 worker 的快照并聚合：
+  counter / histogram  所有进程（包括已退出的进程）求和；
+  gauge                只对仍存活的进程求和（如在途请求数）。
+已退出进程的快照在下次渲染时合并到 archive.json 后删除，文件数量不会随 worker 重启增长。
+"""
+import atexit
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .locking import file_lock
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(UPLOAD_DIR, 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1.0'))
+_ARCHIVE_FILE = 'archive.json'
+_LOCK_FILE = 'metrics.lock'
+
+# 耗时（秒）与大小（字节）的默认分桶
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))  # 1KB ~ 1GB
+
+_registry = {}        # name -> 指标对象，按注册顺序输出
+_lock = threading.Lock()
+_dirty = False
+_flusher_pid = None
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # 标签值元组 -> 数值（histogram 为 [各桶计数..., sum, count]）
+        _registry[name] = self
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _update(self, labels, fn):
+        global _dirty
+        key = self._key(labels)
+        _ensure_flusher()
+        with _lock:
+            self._values[key] = fn(self._values.get(key))
+            _dirty = True
+
+
+class Counter(_Metric):
+    """只增不减的计数"""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self._update(labels, lambda value: (value or 0) + amount)
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值，跨进程聚合时只统计存活进程"""
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        self._update(labels, lambda value: (value or 0) + amount)
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self._update(labels, lambda _: value)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """分桶统计（非累积存储，渲染时转为 Prometheus 的累积 le 桶）"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+
+        def _add(entry):
+            entry = entry or [0] * (len(self.buckets) + 3)
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+            return entry
+        self._update(labels, _add)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+# --- 跨进程快照 ---
+
+def _snapshot():
+    with _lock:
+        return {
+            name: [[list(key), list(value) if isinstance(value, list) else value]
+                   for key, value in metric._values.items()]
+            for name, metric in _registry.items()
+        }
+
+
+def _write_json(path, data):
+    temp_file = f"{path}.{os.getpid()}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(temp_file, path)
+
+
+def flush():
+    """把当前进程的指标写入快照文件"""
+    global _dirty
+    with _lock:
+        _dirty = False
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _write_json(os.path.join(METRICS_DIR, f"{os.getpid()}.json"),
+                    {"pid": os.getpid(), "values": _snapshot()})
+    except OSError as e:
+        logger.error("Metrics: 写入指标快照失败: %s", e)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        if _dirty:
+            flush()
+
+
+def _ensure_flusher():
+    """每个进程（fork 后的 worker 各自）在第一次记录指标时启动后台写入线程"""
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        if _flusher_pid is not None:
+            # fork 出的子进程：父进程已记录的数值由父进程自己上报
+            for metric in _registry.values():
+                metric._values.clear()
+        _flusher_pid = os.getpid()
+    _archive_stale_snapshot()
+    threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+
+
+def _archive_stale_snapshot():
+    """同一 pid 的旧快照来自已退出的进程（pid 被复用），覆盖前先并入归档"""
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    if not os.path.exists(path):
+        return
+    try:
+        with file_lock(os.path.join(METRICS_DIR, _LOCK_FILE)):
+            archive_path = os.path.join(METRICS_DIR, _ARCHIVE_FILE)
+            archive = {}
+            for source in (archive_path, path):
+                try:
+                    with open(source, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                _merge(archive, data.get('values', data) if source == path else data, include_gauges=False)
+            _write_json(archive_path, _to_snapshot(archive))
+            os.remove(path)
+    except OSError as e:
+        logger.error("Metrics: 归档旧指标快照失败: %s", e)
+
+
+atexit.register(lambda: _flusher_pid == os.getpid() and flush())
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        return True  # Windows 上 os.kill(pid, 0) 会终止进程，无法探测，全部视为存活
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge(target, values, include_gauges):
+    """把一个进程的快照累加到 target {name: {key: value}}"""
+    for name, entries in values.items():
+        metric = _registry.get(name)
+        if metric is None or (metric.kind == 'gauge' and not include_gauges):
+            continue
+        merged = target.setdefault(name, {})
+        for key, value in entries:
+            key = tuple(key)
+            if metric.kind == 'histogram':
+                if len(value) != len(metric.buckets) + 3:
+                    continue  # 分桶定义已变化的旧数据
+                current = merged.get(key) or [0] * len(value)
+                merged[key] = [a + b for a, b in zip(current, value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+
+def _to_snapshot(merged):
+    return {name: [[list(key), value] for key, value in entries.items()] for name, entries in merged.items()}
+
+
+def collect() -> dict:
+    """聚合所有进程的指标，返回 {name: {标签值元组: 数值}}"""
+    _ensure_flusher()
+    flush()
+    merged = {}
+    with file_lock(os.path.join(METRICS_DIR, _LOCK_FILE)):
+        archive_path = os.path.join(METRICS_DIR, _ARCHIVE_FILE)
+        archive = {}
+        try:
+            with open(archive_path, 'r', encoding='utf-8') as f:
+                _merge(archive, json.load(f), include_gauges=False)
+        except (OSError, ValueError):
+            pass
+
+        dead_files = []
+        for entry in os.listdir(METRICS_DIR):
+            name, ext = os.path.splitext(entry)
+            if ext != '.json' or not name.isdigit():
+                continue
+            path = os.path.join(METRICS_DIR, entry)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if _pid_alive(int(name)):
+                _merge(merged, data.get('values', {}), include_gauges=True)
+            else:
+                _merge(archive, data.get('values', {}), include_gauges=False)
+                dead_files.append(path)
+
+        if dead_files:
+            # 先写归档再删除，中途失败最多重复计数一次，不会丢数据
+            _write_json(archive_path, _to_snapshot(archive))
+            for path in dead_files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    _merge(merged, _to_snapshot(archive), include_gauges=False)
+    return merged
+
+
+# --- 文本格式输出 ---
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def render() -> str:
+    """返回所有 worker 聚合后的 Prometheus 文本格式指标"""
+    merged = collect()
+    lines = []
+    for name, metric in _registry.items():
+        values = merged.get(name, {})
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for key in sorted(values):
+            value = values[key]
+            if metric.kind != 'histogram':
+                lines.append(f"{name}{_labels(metric.labelnames, key)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float('inf'),), value[:-2]):
+                cumulative += count
+                le = '+Inf' if math.isinf(bound) else _number(float(bound))
+                lines.append(f"{name}_bucket{_labels(metric.labelnames, key, ('le', le))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric.labelnames, key)} {_number(float(value[-2]))}")
+            lines.append(f"{name}_count{_labels(metric.labelnames, key)} {value[-1]}")
+
+    # 缓存命中率（由 cache_requests_total 派生，便于直接查看）
+    ratios = {}
+    for (cache, result), count in merged.get('cache_requests_total', {}).items():
+        hits, total = ratios.get(cache, (0, 0))
+        ratios[cache] = (hits + (count if result == 'hit' else 0), total + count)
+    lines.append("# HELP cache_hit_ratio Cache hit ratio since process start, aggregated across workers.")
+    lines.append("# TYPE cache_hit_ratio gauge")
+    for cache in sorted(ratios):
+        hits, total = ratios[cache]
+        lines.append(f'cache_hit_ratio{{cache="{_escape(cache)}"}} {_number(hits / total if total else 0.0)}')
+    return '\n'.join(lines) + '\n'
+
+
+# --- 指标定义 ---
+
+DIFY_TTFB_SECONDS = Histogram(
+    'dify_ttfb_seconds', 'Time from sending a chat request to Dify until the first streamed byte.',
+    ['model', 'endpoint'])
+DIFY_STREAM_DURATION_SECONDS = Histogram(
+    'dify_stream_duration_seconds', 'Total duration of relayed Dify chat streams.',
+    ['model', 'outcome'])
+DIFY_STREAMS_IN_FLIGHT = Gauge(
+    'dify_streams_in_flight', 'Dify chat streams currently being relayed.', ['model'])
+
+UPLOAD_BYTES = Histogram(
+    'upload_bytes', 'Size of uploaded files.', ['kind'], buckets=SIZE_BUCKETS)
+UPLOAD_DURATION_SECONDS = Histogram(
+    'upload_duration_seconds', 'Time to receive and process an upload, including forwarding to Dify.',
+    ['route', 'outcome'])
+
+HISTORY_READ_SECONDS = Histogram(
+    'history_read_seconds', 'Time to read and parse a conversation history file.', ['op'])
+HISTORY_WRITE_SECONDS = Histogram(
+    'history_write_seconds', 'Time to serialize and write a conversation history file.', ['op'])
+HISTORY_REHYDRATE_SECONDS = Histogram(
+    'history_rehydrate_seconds', 'Time to restore an archived conversation on first access.', ['codec'])
+HISTORY_SEARCH_SECONDS = Histogram(
+    'history_search_seconds', 'Time to run a full-text search over conversation history.', ['mode'])
+HISTORY_FILE_BYTES = Histogram(
+    'history_file_bytes', 'Size of conversation history files read or written.', ['direction'],
+    buckets=SIZE_BUCKETS)
+
+GHIDRA_QUEUE_DEPTH = Gauge(
+    'ghidra_queue_depth', 'Batch analysis jobs queued or running.')
+GHIDRA_RUN_SECONDS = Histogram(
+    'ghidra_run_seconds', 'Wall-clock time of analyzeHeadless invocations.', ['mode', 'outcome'])
+
+CACHE_REQUESTS = Counter(
+    'cache_requests_total', 'Cache lookups by cache and result (hit/miss).', ['cache', 'result'])
+
+
+def cache_lookup(cache: str, hit: bool):
+    """记录一次缓存查询结果"""
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
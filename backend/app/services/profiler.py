@@ -0,0 +1,149 @@
+"""
+按请求开启的采样式 wall-clock 性能剖析。
+
+开启条件（只对 PROFILED_ENDPOINTS 中的接口生效）：
+  - 请求头 X-Profile 等于环境变量 PROFILE_TOKEN（未设置 token 时请求头无效）；
+  - 或按 PROFILE_SAMPLE_RATE（0~1，默认 0）随机抽样。
+
+开启后由一个后台线程每 PROFILE_INTERVAL 秒读取处理该请求的线程的调用栈，直到响应（包括流式
+响应的生成器）结束，因此等待 Dify、磁盘与 Ghidra 的时间都会计入。结果以 flamegraph.pl /
+speedscope 可直接读取的折叠栈格式（"帧;帧;帧 次数"）写入 uploads/profiles/，
+响应头 X-Profile-Id 给出文件名。目录中最多保留 PROFILE_MAX_FILES 个文件。
+
+未开启时每个请求只有一次字典查找与一次比较。
+"""
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(UPLOAD_DIR, 'profiles'))
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '200'))
+# 单个请求最长采样时间（秒），超过后停止采样（防止长连接一直占用采样线程）
+PROFILE_MAX_SECONDS = 600
+
+PROFILED_ENDPOINTS = {
+    'chat.chat_with_dify': 'chat',
+    'chat.upload_file': 'upload',
+    'chat.complete_upload_session': 'upload_complete',
+    'chat.analyze_binary': 'analyze_binary',
+}
+
+
+class RequestProfiler:
+    """对单个线程做采样，累计折叠栈"""
+
+    def __init__(self, thread_id, name):
+        self.thread_id = thread_id
+        self.name = name
+        self.samples = Counter()
+        self.started = time.time()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'profiler-{name}', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        deadline = self.started + PROFILE_MAX_SECONDS
+        while not self._stop.wait(PROFILE_INTERVAL) and time.time() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        """停止采样并写出结果，可重复调用"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        elapsed = time.time() - self.started
+        try:
+            _write_profile(self.name, self.samples)
+            logger.info("Profiler: %s 采样 %s 次，耗时 %.3f 秒", self.name, sum(self.samples.values()), elapsed)
+        except OSError as e:
+            logger.error("Profiler: 写入剖析结果失败 %s: %s", self.name, e)
+
+
+def _write_profile(name, samples):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{name}.folded")
+    temp_file = f"{path}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+    os.replace(temp_file, path)
+    _enforce_retention()
+
+
+def _enforce_retention():
+    """只保留最新的 PROFILE_MAX_FILES 个结果"""
+    try:
+        entries = [os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR) if name.endswith('.folded')]
+    except OSError:
+        return
+    if len(entries) <= PROFILE_MAX_FILES:
+        return
+    entries.sort(key=lambda path: os.path.getmtime(path))
+    for path in entries[:len(entries) - PROFILE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _should_profile():
+    header = request.headers.get('X-Profile')
+    # 按字节比较：compare_digest 不接受含非 ASCII 字符的 str
+    if header and PROFILE_TOKEN and hmac.compare_digest(header.encode('utf-8'), PROFILE_TOKEN.encode('utf-8')):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def init_app(app):
+    """注册请求钩子：命中条件时在请求开始前启动采样，响应结束后写出结果"""
+
+    @app.before_request
+    def _profile_before_request():
+        label = PROFILED_ENDPOINTS.get(request.endpoint)
+        if label is None or request.method == 'OPTIONS' or not _should_profile():
+            return None
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}_{label}_{uuid.uuid4().hex[:8]}"
+        g.profiler = RequestProfiler(threading.get_ident(), name).start()
+        return None
+
+    @app.after_request
+    def _profile_after_request(response):
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            response.headers['X-Profile-Id'] = profiler.name
+            # 流式响应在生成器结束（客户端读完或断开）后才停止采样
+            response.call_on_close(profiler.stop)
+        return response
+
+    @app.teardown_request
+    def _profile_teardown(exc):
+        # 视图抛出未处理异常时 after_request 不会执行
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
@@ -0,0 +1,215 @@
+"""
+准入控制与限流。
+
+按路由类别（chat / upload / analysis）对每个用户、每个模型分别维护令牌桶，并限制同时进行的
+请求数（流式聊天在响应流结束前一直占用名额）。超限时短暂排队（不超过 RATE_LIMIT_MAX_WAIT 秒），
+仍无法放行则返回 429 与 Retry-After。状态保存在 state_backend 中，多个 gunicorn worker 共享。
+
+用户标识：客户端地址（request.remote_addr）。X-User-Id 请求头与请求中的 user 字段由客户端任意填写，
+不作为限流依据，否则每次更换取值都能得到一个新的令牌桶。部署在反向代理之后时需设置 TRUSTED_PROXIES，
+由 ProxyFix 从代理追加的 X-Forwarded-For 中取出真实地址（见 app/__init__.py），不能直接信任该请求头的第一项。
+multipart 上传请求不会读取表单，以免破坏流式解析。
+"""
+import json
+import logging
+import os
+import time
+
+from flask import g, jsonify, request
+
+from . import state_backend
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+# 超限时最多排队等待的秒数，超过则直接拒绝
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '1.0'))
+# 并发名额的最长占用时间（秒），防止 worker 异常退出后名额无法释放
+SLOT_TTL = 900
+_POLL_INTERVAL = 0.1
+
+# rate: 每秒补充的令牌数；burst: 桶容量；concurrency: 同时进行的请求上限（可省略）
+DEFAULT_LIMITS = {
+    "chat": {
+        "user": {"rate": 0.5, "burst": 10, "concurrency": 3},
+        "model": {"rate": 5, "burst": 30, "concurrency": 32},
+    },
+    "upload": {
+        "user": {"rate": 1, "burst": 20, "concurrency": 4},
+        "model": {"rate": 5, "burst": 50},
+    },
+    "analysis": {
+        "user": {"rate": 2, "burst": 30, "concurrency": 2},
+    },
+}
+
+# 视图函数 -> 路由类别；分块上传的数据块与状态查询不单独计数
+ROUTE_CLASSES = {
+    'chat.chat_with_dify': 'chat',
+    'chat.upload_file': 'upload',
+    'chat.create_upload_session': 'upload',
+    'chat.complete_upload_session': 'upload',
+    'chat.analyze_binary': 'analysis',
+    'chat.triage_binary': 'analysis',
+    'chat.get_triage_result': 'analysis',
+}
+
+
+def _load_limits():
+    """默认限额，可用环境变量 RATE_LIMITS（JSON，结构同 DEFAULT_LIMITS）按类别覆盖"""
+    limits = json.loads(json.dumps(DEFAULT_LIMITS))
+    override = os.getenv('RATE_LIMITS')
+    if override:
+        try:
+            for route_class, scopes in json.loads(override).items():
+                for scope, values in scopes.items():
+                    limits.setdefault(route_class, {}).setdefault(scope, {}).update(values)
+        except (ValueError, AttributeError) as e:
+            logger.error("Rate Limiter: RATE_LIMITS 解析失败，使用默认值: %s", e)
+    return limits
+
+
+LIMITS = _load_limits()
+
+
+class RateLimited(Exception):
+    """请求被限流"""
+
+    def __init__(self, code, route_class, scope, retry_after):
+        super().__init__(f"{route_class} 请求过于频繁，请稍后重试")
+        self.code = code
+        self.route_class = route_class
+        self.scope = scope
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+def classify(endpoint: str):
+    """返回视图函数对应的路由类别，不受限流的请求返回 None"""
+    if not endpoint:
+        return None
+    if endpoint in ROUTE_CLASSES:
+        return ROUTE_CLASSES[endpoint]
+    if endpoint.startswith('analysis.'):
+        return 'analysis'
+    return None
+
+
+def _identify():
+    """返回 (用户标识, 模型)"""
+    data = request.get_json(silent=True) if request.is_json else None
+    data = data if isinstance(data, dict) else {}
+    model = data.get('model') or request.args.get('model') or 'dify1'
+    return request.remote_addr or '-', str(model)
+
+
+def _take(backend, key, limit, route_class, scope):
+    """取一个令牌，需要等待的时间不超过 RATE_LIMIT_MAX_WAIT 时排队"""
+    allowed, wait = backend.take_token(key, limit['rate'], limit['burst'])
+    if allowed:
+        return
+    if wait <= RATE_LIMIT_MAX_WAIT:
+        time.sleep(wait)
+        allowed, wait = backend.take_token(key, limit['rate'], limit['burst'])
+        if allowed:
+            return
+    raise RateLimited('rate_limited', route_class, scope, wait)
+
+
+def _acquire_slot(backend, key, limit, route_class, scope):
+    """占用一个并发名额，名额已满时在 RATE_LIMIT_MAX_WAIT 内轮询等待"""
+    deadline = time.time() + RATE_LIMIT_MAX_WAIT
+    while True:
+        token = backend.acquire_slot(key, int(limit['concurrency']), SLOT_TTL)
+        if token:
+            return token
+        if time.time() >= deadline:
+            raise RateLimited('too_many_concurrent', route_class, scope, 1)
+        time.sleep(_POLL_INTERVAL)
+
+
+def admit(route_class: str, user: str, model: str) -> list:
+    """
+    对一次请求执行准入检查。
+
+    Returns:
+        list: 占用的并发名额 [(key, token)]，请求结束时交给 release()。
+
+    Raises:
+        RateLimited: 令牌不足或并发已满。
+    """
+    backend = state_backend.get_backend()
+    scopes = LIMITS.get(route_class, {})
+    subjects = {"user": user, "model": model}
+    for scope, limit in scopes.items():
+        if 'rate' in limit and 'burst' in limit:
+            _take(backend, f"rl:{route_class}:{scope}:{subjects[scope]}", limit, route_class, scope)
+
+    slots = []
+    try:
+        for scope, limit in scopes.items():
+            if limit.get('concurrency'):
+                key = f"cc:{route_class}:{scope}:{subjects[scope]}"
+                slots.append((key, _acquire_slot(backend, key, limit, route_class, scope)))
+    except RateLimited:
+        release(slots)
+        raise
+    return slots
+
+
+def release(slots: list):
+    """释放占用的并发名额"""
+    backend = state_backend.get_backend()
+    for key, token in slots:
+        try:
+            backend.release_slot(key, token)
+        except Exception as e:
+            logger.error("Rate Limiter: 释放并发名额失败 (%s): %s", key, e)
+
+
+def _release_request_slots():
+    slots = g.pop('rate_limit_slots', None)
+    if slots:
+        release(slots)
+
+
+def init_app(app):
+    """注册请求钩子：请求开始前准入检查，响应（含流式响应）结束后释放并发名额"""
+    if not RATE_LIMIT_ENABLED:
+        logger.info("Rate Limiter: 已禁用")
+        return
+
+    @app.before_request
+    def _rate_limit_before_request():
+        route_class = classify(request.endpoint)
+        if route_class is None or request.method == 'OPTIONS':
+            return None
+        user, model = _identify()
+        try:
+            g.rate_limit_slots = admit(route_class, user, model)
+        except RateLimited as e:
+            # 被限流时请求量通常很大，只抽样记录
+            logger.warning("Rate Limiter: 拒绝 %s %s (%s, %s): %s/%s", request.method, request.path, user, model,
+                           e.code, e.scope, extra={"sample_rate": 0.1})
+            response = jsonify({
+                "error": str(e),
+                "code": e.code,
+                "route_class": e.route_class,
+                "scope": e.scope,
+                "retry_after": e.retry_after,
+            })
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429
+        return None
+
+    @app.after_request
+    def _rate_limit_after_request(response):
+        slots = g.pop('rate_limit_slots', None)
+        if slots:
+            # 流式响应在客户端读取完毕（或断开）后才释放名额
+            response.call_on_close(lambda: release(slots))
+        return response
+
+    @app.teardown_request
+    def _rate_limit_teardown(exc):
+        # 视图抛出未处理异常时 after_request 不会执行
+        _release_request_slots()
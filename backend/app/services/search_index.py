@@ -0,0 +1,367 @@
+"""
+对话历史的全文检索索引（SQLite FTS5，trigram 分词：中文、英文与代码标识符都可按子串检索，不区分大小写）。
+
+history_service 在每次保存消息、重命名、删除对话后同步更新索引（失败只记录日志，不影响保存）。
+索引与历史存储实现（文件或 SQLite）无关，保存在 HISTORY_SEARCH_DB_PATH（默认 history/search.db），
+已有的历史需执行一次 backend/reindex_history.py 建立索引。HISTORY_SEARCH_ENABLED=false 关闭。
+
+FTS 表是无内容表（content=''）：只保存 trigram 倒排索引，不保存消息文本的副本，索引不会抵消冷存储的压缩效果。
+结果页的摘要从历史存储读取消息原文生成（已归档的对话直接解压读取，不还原），同时用原文确认每个词确实出现。
+SQLite 3.43 以上使用 contentless_delete 直接删除索引行；更早的版本删除对话时只删除 docs 中的记录，
+残留的倒排项不会再被查到（docs.id 不复用），由下一次 reindex_history.py 清理。
+
+检索时按空白分隔的每个词都必须出现：3 个字符以上的词走 FTS 索引，结果按 bm25 相关度排序；
+更短的词（如两个汉字）只能在原文中过滤，查询全部由短词组成时从最新的消息往前最多检查 SEARCH_SCAN_LIMIT 条。
+"""
+import html
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from . import history_store, metrics
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'history')
+HISTORY_SEARCH_DB_PATH = os.getenv('HISTORY_SEARCH_DB_PATH', os.path.join(HISTORY_DIR, 'search.db'))
+HISTORY_SEARCH_ENABLED = os.getenv('HISTORY_SEARCH_ENABLED', 'true').lower() not in ('false', '0', 'no')
+
+# 新建对话的默认名称，不加入索引（否则搜索“聊天助手”会命中所有对话）
+DEFAULT_CONVERSATION_NAME = "聊天助手"
+# trigram 索引能处理的最短词长
+MIN_INDEXED_TERM = 3
+MAX_TERMS = 8
+MAX_RESULTS = 100
+# 结果摘要的字符数
+SNIPPET_CHARS = 120
+# 一次检索最多从历史存储读取原文核对的候选消息数
+SEARCH_SCAN_LIMIT = 1000
+_SCAN_BATCH = 50
+
+_SCHEMA = (
+    # seq 为消息序号（与 get_messages 返回列表的下标一致），-1 表示对话名称（名称文本保存在 name 中）；
+    # AUTOINCREMENT 保证 id 不复用，残留的倒排项不会指向新记录
+    """CREATE TABLE IF NOT EXISTS docs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        model TEXT NOT NULL,
+        conversation_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        sender TEXT,
+        timestamp TEXT,
+        name TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS docs_conversation ON docs (model, conversation_id, seq)",
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+)
+# rowid 与 docs.id 相同
+_FTS_SCHEMA = "CREATE VIRTUAL TABLE fts USING fts5(text, tokenize='trigram', content=''{options})"
+
+
+def _message_text(message) -> str:
+    text = message.get('text') if isinstance(message, dict) else None
+    if text is None:
+        return ''
+    return text if isinstance(text, str) else str(text)
+
+
+def _parse_query(query: str):
+    """拆分查询词（去掉引号与重复），最多 MAX_TERMS 个"""
+    terms = []
+    for term in query.replace('"', ' ').split():
+        if term.lower() not in (t.lower() for t in terms):
+            terms.append(term)
+    return terms[:MAX_TERMS]
+
+
+def _snippet(text: str, terms) -> str:
+    """截取第一个命中位置附近的文本，HTML 转义后用 <mark> 标出所有命中的词"""
+    text = ' '.join(text.split())
+    lower = text.lower()
+    hits = [pos for pos in (lower.find(term.lower()) for term in terms) if pos >= 0]
+    start = max(0, min(hits) - SNIPPET_CHARS // 3) if hits else 0
+    end = min(len(text), start + SNIPPET_CHARS)
+    fragment = text[start:end]
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    pieces, last = [], 0
+    for match in pattern.finditer(fragment):
+        pieces.append(html.escape(fragment[last:match.start()]))
+        pieces.append(f"<mark>{html.escape(match.group())}</mark>")
+        last = match.end()
+    pieces.append(html.escape(fragment[last:]))
+    return ('…' if start > 0 else '') + ''.join(pieces) + ('…' if end < len(text) else '')
+
+
+class SearchIndex:
+    """docs 表记录每条消息（及对话名称）的位置，fts 无内容表（rowid 与 docs.id 相同）只保存 trigram 索引"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._transaction() as conn:
+            row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'fts'").fetchone()
+            if row and "content=''" not in row[0]:
+                # 旧版本的索引保存了全文副本：删除后需重新执行 reindex_history.py
+                logger.warning("Search Index: %s 是旧格式（保存全文副本），已清空，请执行 reindex_history.py 重建", path)
+                conn.execute("DROP TABLE fts")
+                conn.execute("DROP TABLE IF EXISTS docs")
+                row = None
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            if row is None:
+                try:
+                    conn.execute(_FTS_SCHEMA.format(options=', contentless_delete=1'))
+                except sqlite3.OperationalError:
+                    conn.execute(_FTS_SCHEMA.format(options=''))
+            (sql,) = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'fts'").fetchone()
+        self._can_delete = 'contentless_delete' in sql
+
+    def _connection(self):
+        # 每个线程（以及 fork 出的每个 worker 进程）使用独立连接
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _insert(conn, model, conversation_id, seq, text, sender=None, timestamp=None):
+        if not text:
+            return
+        doc_id = conn.execute("INSERT INTO docs (model, conversation_id, seq, sender, timestamp, name) "
+                              "VALUES (?, ?, ?, ?, ?, ?)",
+                              (model, conversation_id, seq, sender, timestamp, text if seq == -1 else None)).lastrowid
+        conn.execute("INSERT INTO fts (rowid, text) VALUES (?, ?)", (doc_id, text))
+
+    def _delete(self, conn, condition, params):
+        """删除满足 condition（docs 表的条件）的索引记录"""
+        if self._can_delete:
+            conn.execute(f"DELETE FROM fts WHERE rowid IN (SELECT id FROM docs WHERE {condition})", params)
+        else:
+            # 无内容表只能凭原文删除：名称的原文保存在 docs 中，消息的倒排项留待重建索引时清理
+            conn.execute(f"INSERT INTO fts (fts, rowid, text) SELECT 'delete', id, name FROM docs "
+                         f"WHERE {condition} AND seq = -1", params)
+        conn.execute(f"DELETE FROM docs WHERE {condition}", params)
+
+    def _delete_conversation(self, conn, model, conversation_id, seq=None):
+        condition = "model = ? AND conversation_id = ?" + ("" if seq is None else " AND seq = ?")
+        self._delete(conn, condition, (model, conversation_id) if seq is None else (model, conversation_id, seq))
+
+    def index_message(self, model, conversation_id, seq, message):
+        """加入一条新保存的消息"""
+        with self._transaction() as conn:
+            self._insert(conn, model, conversation_id, seq, _message_text(message),
+                         message.get('sender'), message.get('timestamp'))
+
+    def set_name(self, model, conversation_id, name):
+        """更新对话名称（默认名称不加入索引）"""
+        with self._transaction() as conn:
+            self._delete_conversation(conn, model, conversation_id, -1)
+            if name and name != DEFAULT_CONVERSATION_NAME:
+                self._insert(conn, model, conversation_id, -1, name)
+
+    def remove_conversation(self, model, conversation_id):
+        with self._transaction() as conn:
+            self._delete_conversation(conn, model, conversation_id)
+
+    def index_conversation(self, model, conversation_id, name, messages):
+        """重建一个对话的全部索引（重建索引时使用）"""
+        self.index_conversations([(model, conversation_id, name, messages)])
+
+    def index_conversations(self, items):
+        """在一个事务中重建 items 中每个 (model, conversation_id, name, messages) 的索引（批量导入时使用）"""
+        with self._transaction() as conn:
+            for model, conversation_id, name, messages in items:
+                self._replace_conversation(conn, model, conversation_id, name, messages)
+
+    def _replace_conversation(self, conn, model, conversation_id, name, messages):
+        self._delete_conversation(conn, model, conversation_id)
+        if name and name != DEFAULT_CONVERSATION_NAME:
+            self._insert(conn, model, conversation_id, -1, name)
+        for seq, message in enumerate(messages):
+            if isinstance(message, dict):
+                self._insert(conn, model, conversation_id, seq, _message_text(message),
+                             message.get('sender'), message.get('timestamp'))
+
+    def rebuild(self, store, models=None, progress=None) -> dict:
+        """
+        从历史存储重建索引（先清空指定模型的索引，未指定 models 时清空整个索引）。
+        progress(model, 已处理数) 每处理 1000 个对话调用一次。
+        """
+        stats = {"conversations": 0, "messages": 0, "failed": 0}
+        with self._transaction() as conn:
+            if models is None:
+                conn.execute("INSERT INTO fts (fts) VALUES ('delete-all')")
+                conn.execute("DELETE FROM docs")
+            else:
+                for model in models:
+                    self._delete(conn, "model = ?", (model,))
+        for model in store.models() if models is None else models:
+            for done, conversation_id in enumerate(store.conversation_ids(model), 1):
+                try:
+                    data = store.export_conversation(model, conversation_id)
+                    if data is not None:
+                        metadata = data["metadata"] or {}
+                        self.index_conversation(model, conversation_id, metadata.get('custom_name'),
+                                                data["messages"])
+                        stats["conversations"] += 1
+                        stats["messages"] += len(data["messages"])
+                except Exception as e:
+                    stats["failed"] += 1
+                    logger.error("Search Index: 索引对话 %s/%s 失败: %s", model, conversation_id, e)
+                if progress is not None and done % 1000 == 0:
+                    progress(model, done)
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilt_at', ?)", (str(int(time.time())),))
+            # 合并 FTS 段，提高查询速度
+            conn.execute("INSERT INTO fts (fts) VALUES ('optimize')")
+        # 合并后旧段占用的页面归还给文件系统
+        conn = self._connection()
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return stats
+
+    def search(self, query: str, model: str = None, limit: int = 20, offset: int = 0, sort: str = 'relevance',
+               store=None) -> dict:
+        """
+        全文检索。sort='relevance' 按 bm25 排序（需对全部命中打分，常见词较慢），
+        'recent' 按保存时间倒序（凑够一页即停止，适合命中很多的查询）。只有短词的查询总是按时间倒序。
+        摘要与短词过滤使用 store（默认为当前历史存储）中的原文。
+
+        Returns:
+            dict: {"query", "terms", "results": [{"model", "conversation_id", "conversation_name", "seq"（-1 为名称命中）,
+                   "sender", "timestamp", "snippet"（HTML，命中处为 <mark>）, "score"}], "has_more",
+                   "scan_limited"（达到 SEARCH_SCAN_LIMIT 仍未凑够一页）, "took_ms"}
+
+        Raises:
+            ValueError: 查询为空或 sort 无效。
+        """
+        started = time.perf_counter()
+        terms = _parse_query(query or '')
+        if not terms:
+            raise ValueError("搜索内容不能为空")
+        if sort not in ('relevance', 'recent'):
+            raise ValueError("sort 只能是 relevance 或 recent")
+        limit = max(1, min(int(limit), MAX_RESULTS))
+        offset = max(0, int(offset))
+        store = store or history_store.get_store()
+
+        long_terms = [term for term in terms if len(term) >= MIN_INDEXED_TERM]
+        conditions, params = [], []
+        if long_terms:
+            conditions.append("fts MATCH ?")
+            params.append(' '.join('"' + term.replace('"', '""') + '"' for term in long_terms))
+        if model:
+            conditions.append("d.model = ?")
+            params.append(model)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        if long_terms:
+            order = "bm25(fts)" if sort == 'relevance' else "fts.rowid DESC"
+            sql = (f"SELECT d.model, d.conversation_id, d.seq, d.sender, d.timestamp, d.name, bm25(fts) "
+                   f"FROM fts JOIN docs d ON d.id = fts.rowid {where} ORDER BY {order} LIMIT ? OFFSET ?")
+        else:
+            # 只有短词：从最新的消息往前检查原文，常见词凑够一页即可停止
+            sql = (f"SELECT d.model, d.conversation_id, d.seq, d.sender, d.timestamp, d.name, NULL "
+                   f"FROM docs d {where} ORDER BY d.id DESC LIMIT ? OFFSET ?")
+        conn = self._connection()
+        lowered = [term.lower() for term in terms]
+        conversations = {}
+
+        def _text(model_name, conversation_id, seq, name):
+            if seq == -1:
+                return name or ''
+            key = (model_name, conversation_id)
+            if key not in conversations:
+                try:
+                    data = store.export_conversation(model_name, conversation_id)
+                except (ValueError, OSError) as e:
+                    logger.warning("Search Index: 读取对话 %s/%s 失败: %s", model_name, conversation_id, e)
+                    data = None
+                conversations[key] = data["messages"] if data else []
+            messages = conversations[key]
+            return _message_text(messages[seq]) if 0 <= seq < len(messages) else ''
+
+        # 逐批取出候选并用原文核对（索引可能暂时落后于历史存储），跳过前 offset 个命中
+        matches, scanned, exhausted = [], 0, False
+        while len(matches) < offset + limit + 1 and scanned < SEARCH_SCAN_LIMIT:
+            batch = min(_SCAN_BATCH, SEARCH_SCAN_LIMIT - scanned)
+            rows = conn.execute(sql, params + [batch, scanned]).fetchall()
+            scanned += len(rows)
+            for model_name, conversation_id, seq, sender, timestamp, name, rank in rows:
+                text = _text(model_name, conversation_id, seq, name)
+                lower = text.lower()
+                if text and all(term in lower for term in lowered):
+                    matches.append((model_name, conversation_id, seq, sender, timestamp, text, rank))
+            if len(rows) < batch:
+                exhausted = True
+                break
+
+        names = {}
+        results = []
+        for model_name, conversation_id, seq, sender, timestamp, text, rank in matches[offset:offset + limit]:
+            key = (model_name, conversation_id)
+            if key not in names:
+                row = conn.execute("SELECT name FROM docs WHERE model = ? AND conversation_id = ? AND seq = -1",
+                                   key).fetchone()
+                names[key] = row[0] if row else DEFAULT_CONVERSATION_NAME
+            results.append({
+                "model": model_name,
+                "conversation_id": conversation_id,
+                "conversation_name": names[key],
+                "seq": seq,
+                "sender": sender,
+                "timestamp": timestamp,
+                "snippet": _snippet(text, terms),
+                "score": round(-rank, 6) if long_terms else None,
+            })
+        elapsed = time.perf_counter() - started
+        metrics.HISTORY_SEARCH_SECONDS.observe(elapsed, mode='fts' if long_terms else 'scan')
+        return {
+            "query": query,
+            "terms": terms,
+            "results": results,
+            "has_more": len(matches) > offset + limit,
+            "scan_limited": len(matches) <= offset + limit and not exhausted,
+            "took_ms": round(elapsed * 1000, 2),
+        }
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """返回当前进程使用的搜索索引（懒加载），HISTORY_SEARCH_ENABLED=false 时返回 None"""
+    global _index
+    if not HISTORY_SEARCH_ENABLED and _index is None:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = SearchIndex(HISTORY_SEARCH_DB_PATH)
+            logger.info("Search Index: 使用 %s", HISTORY_SEARCH_DB_PATH)
+        return _index
+
+
+def set_index(index):
+    """替换搜索索引（重建索引、基准测试或测试时注入其他路径）"""
+    global _index
+    with _index_lock:
+        _index = index
@@ -0,0 +1,192 @@
+"""
+跨 worker 进程共享的轻量状态存储。
+
+提供限流等功能需要的原子操作：令牌桶、带过期时间的并发名额、计数器。
+每个存储实例有一个 epoch 标识，存储被重建（计数器从 0 重新开始）时随之改变，
+基于计数器生成的版本号（如 ETag）需要带上它，避免重建后旧版本号被误认为仍然有效。
+默认使用 SQLite（uploads/state.db，WAL 模式），gunicorn 的多个 worker 共享同一份状态；
+STATE_BACKEND=memory 时使用进程内实现，供单进程运行或测试替换（也可通过 set_backend 注入）。
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(UPLOAD_DIR, 'state.db'))
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')
+
+
+class MemoryStateBackend:
+    """进程内实现，接口与 SQLiteStateBackend 相同"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}   # key -> (tokens, updated)
+        self._slots = {}     # key -> {token: expires}
+        self._counters = {}  # key -> int
+        self.epoch = uuid.uuid4().hex[:12]
+
+    def take_token(self, key: str, rate: float, burst: float, cost: float = 1.0):
+        """
+        从令牌桶取出 cost 个令牌。
+
+        Returns:
+            tuple: (是否成功, 令牌不足时需要等待的秒数)
+        """
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+        return allowed, 0.0 if allowed else (cost - tokens) / rate
+
+    def acquire_slot(self, key: str, limit: int, ttl: float):
+        """占用一个并发名额，成功返回名额 token，已满返回 None。名额在 ttl 秒后自动失效"""
+        now = time.time()
+        with self._lock:
+            slots = {t: exp for t, exp in self._slots.get(key, {}).items() if exp > now}
+            token = None
+            if len(slots) < limit:
+                token = uuid.uuid4().hex
+                slots[token] = now + ttl
+            self._slots[key] = slots
+        return token
+
+    def release_slot(self, key: str, token: str):
+        """释放并发名额"""
+        with self._lock:
+            self._slots.get(key, {}).pop(token, None)
+
+    def count_slots(self, key: str) -> int:
+        """当前占用的并发名额数"""
+        now = time.time()
+        with self._lock:
+            return sum(1 for exp in self._slots.get(key, {}).values() if exp > now)
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        """计数器加 amount，返回新值"""
+        with self._lock:
+            value = self._counters.get(key, 0) + amount
+            self._counters[key] = value
+        return value
+
+    def get_counter(self, key: str) -> int:
+        """读取计数器，不存在时为 0"""
+        with self._lock:
+            return self._counters.get(key, 0)
+
+
+class SQLiteStateBackend:
+    """基于 SQLite 的实现，所有读-改-写操作在 BEGIN IMMEDIATE 事务中完成，跨进程原子"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS slots (key TEXT, token TEXT PRIMARY KEY, expires REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS slots_key ON slots (key, expires)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # 首次创建数据库时生成 epoch，之后各 worker 读取同一个值
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)", (uuid.uuid4().hex[:12],))
+            (self.epoch,) = conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()
+
+    def _connection(self):
+        # 每个线程（以及 fork 出的每个 worker 进程）使用独立连接
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def take_token(self, key: str, rate: float, burst: float, cost: float = 1.0):
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                         (key, tokens, now))
+        return allowed, 0.0 if allowed else (cost - tokens) / rate
+
+    def acquire_slot(self, key: str, limit: int, ttl: float):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM slots WHERE key = ? AND expires <= ?", (key, now))
+            (used,) = conn.execute("SELECT COUNT(*) FROM slots WHERE key = ?", (key,)).fetchone()
+            if used >= limit:
+                return None
+            token = uuid.uuid4().hex
+            conn.execute("INSERT INTO slots (key, token, expires) VALUES (?, ?, ?)", (key, token, now + ttl))
+        return token
+
+    def release_slot(self, key: str, token: str):
+        self._connection().execute("DELETE FROM slots WHERE token = ?", (token,))
+
+    def count_slots(self, key: str) -> int:
+        (used,) = self._connection().execute(
+            "SELECT COUNT(*) FROM slots WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        return used
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO counters (key, value) VALUES (?, ?) "
+                         "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value", (key, amount))
+            (value,) = conn.execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()
+        return value
+
+    def get_counter(self, key: str) -> int:
+        row = self._connection().execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """返回当前进程使用的状态存储（按 STATE_BACKEND 懒加载）"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if STATE_BACKEND == 'memory':
+                _backend = MemoryStateBackend()
+            else:
+                _backend = SQLiteStateBackend(STATE_DB_PATH)
+            logger.info("State Backend: 使用 %s", type(_backend).__name__)
+        return _backend
+
+
+def set_backend(backend):
+    """替换状态存储（测试或自定义部署时注入其他实现）"""
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,416 @@
+"""
+二进制快速预分析（pre-triage）服务。
+
+在 Ghidra 分析完成之前，使用纯 Python + mmap 解析 PE/ELF 头部，
+快速提取节区、导入/导出、节区熵、字符串和入口点等信息。
+结果按文件 SHA-256 缓存在 uploads/triage_cache/ 下。
+"""
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import time
+from collections import Counter, OrderedDict
+from threading import Lock
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
+TRIAGE_CACHE_DIR = os.path.join(UPLOAD_DIR, 'triage_cache')
+
+# 熵计算时每个节区最多采样的字节数（均匀分布的若干块）
+ENTROPY_SAMPLE_BYTES = 256 * 1024
+ENTROPY_SAMPLE_BLOCKS = 8
+# 字符串提取的扫描上限与数量上限，保证大文件也能在亚秒级完成
+STRING_SCAN_LIMIT = 16 * 1024 * 1024
+MAX_STRINGS = 2000
+MIN_STRING_LENGTH = 5
+MAX_IMPORTS = 5000
+MAX_EXPORTS = 5000
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_ASCII_RE = re.compile(rb'[\x20-\x7e]{%d,}' % MIN_STRING_LENGTH)
+_UTF16_RE = re.compile(rb'(?:[\x20-\x7e]\x00){%d,}' % MIN_STRING_LENGTH)
+
+# 进程内 LRU 缓存，避免重复读取磁盘缓存文件
+_MEMORY_CACHE_SIZE = 128
+_memory_cache = OrderedDict()
+_cache_lock = Lock()
+
+
+class TriageError(Exception):
+    """无法解析的二进制文件格式"""
+
+
+# --- Internal Helpers ---
+
+def _is_valid_sha256(value):
+    return bool(value) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+def _cache_path(sha256):
+    return os.path.join(TRIAGE_CACHE_DIR, f"{sha256}.json")
+
+
+def _cstring(buf, offset, limit=512):
+    """从 buf 的 offset 处读取以 NUL 结尾的 ASCII 字符串"""
+    if offset < 0 or offset >= len(buf):
+        return ''
+    end = buf.find(b'\x00', offset, min(len(buf), offset + limit))
+    if end == -1:
+        end = min(len(buf), offset + limit)
+    return buf[offset:end].decode('ascii', errors='replace')
+
+
+def _entropy(buf, offset, size):
+    """计算 [offset, offset+size) 的香农熵；大区域均匀采样以控制耗时"""
+    size = max(0, min(size, len(buf) - offset))
+    if size <= 0:
+        return 0.0
+    if size <= ENTROPY_SAMPLE_BYTES:
+        counts = Counter(buf[offset:offset + size])
+        total = size
+    else:
+        block = ENTROPY_SAMPLE_BYTES // ENTROPY_SAMPLE_BLOCKS
+        step = (size - block) // (ENTROPY_SAMPLE_BLOCKS - 1)
+        counts = Counter()
+        for i in range(ENTROPY_SAMPLE_BLOCKS):
+            start = offset + i * step
+            counts.update(buf[start:start + block])
+        total = block * ENTROPY_SAMPLE_BLOCKS
+    entropy = 0.0
+    for count in counts.values():
+        p = count / total
+        entropy -= p * math.log2(p)
+    return round(entropy, 4)
+
+
+def _extract_strings(buf):
+    """提取 ASCII 与 UTF-16LE 字符串，超过上限时截断"""
+    scan_end = min(len(buf), STRING_SCAN_LIMIT)
+    strings = []
+    truncated = scan_end < len(buf)
+    for match in _ASCII_RE.finditer(buf, 0, scan_end):
+        if len(strings) >= MAX_STRINGS:
+            truncated = True
+            break
+        strings.append({"offset": match.start(), "encoding": "ascii",
+                        "value": match.group().decode('ascii')})
+    for match in _UTF16_RE.finditer(buf, 0, scan_end):
+        if len(strings) >= MAX_STRINGS:
+            truncated = True
+            break
+        strings.append({"offset": match.start(), "encoding": "utf-16le",
+                        "value": match.group().decode('utf-16-le')})
+    return strings, truncated
+
+
+# --- PE ---
+
+_PE_MACHINES = {0x14c: 'x86', 0x8664: 'x86_64', 0x1c0: 'arm', 0xaa64: 'arm64'}
+
+
+def _pe_rva_to_offset(sections, rva):
+    for sec in sections:
+        start = sec['virtual_address']
+        span = max(sec['virtual_size'], sec['raw_size'])
+        if start <= rva < start + span:
+            return rva - start + sec['raw_offset']
+    return None
+
+
+def _parse_pe(buf):
+    e_lfanew = struct.unpack_from('<I', buf, 0x3c)[0]
+    if buf[e_lfanew:e_lfanew + 4] != b'PE\x00\x00':
+        raise TriageError("无效的PE签名")
+    coff = e_lfanew + 4
+    machine, num_sections, timestamp, _, _, opt_size, characteristics = struct.unpack_from('<HHIIIHH', buf, coff)
+    opt = coff + 20
+    magic = struct.unpack_from('<H', buf, opt)[0]
+    is_pe32_plus = magic == 0x20b
+    entry_rva = struct.unpack_from('<I', buf, opt + 16)[0]
+    if is_pe32_plus:
+        image_base = struct.unpack_from('<Q', buf, opt + 24)[0]
+        num_dirs_off, dirs_off = opt + 108, opt + 112
+    else:
+        image_base = struct.unpack_from('<I', buf, opt + 28)[0]
+        num_dirs_off, dirs_off = opt + 92, opt + 96
+    num_dirs = struct.unpack_from('<I', buf, num_dirs_off)[0]
+    data_dirs = [struct.unpack_from('<II', buf, dirs_off + i * 8) for i in range(min(num_dirs, 16))]
+
+    sections = []
+    sec_off = opt + opt_size
+    for i in range(num_sections):
+        base = sec_off + i * 40
+        name = buf[base:base + 8].rstrip(b'\x00').decode('ascii', errors='replace')
+        vsize, vaddr, raw_size, raw_offset = struct.unpack_from('<IIII', buf, base + 8)
+        flags = struct.unpack_from('<I', buf, base + 36)[0]
+        sections.append({
+            "name": name,
+            "virtual_address": vaddr,
+            "virtual_size": vsize,
+            "raw_offset": raw_offset,
+            "raw_size": raw_size,
+            "characteristics": flags,
+            "executable": bool(flags & 0x20000000),
+            "writable": bool(flags & 0x80000000),
+        })
+
+    imports = []
+    if len(data_dirs) > 1 and data_dirs[1][0]:
+        desc = _pe_rva_to_offset(sections, data_dirs[1][0])
+        thunk_size = 8 if is_pe32_plus else 4
+        ordinal_flag = 1 << (thunk_size * 8 - 1)
+        while desc is not None and desc + 20 <= len(buf) and len(imports) < MAX_IMPORTS:
+            original_first_thunk, _, _, name_rva, first_thunk = struct.unpack_from('<IIIII', buf, desc)
+            if not name_rva and not first_thunk:
+                break
+            name_off = _pe_rva_to_offset(sections, name_rva)
+            dll = _cstring(buf, name_off) if name_off is not None else ''
+            thunk = _pe_rva_to_offset(sections, original_first_thunk or first_thunk)
+            while thunk is not None and thunk + thunk_size <= len(buf) and len(imports) < MAX_IMPORTS:
+                value = struct.unpack_from('<Q' if is_pe32_plus else '<I', buf, thunk)[0]
+                if not value:
+                    break
+                if value & ordinal_flag:
+                    imports.append({"library": dll, "name": None, "ordinal": value & 0xffff})
+                else:
+                    hint_off = _pe_rva_to_offset(sections, value & 0x7fffffff)
+                    name = _cstring(buf, hint_off + 2) if hint_off is not None else ''
+                    imports.append({"library": dll, "name": name, "ordinal": None})
+                thunk += thunk_size
+            desc += 20
+
+    exports = []
+    if data_dirs and data_dirs[0][0]:
+        exp = _pe_rva_to_offset(sections, data_dirs[0][0])
+        if exp is not None and exp + 40 <= len(buf):
+            ordinal_base, _, num_names, funcs_rva, names_rva, ordinals_rva = struct.unpack_from('<IIIIII', buf, exp + 16)
+            names_off = _pe_rva_to_offset(sections, names_rva)
+            ordinals_off = _pe_rva_to_offset(sections, ordinals_rva)
+            funcs_off = _pe_rva_to_offset(sections, funcs_rva)
+            if names_off is not None and ordinals_off is not None and funcs_off is not None:
+                for i in range(min(num_names, MAX_EXPORTS)):
+                    name_off = _pe_rva_to_offset(sections, struct.unpack_from('<I', buf, names_off + i * 4)[0])
+                    ordinal = struct.unpack_from('<H', buf, ordinals_off + i * 2)[0]
+                    func_rva = struct.unpack_from('<I', buf, funcs_off + ordinal * 4)[0]
+                    exports.append({
+                        "name": _cstring(buf, name_off) if name_off is not None else '',
+                        "ordinal": ordinal + ordinal_base,
+                        "address": hex(image_base + func_rva),
+                    })
+
+    for sec in sections:
+        sec['entropy'] = _entropy(buf, sec['raw_offset'], sec['raw_size'])
+
+    return {
+        "format": "PE",
+        "arch": _PE_MACHINES.get(machine, hex(machine)),
+        "bits": 64 if is_pe32_plus else 32,
+        "is_dll": bool(characteristics & 0x2000),
+        "timestamp": timestamp,
+        "image_base": hex(image_base),
+        "entry_point": hex(image_base + entry_rva),
+        "sections": sections,
+        "imports": imports,
+        "exports": exports,
+    }
+
+
+# --- ELF ---
+
+_ELF_MACHINES = {3: 'x86', 62: 'x86_64', 40: 'arm', 183: 'arm64', 8: 'mips', 20: 'ppc', 21: 'ppc64', 243: 'riscv'}
+
+
+def _parse_elf(buf):
+    ei_class, ei_data = buf[4], buf[5]
+    if ei_class not in (1, 2) or ei_data not in (1, 2):
+        raise TriageError("无效的ELF头部")
+    is64 = ei_class == 2
+    end = '<' if ei_data == 1 else '>'
+    if is64:
+        e_type, e_machine, _, e_entry, _, e_shoff, _, _, _, _, e_shentsize, e_shnum, e_shstrndx = \
+            struct.unpack_from(end + 'HHIQQQIHHHHHH', buf, 16)
+        sh_fmt = end + 'IIQQQQIIQQ'
+    else:
+        e_type, e_machine, _, e_entry, _, e_shoff, _, _, _, _, e_shentsize, e_shnum, e_shstrndx = \
+            struct.unpack_from(end + 'HHIIIIIHHHHHH', buf, 16)
+        sh_fmt = end + 'IIIIIIIIII'
+
+    raw_sections = []
+    if e_shoff and e_shnum and e_shoff + e_shnum * e_shentsize <= len(buf):
+        for i in range(e_shnum):
+            raw_sections.append(struct.unpack_from(sh_fmt, buf, e_shoff + i * e_shentsize))
+
+    shstr_off = raw_sections[e_shstrndx][4] if e_shstrndx < len(raw_sections) else None
+    sections = []
+    for name_idx, sh_type, flags, addr, offset, size, link, _, _, entsize in raw_sections:
+        sections.append({
+            "name": _cstring(buf, shstr_off + name_idx) if shstr_off is not None else '',
+            "type": sh_type,
+            "virtual_address": addr,
+            "raw_offset": offset,
+            # SHT_NOBITS (.bss) 在文件中不占空间
+            "raw_size": 0 if sh_type == 8 else size,
+            "executable": bool(flags & 0x4),
+            "writable": bool(flags & 0x1),
+            "entropy": 0.0 if sh_type == 8 else _entropy(buf, offset, size),
+        })
+
+    imports, exports, needed = [], [], []
+    sym_fmt = end + ('IBBHQQ' if is64 else 'IIIBBH')
+    sym_size = 24 if is64 else 16
+    for sec_index, (_, sh_type, _, _, offset, size, link, _, _, _) in enumerate(raw_sections):
+        # SHT_DYNSYM = 11
+        if sh_type == 11 and link < len(raw_sections):
+            str_off = raw_sections[link][4]
+            for i in range(1, min(size // sym_size, MAX_IMPORTS + MAX_EXPORTS)):
+                fields = struct.unpack_from(sym_fmt, buf, offset + i * sym_size)
+                if is64:
+                    st_name, st_info, _, st_shndx, st_value, _ = fields
+                else:
+                    st_name, st_value, _, st_info, _, st_shndx = fields
+                name = _cstring(buf, str_off + st_name)
+                if not name:
+                    continue
+                bind, sym_type = st_info >> 4, st_info & 0xf
+                if st_shndx == 0:
+                    if len(imports) < MAX_IMPORTS:
+                        imports.append({"library": None, "name": name, "ordinal": None})
+                elif bind in (1, 2) and sym_type in (1, 2) and len(exports) < MAX_EXPORTS:
+                    exports.append({"name": name, "ordinal": None, "address": hex(st_value)})
+        # SHT_DYNAMIC = 6，DT_NEEDED = 1
+        elif sh_type == 6 and link < len(raw_sections):
+            str_off = raw_sections[link][4]
+            dyn_fmt = end + ('qQ' if is64 else 'iI')
+            dyn_size = 16 if is64 else 8
+            for i in range(size // dyn_size):
+                tag, value = struct.unpack_from(dyn_fmt, buf, offset + i * dyn_size)
+                if tag == 0:
+                    break
+                if tag == 1:
+                    needed.append(_cstring(buf, str_off + value))
+
+    return {
+        "format": "ELF",
+        "arch": _ELF_MACHINES.get(e_machine, str(e_machine)),
+        "bits": 64 if is64 else 32,
+        "is_dll": e_type == 3,
+        "entry_point": hex(e_entry),
+        "sections": sections,
+        "imports": imports,
+        "exports": exports,
+        "needed_libraries": needed,
+    }
+
+
+def _parse(buf):
+    if buf[:2] == b'MZ' and len(buf) >= 0x40:
+        return _parse_pe(buf)
+    if buf[:4] == b'\x7fELF' and len(buf) >= 52:
+        return _parse_elf(buf)
+    raise TriageError("不支持的文件格式（仅支持PE/ELF）")
+
+
+# --- Public Service Functions ---
+
+def compute_sha256(file_path: str) -> str:
+    """分块计算文件的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_cached_triage(sha256: str):
+    """按哈希读取缓存的预分析结果，未命中返回 None"""
+    sha256 = (sha256 or '').lower()
+    if not _is_valid_sha256(sha256):
+        return None
+    with _cache_lock:
+        if sha256 in _memory_cache:
+            _memory_cache.move_to_end(sha256)
+            metrics.cache_lookup('triage', True)
+            return _memory_cache[sha256]
+    path = _cache_path(sha256)
+    if not os.path.exists(path):
+        metrics.cache_lookup('triage', False)
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            result = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error("Triage Service: 读取缓存失败 %s: %s", path, e)
+        metrics.cache_lookup('triage', False)
+        return None
+    metrics.cache_lookup('triage', True)
+    _remember(sha256, result)
+    return result
+
+
+def _remember(sha256, result):
+    with _cache_lock:
+        _memory_cache[sha256] = result
+        _memory_cache.move_to_end(sha256)
+        while len(_memory_cache) > _MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def triage_file(file_path: str, sha256: str = None) -> dict:
+    """
+    对二进制文件进行快速预分析，结果按 SHA-256 缓存。
+
+    Args:
+        file_path: 二进制文件路径。
+        sha256: 已知的文件哈希（可选，避免重复计算）。
+
+    Returns:
+        dict: 包含格式、入口点、节区、导入/导出、字符串等信息。
+
+    Raises:
+        TriageError: 文件不是可识别的 PE/ELF 格式。
+    """
+    sha256 = sha256 or compute_sha256(file_path)
+    cached = get_cached_triage(sha256)
+    if cached is not None:
+        return cached
+
+    start = time.perf_counter()
+    file_size = os.path.getsize(file_path)
+    if file_size == 0:
+        raise TriageError("文件为空")
+
+    with open(file_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            try:
+                result = _parse(buf)
+            except (struct.error, IndexError) as e:
+                raise TriageError(f"文件头部损坏: {e}")
+            strings, strings_truncated = _extract_strings(buf)
+
+    result.update({
+        "sha256": sha256,
+        "file_size": file_size,
+        "strings": strings,
+        "strings_truncated": strings_truncated,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 2),
+    })
+
+    try:
+        os.makedirs(TRIAGE_CACHE_DIR, exist_ok=True)
+        tmp_path = _cache_path(sha256) + f".{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False)
+        os.replace(tmp_path, _cache_path(sha256))
+    except OSError as e:
+        logger.error("Triage Service: 写入缓存失败: %s", e)
+
+    _remember(sha256, result)
+    return result
@@ -0,0 +1,387 @@
+"""
+流式上传服务：边接收边写盘并计算 SHA-256，支持分块断点续传，
+以及不落盘地增量解析 multipart 请求体（MultipartStream）。
+
+分块上传流程：
+  1. create_upload() 创建会话，返回 upload_id；
+  2. append_chunk() 按偏移量追加数据块（偏移不匹配时返回当前偏移，客户端据此续传）；
+  3. complete_upload() 校验大小并返回内容哈希，文件留在暂存区由调用方转存（二进制进入 Blob 存储）。
+未完成的数据保存在 uploads/partial/<upload_id>.part，会话元数据保存在同名 .json 中。
+"""
+import hashlib
+import json
+import os
+import time
+import uuid
+from threading import Lock
+
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+from werkzeug.utils import secure_filename
+
+from .locking import file_lock
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
+PARTIAL_DIR = os.path.join(UPLOAD_DIR, 'partial')
+# 单个文件的大小上限（字节）
+MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', str(1024 * 1024 * 1024)))
+STREAM_CHUNK_SIZE = 1024 * 1024
+# 建议客户端使用的分块大小
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# 超过该时间未活动的未完成上传会被清理（秒）
+UPLOAD_EXPIRY_SECONDS = 24 * 3600
+# multipart 请求中普通表单字段的总大小上限（字节）
+MAX_FORM_FIELDS_SIZE = 1024 * 1024
+
+# 进程内的增量哈希状态 {upload_id: (已哈希字节数, hashlib 对象)}
+_hashers = {}
+_hashers_lock = Lock()
+
+
+class UploadError(Exception):
+    """上传失败，status 为建议的 HTTP 状态码"""
+
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+def save_stream(stream, dest_path: str, max_size: int = None):
+    """
+    将输入流写入 dest_path，同时计算 SHA-256 并在超出大小上限时中止。
+
+    Returns:
+        tuple: (sha256, size)
+
+    Raises:
+        UploadError: 超出大小上限（已写入的部分会被删除）。
+    """
+    max_size = max_size or MAX_UPLOAD_SIZE
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadError(f"文件超过大小上限 {max_size} 字节", status=413)
+                digest.update(chunk)
+                f.write(chunk)
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return digest.hexdigest(), size
+
+
+class MultipartStream:
+    """
+    增量解析 multipart/form-data 请求体，文件部分以类文件对象的方式按需读取，
+    不经过内存整体缓存或临时文件。读取文件内容时同步计算 SHA-256 并检查大小上限。
+
+    用法：next_file() 前进到下一个文件部分（途中遇到的普通字段记录在 fields 中），
+    随后用 read() 读取该文件的内容；drain() 读完剩余部分以收集文件之后的字段。
+    """
+
+    def __init__(self, stream, boundary: bytes, max_size: int = None):
+        self._stream = stream
+        self._decoder = MultipartDecoder(boundary)
+        self._pending = bytearray()
+        self._part = None
+        self._part_done = True
+        self._field_size = 0
+        self._finished = False
+        self._digest = None
+        self.max_size = max_size or MAX_UPLOAD_SIZE
+        self.fields = {}
+        self.field_name = None
+        self.filename = None
+        self.size = 0
+
+    def _next_event(self):
+        while True:
+            try:
+                event = self._decoder.next_event()
+            except ValueError as e:
+                raise UploadError(f"请求体格式错误: {e}")
+            if not isinstance(event, NeedData):
+                return event
+            if self._decoder.complete:
+                raise UploadError("请求体不完整")
+            data = self._stream.read(STREAM_CHUNK_SIZE)
+            self._decoder.receive_data(data or None)
+
+    def _advance(self):
+        """处理一个事件并返回它，请求体结束时返回 Epilogue"""
+        event = self._next_event()
+        if isinstance(event, Epilogue):
+            self._finished = True
+        elif isinstance(event, (Field, File)):
+            self._part = event
+            self._part_done = False
+            self._pending = bytearray()
+        elif isinstance(event, Data):
+            self._pending.extend(event.data)
+            if isinstance(self._part, Field):
+                self._field_size += len(event.data)
+                if self._field_size > MAX_FORM_FIELDS_SIZE:
+                    raise UploadError("表单字段过大", status=413)
+            if not event.more_data:
+                self._part_done = True
+                if isinstance(self._part, Field):
+                    self.fields[self._part.name] = self._pending.decode('utf-8', 'replace')
+                    self._pending = bytearray()
+        return event
+
+    def next_file(self):
+        """前进到下一个文件部分并返回其表单字段名，没有更多文件时返回 None"""
+        # 跳过当前文件未读取的内容
+        while isinstance(self._part, File) and not self._part_done:
+            self._pending = bytearray()
+            self._advance()
+        while not self._finished:
+            event = self._advance()
+            if isinstance(event, File):
+                self.field_name = event.name
+                self.filename = event.filename or ''
+                self.size = 0
+                self._digest = hashlib.sha256()
+                return self.field_name
+        return None
+
+    def read(self, size: int = -1) -> bytes:
+        """读取当前文件部分的内容，读完返回 b''"""
+        if not isinstance(self._part, File):
+            return b''
+        while not self._pending and not self._part_done:
+            self._advance()
+        if size is None or size < 0 or size >= len(self._pending):
+            chunk = bytes(self._pending)
+            self._pending = bytearray()
+        else:
+            chunk = bytes(self._pending[:size])
+            del self._pending[:size]
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise UploadError(f"文件超过大小上限 {self.max_size} 字节", status=413)
+        self._digest.update(chunk)
+        return chunk
+
+    def sha256(self) -> str:
+        """当前文件已读取内容的 SHA-256"""
+        return self._digest.hexdigest() if self._digest else None
+
+    def drain(self):
+        """
+        读完请求体剩余部分（丢弃当前文件未读取的内容与后续文件），收集文件之后的普通字段。
+        当前文件的 filename、size 与 sha256() 保持不变。
+        """
+        while not self._finished:
+            self._advance()
+            if isinstance(self._part, File):
+                self._pending = bytearray()
+
+
+def staging_path(filename: str) -> str:
+    """返回一个唯一的暂存路径，上传内容先写到这里再转存，避免覆盖 uploads/ 中的同名文件"""
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    return os.path.join(PARTIAL_DIR, f"{uuid.uuid4().hex}.staged_{secure_filename(filename)}")
+
+
+# --- Chunked Upload Sessions ---
+
+def _session_paths(upload_id):
+    if not upload_id or secure_filename(upload_id) != upload_id:
+        raise UploadError("无效的上传ID")
+    base = os.path.join(PARTIAL_DIR, upload_id)
+    return f"{base}.json", f"{base}.part", f"{base}.lock"
+
+
+def _load_session(upload_id):
+    meta_path, part_path, _ = _session_paths(upload_id)
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            session = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        raise UploadError("上传会话不存在或已过期", status=404)
+    session['offset'] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return session
+
+
+def _get_hasher(upload_id, part_path, offset):
+    """返回与当前偏移一致的增量哈希对象；进程内状态缺失或落后时从磁盘补齐"""
+    with _hashers_lock:
+        state = _hashers.get(upload_id)
+    if state and state[0] == offset:
+        return state[1]
+    digest = hashlib.sha256()
+    remaining = offset
+    with open(part_path, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest
+
+
+def create_upload(filename: str, total_size: int, metadata: dict = None) -> dict:
+    """创建分块上传会话"""
+    filename = secure_filename(filename or '')
+    if not filename:
+        raise UploadError("无效的文件名")
+    if total_size is None or total_size < 0:
+        raise UploadError("缺少有效的文件大小")
+    if total_size > MAX_UPLOAD_SIZE:
+        raise UploadError(f"文件超过大小上限 {MAX_UPLOAD_SIZE} 字节", status=413)
+
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    cleanup_expired_uploads()
+    upload_id = uuid.uuid4().hex
+    meta_path, part_path, _ = _session_paths(upload_id)
+    session = {
+        "upload_id": upload_id,
+        "filename": filename,
+        "size": total_size,
+        "created": time.time(),
+        "metadata": metadata or {},
+    }
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(session, f, ensure_ascii=False)
+    open(part_path, 'wb').close()
+    return {**session, "offset": 0, "chunk_size": DEFAULT_CHUNK_SIZE}
+
+
+def get_upload_status(upload_id: str) -> dict:
+    """返回上传会话状态（含已接收的偏移量）"""
+    return _load_session(upload_id)
+
+
+def append_chunk(upload_id: str, offset: int, stream) -> dict:
+    """
+    在 offset 处追加数据块，边写边更新哈希。
+
+    Raises:
+        UploadError: 会话不存在(404)、偏移不匹配(409，details 中含当前 offset)、超出声明大小(413)。
+    """
+    _, part_path, lock_path = _session_paths(upload_id)
+    with file_lock(lock_path):
+        session = _load_session(upload_id)
+        current = session['offset']
+        if offset != current:
+            raise UploadError("偏移量不匹配", status=409, offset=current)
+        digest = _get_hasher(upload_id, part_path, current)
+        written = current
+        try:
+            with open(part_path, 'ab') as f:
+                while True:
+                    chunk = stream.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if written + len(chunk) > session['size']:
+                        raise UploadError("数据超出声明的文件大小", status=413, offset=written)
+                    f.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+        except Exception:
+            # 超限或连接中断：截断到最后一个完整写入的位置，客户端可从该偏移续传
+            with open(part_path, 'ab') as f:
+                f.truncate(written)
+            raise
+        finally:
+            with _hashers_lock:
+                _hashers[upload_id] = (written, digest)
+            # 刷新元数据与锁文件的修改时间，活动中的会话不会被当作过期清理
+            os.utime(_session_paths(upload_id)[0])
+            os.utime(lock_path)
+    return {**session, "offset": written}
+
+
+def complete_upload(upload_id: str) -> dict:
+    """
+    完成上传：校验大小并返回内容哈希。文件被重命名为暂存路径，由调用方转存或删除。
+
+    Returns:
+        dict: {"filename", "path"（暂存路径）, "size", "sha256", "metadata"}
+    """
+    meta_path, part_path, lock_path = _session_paths(upload_id)
+    with file_lock(lock_path):
+        session = _load_session(upload_id)
+        if session['offset'] != session['size']:
+            raise UploadError("上传尚未完成", status=409, offset=session['offset'])
+        digest = _get_hasher(upload_id, part_path, session['offset'])
+        dest_path = staging_path(session['filename'])
+        os.replace(part_path, dest_path)
+        os.remove(meta_path)
+        with _hashers_lock:
+            _hashers.pop(upload_id, None)
+    try:
+        os.remove(lock_path)
+    except OSError:
+        pass
+    return {
+        "filename": session['filename'],
+        "path": dest_path,
+        "size": session['size'],
+        "sha256": digest.hexdigest(),
+        "metadata": session.get('metadata', {}),
+    }
+
+
+def _session_mtime(upload_id):
+    """会话各文件中最新的修改时间"""
+    mtimes = []
+    for path in _session_paths(upload_id):
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            pass
+    return max(mtimes, default=0)
+
+
+def cleanup_expired_uploads():
+    """
+    删除超过有效期的未完成上传。会话的元数据、数据与锁文件都超过有效期未修改时才会被删除，
+    并且在会话锁内进行（正在追加数据的会话会被跳过）；其他残留的暂存文件按各自的修改时间删除。
+    """
+    if not os.path.isdir(PARTIAL_DIR):
+        return
+    cutoff = time.time() - UPLOAD_EXPIRY_SECONDS
+    sessions = set()
+    for entry in os.scandir(PARTIAL_DIR):
+        upload_id, ext = os.path.splitext(entry.name)
+        if ext in ('.json', '.part', '.lock') and '.' not in upload_id:
+            sessions.add(upload_id)
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+    for upload_id in sessions:
+        try:
+            meta_path, part_path, lock_path = _session_paths(upload_id)
+        except UploadError:
+            continue
+        if _session_mtime(upload_id) >= cutoff:
+            continue
+        with file_lock(lock_path, blocking=False) as acquired:
+            # 获取锁期间可能有数据块刚写完，锁内再确认一次
+            if not acquired or _session_mtime(upload_id) >= cutoff:
+                continue
+            for path in (meta_path, part_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            with _hashers_lock:
+                _hashers.pop(upload_id, None)
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
@@ -0,0 +1,287 @@
+"""
+Dify 上游端点路由与熔断。
+
+一个模型可以配置多个 Dify 端点（见 config.get_model_endpoints）。新对话按
+“(在途请求数 + 1) × 首字节延迟 EWMA” 选择得分最低的可用端点；
+已绑定端点的对话（Dify 对话 ID 只在其所属实例有效）始终路由到绑定的端点。
+
+每个端点有一个熔断器：
+  closed     正常放行；最近窗口内错误率或慢调用比例超过阈值、或连续失败过多时转为 open；
+  open       直接拒绝（调用方立即返回 UpstreamUnavailable），持续时间按连续熔断次数指数增长；
+  half_open  open 到期后只放行少量探测请求，探测成功转为 closed，失败重新 open。
+
+统计信息保存在进程内，每个 worker 进程独立观测与决策。
+"""
+import logging
+import os
+import random
+import time
+from collections import deque, namedtuple
+from threading import Lock
+
+from .. import config as app_config
+
+logger = logging.getLogger(__name__)
+
+# EWMA 平滑系数，越大对最近一次观测越敏感
+EWMA_ALPHA = 0.3
+
+# 熔断阈值
+BREAKER_WINDOW_SECONDS = 60
+BREAKER_MIN_REQUESTS = int(os.getenv('DIFY_BREAKER_MIN_REQUESTS', '10'))
+BREAKER_ERROR_RATE = float(os.getenv('DIFY_BREAKER_ERROR_RATE', '0.5'))
+BREAKER_CONSECUTIVE_FAILURES = int(os.getenv('DIFY_BREAKER_CONSECUTIVE_FAILURES', '5'))
+# 首字节延迟超过该值（秒）视为慢调用，慢调用比例超过阈值同样熔断
+BREAKER_SLOW_SECONDS = float(os.getenv('DIFY_BREAKER_SLOW_SECONDS', '20'))
+BREAKER_SLOW_RATE = float(os.getenv('DIFY_BREAKER_SLOW_RATE', '0.8'))
+# open 持续时长（秒）：首次 BASE，连续熔断时翻倍，不超过 MAX
+BREAKER_OPEN_SECONDS = float(os.getenv('DIFY_BREAKER_OPEN_SECONDS', '30'))
+BREAKER_MAX_OPEN_SECONDS = 300
+# half_open 状态下同时放行的探测请求数
+HALF_OPEN_PROBES = 1
+# 没有首字节延迟观测的端点（刚启动、新加入、只处理上传或只失败过）按同模型其他端点的平均延迟计分，
+# 同模型都没有观测时使用该默认值（秒），此时相当于按在途请求数排序
+DEFAULT_LATENCY_SECONDS = float(os.getenv('DIFY_DEFAULT_LATENCY_SECONDS', '1.0'))
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+_stats = {}  # {(model, endpoint_id): dict}
+_lock = Lock()
+
+# acquire() 放行后返回的凭据，release() 时交回；probe 为探测请求所属的 half_open 轮次，普通请求为 None
+Permit = namedtuple('Permit', ['probe'])
+
+
+class UpstreamUnavailable(Exception):
+    """端点熔断或全部不可用，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, model, retry_after, reason=''):
+        super().__init__(f"{model} 上游服务暂时不可用{('：' + reason) if reason else ''}")
+        self.model = model
+        self.retry_after = max(1, int(retry_after + 0.999))
+        self.reason = reason
+
+
+def _get_stats(model, endpoint_id):
+    key = (model, endpoint_id)
+    stats = _stats.get(key)
+    if stats is None:
+        stats = _stats[key] = {
+            "outstanding": 0,
+            "ewma_latency": None,
+            "requests": 0,
+            "failures": 0,
+            "state": CLOSED,
+            "window": deque(),  # (时间, 是否成功, 是否慢调用)
+            "consecutive_failures": 0,
+            "trips": 0,
+            "open_until": 0.0,
+            "probes": 0,
+            "half_open_cycle": 0,
+        }
+    return stats
+
+
+def _refresh(stats, now):
+    """open 到期后转为 half_open，并清理窗口外的观测"""
+    if stats['state'] == OPEN and now >= stats['open_until']:
+        stats['state'] = HALF_OPEN
+        stats['probes'] = 0
+        stats['half_open_cycle'] += 1
+    window = stats['window']
+    while window and window[0][0] < now - BREAKER_WINDOW_SECONDS:
+        window.popleft()
+
+
+def _trip(model, endpoint_id, stats, now, reason):
+    duration = min(BREAKER_MAX_OPEN_SECONDS, BREAKER_OPEN_SECONDS * (2 ** stats['trips']))
+    stats['trips'] += 1
+    stats['state'] = OPEN
+    stats['open_until'] = now + duration
+    stats['probes'] = 0
+    stats['window'].clear()
+    logger.warning("Upstream Router: 端点 %s (%s) 熔断 %.0f 秒: %s", endpoint_id, model, duration, reason)
+
+
+def _close(model, endpoint_id, stats):
+    if stats['state'] != CLOSED:
+        logger.info("Upstream Router: 端点 %s (%s) 探测成功，恢复正常", endpoint_id, model)
+    stats['state'] = CLOSED
+    stats['trips'] = 0
+    stats['probes'] = 0
+    stats['consecutive_failures'] = 0
+
+
+def _evaluate(model, endpoint_id, stats, now):
+    """closed 状态下根据窗口统计判断是否需要熔断"""
+    if stats['consecutive_failures'] >= BREAKER_CONSECUTIVE_FAILURES:
+        _trip(model, endpoint_id, stats, now, f"连续失败 {stats['consecutive_failures']} 次")
+        return
+    window = stats['window']
+    if len(window) < BREAKER_MIN_REQUESTS:
+        return
+    error_rate = sum(1 for _, ok, _ in window if not ok) / len(window)
+    slow_rate = sum(1 for _, _, slow in window if slow) / len(window)
+    if error_rate >= BREAKER_ERROR_RATE:
+        _trip(model, endpoint_id, stats, now, f"错误率 {error_rate:.0%}")
+    elif slow_rate >= BREAKER_SLOW_RATE:
+        _trip(model, endpoint_id, stats, now, f"慢调用比例 {slow_rate:.0%}")
+
+
+def _score(stats, prior):
+    latency = stats['ewma_latency']
+    return (stats['outstanding'] + 1) * (prior if latency is None else latency)
+
+
+def candidates(model: str, pinned: str = None) -> list:
+    """
+    返回按优先级排序的候选端点列表（可用端点在前，熔断中的端点在后）。
+    实际能否发送请求以 acquire() 的结果为准。
+
+    Args:
+        model: 模型名称。
+        pinned: 对话绑定的端点 id。若该端点仍在配置中，只返回它（不做故障转移）。
+
+    Returns:
+        list: [{"id", "api_url", "api_key"}]，未配置端点时为空列表。
+    """
+    endpoints = app_config.get_model_endpoints(model)
+    if pinned:
+        for endpoint in endpoints:
+            if endpoint['id'] == pinned:
+                return [endpoint]
+    now = time.time()
+    with _lock:
+        all_stats = [_get_stats(model, endpoint['id']) for endpoint in endpoints]
+        measured = [stats['ewma_latency'] for stats in all_stats if stats['ewma_latency'] is not None]
+        prior = sum(measured) / len(measured) if measured else DEFAULT_LATENCY_SECONDS
+        ranked = []
+        for endpoint, stats in zip(endpoints, all_stats):
+            _refresh(stats, now)
+            # 0: closed，按得分排序；1: half_open；2: open，按最早恢复排序
+            if stats['state'] == CLOSED:
+                rank = (0, _score(stats, prior))
+            elif stats['state'] == HALF_OPEN:
+                rank = (1, 0.0)
+            else:
+                rank = (2, stats['open_until'])
+            ranked.append((rank, random.random(), endpoint))
+    ranked.sort(key=lambda item: item[:2])
+    return [item[2] for item in ranked]
+
+
+def acquire(model: str, endpoint_id: str):
+    """
+    请求开始前调用：熔断器放行时占用一个在途名额并返回 Permit，否则返回 None。
+    放行后必须以该 Permit 调用 release()，并尽量调用 record_success()/record_failure() 报告结果。
+    """
+    now = time.time()
+    with _lock:
+        stats = _get_stats(model, endpoint_id)
+        _refresh(stats, now)
+        if stats['state'] == OPEN:
+            return None
+        probe = None
+        if stats['state'] == HALF_OPEN:
+            if stats['probes'] >= HALF_OPEN_PROBES:
+                return None
+            stats['probes'] += 1
+            probe = stats['half_open_cycle']
+        stats['outstanding'] += 1
+        stats['requests'] += 1
+        return Permit(probe)
+
+
+def release(model: str, endpoint_id: str, permit: Permit):
+    """请求结束（含流式响应读取完毕）：释放在途名额"""
+    with _lock:
+        stats = _get_stats(model, endpoint_id)
+        stats['outstanding'] = max(0, stats['outstanding'] - 1)
+        # 探测请求没有报告结果就结束了（如客户端中断），归还探测名额；
+        # closed 时放行的请求以及上一轮的探测请求不占用本轮的探测名额
+        if (permit.probe is not None and stats['state'] == HALF_OPEN
+                and permit.probe == stats['half_open_cycle'] and stats['probes'] > 0):
+            stats['probes'] -= 1
+
+
+def record_success(model: str, endpoint_id: str, latency: float = None):
+    """
+    记录一次成功响应。latency 为首字节延迟（秒），用于 EWMA 与慢调用判断；
+    上传等耗时取决于数据量的请求传 None。
+    """
+    now = time.time()
+    with _lock:
+        stats = _get_stats(model, endpoint_id)
+        slow = False
+        if latency is not None:
+            previous = stats['ewma_latency']
+            stats['ewma_latency'] = latency if previous is None else previous + EWMA_ALPHA * (latency - previous)
+            slow = latency > BREAKER_SLOW_SECONDS
+        stats['consecutive_failures'] = 0
+        if stats['state'] == HALF_OPEN:
+            if slow:
+                _trip(model, endpoint_id, stats, now, f"探测请求延迟 {latency:.1f} 秒")
+            else:
+                _close(model, endpoint_id, stats)
+            return
+        stats['window'].append((now, True, slow))
+        if stats['state'] == CLOSED:
+            _refresh(stats, now)
+            _evaluate(model, endpoint_id, stats, now)
+
+
+def record_failure(model: str, endpoint_id: str):
+    """记录一次失败（连接错误、超时或 5xx）"""
+    now = time.time()
+    with _lock:
+        stats = _get_stats(model, endpoint_id)
+        stats['failures'] += 1
+        stats['consecutive_failures'] += 1
+        if stats['state'] == HALF_OPEN:
+            _trip(model, endpoint_id, stats, now, "探测请求失败")
+            return
+        stats['window'].append((now, False, False))
+        if stats['state'] == CLOSED:
+            _refresh(stats, now)
+            _evaluate(model, endpoint_id, stats, now)
+
+
+def retry_after(model: str, endpoint_ids: list) -> float:
+    """给定端点中最早恢复放行的等待秒数"""
+    now = time.time()
+    with _lock:
+        waits = []
+        for endpoint_id in endpoint_ids:
+            stats = _get_stats(model, endpoint_id)
+            _refresh(stats, now)
+            waits.append(max(0.0, stats['open_until'] - now) if stats['state'] == OPEN else 0.0)
+    return min(waits) if waits else 0.0
+
+
+def get_status() -> dict:
+    """返回各模型端点的路由与熔断状态 {model: [{id, api_url, state, outstanding, ewma_latency_ms, ...}]}"""
+    now = time.time()
+    status = {}
+    with _lock:
+        for model in app_config.get_all_configs():
+            entries = []
+            for endpoint in app_config.get_model_endpoints(model):
+                stats = _get_stats(model, endpoint['id'])
+                _refresh(stats, now)
+                window = stats['window']
+                entries.append({
+                    "id": endpoint['id'],
+                    "api_url": endpoint['api_url'],
+                    "state": stats['state'],
+                    "outstanding": stats['outstanding'],
+                    "ewma_latency_ms": round(stats['ewma_latency'] * 1000, 1) if stats['ewma_latency'] is not None else None,
+                    "requests": stats['requests'],
+                    "failures": stats['failures'],
+                    "window_requests": len(window),
+                    "window_error_rate": round(sum(1 for _, ok, _ in window if not ok) / len(window), 3) if window else 0.0,
+                    "window_slow_rate": round(sum(1 for _, _, slow in window if slow) / len(window), 3) if window else 0.0,
+                    "consecutive_failures": stats['consecutive_failures'],
+                    "retry_after": round(max(0.0, stats['open_until'] - now), 1) if stats['state'] == OPEN else 0.0,
+                })
+            status[model] = entries
+    return status
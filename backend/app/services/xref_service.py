@@ -0,0 +1,224 @@
+"""
+调用图与交叉引用索引服务。
+
+从 Ghidra 导出的 <binary>_ghidra.json 中构建函数级邻接索引（调用者/被调用者、
+导入 API 引用、字符串引用），并将精简索引持久化为 <binary>_xrefs.json，
+使各 worker 进程无需重新解析完整的反编译结果即可毫秒级回答查询。
+"""
+import json
+import logging
+import os
+import re
+from collections import OrderedDict, deque
+from threading import Lock
+
+from werkzeug.utils import secure_filename
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'uploads')
+XREF_INDEX_VERSION = 1
+DEFAULT_NEIGHBORHOOD_LIMIT = 500
+MAX_HOPS = 10
+
+# 兼容旧版导出文件：从反汇编文本中解析直接调用目标
+_DIRECT_CALL_RE = re.compile(r'^CALL\s+0x([0-9a-fA-F]+)\s*$')
+
+_INDEX_CACHE_SIZE = 16
+_index_cache = OrderedDict()
+_cache_lock = Lock()
+
+
+def _canonical_address(address):
+    """统一地址格式（去除前导零、小写），便于匹配"""
+    try:
+        return hex(int(str(address), 16))
+    except (TypeError, ValueError):
+        return str(address)
+
+
+def get_analysis_path(analysis_id: str) -> str:
+    """返回分析结果 JSON 的路径（分析ID即上传的二进制文件名）"""
+    filename = secure_filename(analysis_id or '')
+    if not filename:
+        raise ValueError("无效的分析ID")
+    return os.path.join(UPLOAD_DIR, f"{filename}_ghidra.json")
+
+
+def _get_index_path(analysis_id: str) -> str:
+    return os.path.join(UPLOAD_DIR, f"{secure_filename(analysis_id)}_xrefs.json")
+
+
+class XrefIndex:
+    """函数调用图与交叉引用的内存邻接索引"""
+
+    def __init__(self, functions):
+        # functions: {entry: {"name", "callees", "imports", "strings"}}
+        self.names = {}
+        self.by_name = {}
+        self.callees = {}
+        self.callers = {}
+        self.imports = {}
+        self.strings = {}
+        self.api_callers = {}
+
+        for entry, info in functions.items():
+            self.names[entry] = info.get('name', entry)
+            self.by_name.setdefault(self.names[entry], entry)
+            self.callees[entry] = tuple(info.get('callees', ()))
+            self.imports[entry] = info.get('imports', [])
+            self.strings[entry] = info.get('strings', [])
+            for api in self.imports[entry]:
+                self.api_callers.setdefault(api.get('name'), []).append(entry)
+
+        for entry, targets in self.callees.items():
+            for target in targets:
+                self.callers.setdefault(target, []).append(entry)
+
+    @classmethod
+    def from_analysis(cls, analysis):
+        """从 Ghidra 导出结果构建索引；旧导出缺少 callees 时回退到解析反汇编"""
+        raw_functions = analysis.get('functions', [])
+        entries = {_canonical_address(f.get('entry_point')) for f in raw_functions}
+        functions = {}
+        for func in raw_functions:
+            entry = _canonical_address(func.get('entry_point'))
+            if 'callees' in func:
+                callees = [_canonical_address(c) for c in func['callees']]
+            else:
+                callees = []
+                for line in func.get('disassembly', []):
+                    match = _DIRECT_CALL_RE.match(line.get('code', ''))
+                    if match:
+                        target = _canonical_address(match.group(1))
+                        if target in entries and target not in callees:
+                            callees.append(target)
+            functions[entry] = {
+                "name": func.get('name', entry),
+                "callees": callees,
+                "imports": [{"library": api.get('library'), "name": api.get('name')}
+                            for api in func.get('imported_apis', [])],
+                "strings": func.get('string_refs', []),
+            }
+        return cls(functions)
+
+    def to_dict(self):
+        return {
+            entry: {
+                "name": self.names[entry],
+                "callees": list(self.callees[entry]),
+                "imports": self.imports[entry],
+                "strings": self.strings[entry],
+            }
+            for entry in self.names
+        }
+
+    def resolve(self, function):
+        """接受函数名或入口地址，返回规范化的入口地址"""
+        if function in self.by_name:
+            return self.by_name[function]
+        entry = _canonical_address(function)
+        return entry if entry in self.names else None
+
+    def describe(self, entry):
+        return {"entry_point": entry, "name": self.names.get(entry, entry)}
+
+    def get_callers(self, entry):
+        return [self.describe(e) for e in self.callers.get(entry, ())]
+
+    def get_callees(self, entry):
+        return [self.describe(e) for e in self.callees.get(entry, ())]
+
+    def neighborhood(self, entry, hops=1, direction='both', limit=DEFAULT_NEIGHBORHOOD_LIMIT):
+        """BFS 获取 k 跳邻域，返回节点（含距离）与边，超过 limit 个节点时截断"""
+        hops = max(0, min(int(hops), MAX_HOPS))
+        distances = {entry: 0}
+        edges = []
+        seen_edges = set()  # 两端都展开时同一条边会从两端各访问一次
+        queue = deque([entry])
+        truncated = False
+        while queue:
+            current = queue.popleft()
+            depth = distances[current]
+            if depth >= hops:
+                continue
+            neighbors = []
+            if direction in ('both', 'callees'):
+                neighbors.extend((current, n, n) for n in self.callees.get(current, ()))
+            if direction in ('both', 'callers'):
+                neighbors.extend((n, current, n) for n in self.callers.get(current, ()))
+            for src, dst, node in neighbors:
+                if node not in distances:
+                    if len(distances) >= limit:
+                        truncated = True
+                        continue
+                    distances[node] = depth + 1
+                    queue.append(node)
+                if (src, dst) not in seen_edges:
+                    seen_edges.add((src, dst))
+                    edges.append([src, dst])
+        nodes = [{**self.describe(e), "distance": d} for e, d in distances.items()]
+        return {"nodes": nodes, "edges": edges, "truncated": truncated}
+
+
+def _load_compact_index(index_path, source_mtime):
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') == XREF_INDEX_VERSION and data.get('source_mtime') == source_mtime:
+            return XrefIndex(data.get('functions', {}))
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error("Xref Service: 读取索引文件失败 %s: %s", index_path, e)
+    return None
+
+
+def _save_compact_index(index_path, index, source_mtime):
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": XREF_INDEX_VERSION, "source_mtime": source_mtime,
+                       "functions": index.to_dict()}, f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        logger.error("Xref Service: 写入索引文件失败 %s: %s", index_path, e)
+
+
+def get_index(analysis_id: str) -> XrefIndex:
+    """
+    获取分析结果的交叉引用索引（进程内缓存 -> 磁盘精简索引 -> 重新构建）。
+
+    Raises:
+        ValueError: 分析ID无效。
+        FileNotFoundError: 分析结果不存在。
+    """
+    analysis_path = get_analysis_path(analysis_id)
+    if not os.path.exists(analysis_path):
+        raise FileNotFoundError(f"分析结果不存在: {analysis_id}")
+    source_mtime = os.path.getmtime(analysis_path)
+    cache_key = os.path.abspath(analysis_path)
+
+    with _cache_lock:
+        cached = _index_cache.get(cache_key)
+        if cached and cached[0] == source_mtime:
+            _index_cache.move_to_end(cache_key)
+            metrics.cache_lookup('xref_index_memory', True)
+            return cached[1]
+    metrics.cache_lookup('xref_index_memory', False)
+
+    index_path = _get_index_path(analysis_id)
+    index = _load_compact_index(index_path, source_mtime) if os.path.exists(index_path) else None
+    metrics.cache_lookup('xref_index_disk', index is not None)
+    if index is None:
+        with open(analysis_path, 'r', encoding='utf-8') as f:
+            index = XrefIndex.from_analysis(json.load(f))
+        _save_compact_index(index_path, index, source_mtime)
+        logger.info("Xref Service: 已为 %s 构建交叉引用索引 (%s 个函数)", analysis_id, len(index.names))
+
+    with _cache_lock:
+        _index_cache[cache_key] = (source_mtime, index)
+        _index_cache.move_to_end(cache_key)
+        while len(_index_cache) > _INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
@@ -0,0 +1,417 @@
+"""
+history_service 微基准测试。
+
+在临时目录中生成指定规模的合成历史记录（大量普通对话 + 若干超长对话），逐个测量
+history_service 各公开函数的延迟分位数与吞吐量，并测量多个线程同时写入时的表现。
+生成的历史会先建立全文索引（耗时记入 setup.reindex_seconds），search* 测量不同类型查询的延迟。
+文件存储最后会归档全部对话，记录压缩比（archive）与归档后首次访问的延迟（*_archived*）。
+结果以 JSON 输出，可用 --compare 与另一次运行（例如上一个提交，或另一种存储）的结果对比。
+--backend sqlite 时先生成同样的文件历史，再用 history_store.migrate 导入 SQLite（迁移耗时记入结果）。
+
+用法（在 backend/ 目录下）：
+    python benchmarks/bench_history.py                           # 默认规模：每模型 10000 个对话，长对话 2000 条消息
+    python benchmarks/bench_history.py --quick                   # 小规模冒烟
+    python benchmarks/bench_history.py --output before.json
+    python benchmarks/bench_history.py --output after.json --compare before.json
+    python benchmarks/bench_history.py --output file.json                                        # 对比两种存储
+    python benchmarks/bench_history.py --backend sqlite --output sqlite.json --compare file.json
+
+不会读写 backend/history 与 uploads 下的真实数据。
+"""
+import argparse
+import atexit
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BACKEND_DIR)
+
+from stats import latency_summary  # noqa: E402  （与本脚本同目录）
+
+MODEL = 'dify1'
+USER_TEXT = "请分析这个函数的控制流，并说明是否存在栈溢出风险。"
+ASSISTANT_TEXT = ("该函数首先读取用户输入到固定大小的栈缓冲区，随后调用 strcpy 复制到局部变量，"
+                  "没有检查长度，存在典型的栈溢出漏洞。建议使用 strncpy 或检查输入长度。\n") * 8
+
+
+# --- 合成数据 ---
+
+def _message(index, sender, day):
+    text = USER_TEXT if sender == 'user' else ASSISTANT_TEXT
+    return {
+        "id": f"temp-{sender}-{index}",
+        "role": sender,
+        "text": f"{text} #{index}",
+        "sender": sender,
+        "timestamp": (day + timedelta(seconds=index)).isoformat() + 'Z',
+        "model": MODEL,
+    }
+
+
+def _write_conversation(model_dir, conversation_id, day, message_count):
+    history = [{
+        "creation_time": day.isoformat() + 'Z',
+        "model": MODEL,
+        "conversation_id": conversation_id,
+        "dify_conversation_id": None,
+        "custom_name": f"{USER_TEXT[:20]}...",
+    }]
+    history.extend(_message(i, 'user' if i % 2 == 0 else 'assistant', day) for i in range(message_count))
+    # 与文件存储相同的年月分片目录
+    shard_dir = os.path.join(model_dir, f"{day:%Y}", f"{day:%m}")
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(os.path.join(shard_dir, f"{conversation_id}.json"), 'w', encoding='utf-8') as f:
+        json.dump(history, f, ensure_ascii=False, indent=2)
+
+
+def generate_tree(history_dir, conversations, long_conversations, long_messages, rng):
+    """生成合成历史目录，返回 (普通对话 ID 列表, 长对话 ID 列表)"""
+    model_dir = os.path.join(history_dir, MODEL)
+    os.makedirs(model_dir, exist_ok=True)
+    # 对话分布在过去一年，避免与基准测试中当天新建的对话混在一起
+    start = datetime.utcnow() - timedelta(days=366)
+    short_ids, long_ids = [], []
+    for i in range(conversations):
+        day = start + timedelta(days=i * 365 // max(conversations, 1))
+        conversation_id = f"{day:%Y%m%d}_{i + 1}_{rng.getrandbits(32):08x}"
+        if i < long_conversations:
+            _write_conversation(model_dir, conversation_id, day, long_messages)
+            long_ids.append(conversation_id)
+        else:
+            _write_conversation(model_dir, conversation_id, day, rng.randint(2, 40))
+            short_ids.append(conversation_id)
+    return short_ids, long_ids
+
+
+# --- 统计 ---
+
+class _LogCounter(logging.Handler):
+    """统计 history_service 输出的警告与错误（并发写入损坏文件时会大量出现），不打印"""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+_log_counter = _LogCounter()
+
+
+def summarize(latencies, elapsed, **extra):
+    result = latency_summary(latencies, elapsed)
+    result["warnings_logged"] = _log_counter.count
+    _log_counter.count = 0
+    result.update(extra)
+    return result
+
+
+def measure(func, args_list):
+    """顺序执行 func(*args)，返回 (每次耗时列表, 总耗时)"""
+    latencies = []
+    started = time.perf_counter()
+    for args in args_list:
+        t0 = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - t0)
+    return latencies, time.perf_counter() - started
+
+
+def measure_concurrent(workers, jobs):
+    """
+    jobs: 每个线程一个 [(func, args), ...] 列表，所有线程同时开始。
+    返回 (全部调用的耗时列表, 总耗时)
+    """
+    barrier = threading.Barrier(workers + 1)
+    latencies = []
+    lock = threading.Lock()
+
+    def _worker(calls):
+        local = []
+        barrier.wait()
+        for func, args in calls:
+            t0 = time.perf_counter()
+            func(*args)
+            local.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(local)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_worker, calls) for calls in jobs]
+        barrier.wait()
+        started = time.perf_counter()
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - started
+    return latencies, elapsed
+
+
+# --- 基准场景 ---
+
+def run_benchmarks(history_service, store, short_ids, long_ids, args, rng, archive):
+    results = {}
+    counter = iter(range(10 ** 9))
+    iterations = args.iterations
+
+    def new_message(sender='user'):
+        return {"sender": sender, "text": f"bench message {next(counter)}"}
+
+    def pick(ids, n):
+        return [rng.choice(ids) for _ in range(n)]
+
+    def run(name, func, args_list, **extra):
+        latencies, elapsed = measure(func, args_list)
+        results[name] = summarize(latencies, elapsed, **extra)
+        _progress(name, results[name])
+
+    created = []
+
+    def create():
+        created.append(history_service.create_new_conversation(MODEL))
+
+    run('create_new_conversation', create, [()] * iterations)
+    run('save_message', history_service.save_message,
+        [(cid, new_message(), MODEL) for cid in pick(short_ids, iterations)])
+    run('save_message_long', history_service.save_message,
+        [(cid, new_message(), MODEL) for cid in pick(long_ids, iterations)], messages=args.long_messages)
+    run('get_messages', history_service.get_messages, [(cid, MODEL) for cid in pick(short_ids, iterations)])
+    run('get_messages_long', history_service.get_messages, [(cid, MODEL) for cid in pick(long_ids, iterations)],
+        messages=args.long_messages)
+    # 增量读取：客户端已有除最后 20 条外的全部消息
+    run('get_messages_page_long', history_service.get_messages_page,
+        [(cid, MODEL, args.long_messages - 21, 50) for cid in pick(long_ids, iterations)], messages=args.long_messages)
+    run('get_conversation_metadata', history_service.get_conversation_metadata,
+        [(cid, MODEL) for cid in pick(short_ids, iterations)])
+    run('get_conversation_metadata_long', history_service.get_conversation_metadata,
+        [(cid, MODEL) for cid in pick(long_ids, iterations)], messages=args.long_messages)
+    run('update_dify_conversation_id', history_service.update_dify_conversation_id,
+        [(cid, f"dify-{i}", MODEL) for i, cid in enumerate(pick(short_ids, iterations))])
+    run('set_conversation_endpoint', history_service.set_conversation_endpoint,
+        [(cid, f"endpoint-{i % 2}", MODEL) for i, cid in enumerate(pick(short_ids, iterations))])
+    run('rename_conversation_name', history_service.rename_conversation_name,
+        [(cid, f"renamed {i}", MODEL) for i, cid in enumerate(pick(short_ids, iterations))])
+    # 列表需要读取全部对话文件，迭代次数相应减少
+    run('list_conversations', history_service.list_conversations, [(MODEL,)] * args.list_iterations,
+        conversations=len(short_ids) + len(long_ids) + len(created))
+    run('list_conversations_page', history_service.list_conversations_page, [(MODEL, 50)] * iterations)
+    run('delete_conversation', history_service.delete_conversation, [(cid, MODEL) for cid in created])
+    # 全文检索：几乎每条助手消息都命中的常见词（需对全部命中排序）、只命中一条的词、走子串扫描的两字词
+    run('search_common', history_service.search_history, [("strcpy",)] * iterations)
+    run('search_rare', history_service.search_history,
+        [(f"#{rng.randrange(args.long_messages)}",) for _ in range(iterations)])
+    run('search_short', history_service.search_history, [("漏洞",)] * iterations)
+
+    writers = args.writers
+    per_writer = max(1, iterations // writers)
+
+    # 每个线程写各自的对话
+    targets = rng.sample(short_ids, min(writers, len(short_ids)))
+    jobs = [[(history_service.save_message, (cid, new_message(), MODEL)) for _ in range(per_writer)]
+            for cid in targets]
+    latencies, elapsed = measure_concurrent(len(jobs), jobs)
+    results['concurrent_save_message'] = summarize(latencies, elapsed, writers=len(jobs))
+    _progress('concurrent_save_message', results['concurrent_save_message'])
+
+    # 所有线程写同一个对话：读-改-写没有加锁时会丢失更新，记录实际丢失的条数
+    shared = short_ids[0]
+    _log_counter.count = 0
+    before = len(history_service.get_messages(shared, MODEL))
+    jobs = [[(history_service.save_message, (shared, new_message(), MODEL)) for _ in range(per_writer)]
+            for _ in range(writers)]
+    latencies, elapsed = measure_concurrent(writers, jobs)
+    lost = before + writers * per_writer - len(history_service.get_messages(shared, MODEL))
+    results['concurrent_save_message_shared'] = summarize(latencies, elapsed, writers=writers, lost_writes=lost)
+    _progress('concurrent_save_message_shared', results['concurrent_save_message_shared'])
+
+    # 一半线程写入、一半线程读取
+    readers = max(1, writers // 2)
+    jobs = [[(history_service.save_message, (cid, new_message(), MODEL)) for _ in range(per_writer)]
+            for cid in pick(short_ids, writers - readers or 1)]
+    jobs += [[(history_service.get_messages, (cid, MODEL)) for cid in pick(short_ids, per_writer)]
+             for _ in range(readers)]
+    latencies, elapsed = measure_concurrent(len(jobs), jobs)
+    results['concurrent_mixed'] = summarize(latencies, elapsed, writers=len(jobs) - readers, readers=readers)
+    _progress('concurrent_mixed', results['concurrent_mixed'])
+
+    if hasattr(store, 'archive_idle'):
+        # 冷存储：归档全部对话，测量压缩效果与归档后首次访问（解压还原）的延迟
+        started = time.perf_counter()
+        archived = store.archive_idle(time.time() + 60)
+        archived['seconds'] = round(time.perf_counter() - started, 3)
+        archived['ratio'] = round(archived['bytes_before'] / archived['bytes_after'], 2) if archived['bytes_after'] else None
+        archive.update(archived)
+        sys.stderr.write(f"archived {archived}\n")
+        run('list_conversations_archived', history_service.list_conversations, [(MODEL,)] * args.list_iterations)
+        run('get_conversation_metadata_archived', history_service.get_conversation_metadata,
+            [(cid, MODEL) for cid in pick(short_ids, iterations)])
+        # 每个对话只有第一次访问需要还原，因此取不重复的对话
+        run('get_messages_archived_first', history_service.get_messages,
+            [(cid, MODEL) for cid in rng.sample(short_ids, min(iterations, len(short_ids)))])
+        run('get_messages_long_archived_first', history_service.get_messages, [(cid, MODEL) for cid in long_ids],
+            messages=args.long_messages)
+    return results
+
+
+def _progress(name, result):
+    sys.stderr.write(f"{name:34s} n={result['count']:<6d} p50={result['p50_ms']:9.3f}ms "
+                     f"p99={result['p99_ms']:9.3f}ms {result['throughput_ops']:10.1f} ops/s"
+                     + (f" warnings={result['warnings_logged']}" if result['warnings_logged'] else '')
+                     + (f" lost={result['lost_writes']}" if result.get('lost_writes') else '') + "\n")
+
+
+# --- 对比 ---
+
+def compare(current, baseline, threshold):
+    """打印与基线结果的对比，返回 p50 或 p90 变慢超过 threshold 倍的操作列表（p99 样本少、波动大，不参与判定）"""
+    regressions = []
+    meta = baseline.get('meta', {})
+    sys.stderr.write(f"\n对比基线 {meta.get('commit') or '?'}（{meta.get('backend', 'file')} -> "
+                     f"{current['meta'].get('backend', 'file')}）:\n")
+    sys.stderr.write(f"{'operation':34s} {'p50 old':>10s} {'p50 new':>10s} {'p90 old':>10s} {'p90 new':>10s} ratio\n")
+    for name, new in current['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if not old:
+            continue
+        ratios = [new[key] / old[key] for key in ('p50_ms', 'p90_ms') if old[key] > 0]
+        worst = max(ratios) if ratios else 1.0
+        flag = '  <-- regression' if worst > threshold else ''
+        if flag:
+            regressions.append(name)
+        sys.stderr.write(f"{name:34s} {old['p50_ms']:10.3f} {new['p50_ms']:10.3f} "
+                         f"{old['p90_ms']:10.3f} {new['p90_ms']:10.3f} {worst:5.2f}{flag}\n")
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="history_service 微基准测试")
+    parser.add_argument('--conversations', type=int, default=10000, help="每个模型的对话数量")
+    parser.add_argument('--long-conversations', type=int, default=20, help="其中超长对话的数量")
+    parser.add_argument('--long-messages', type=int, default=2000, help="超长对话的消息数")
+    parser.add_argument('--iterations', type=int, default=200, help="每项操作的调用次数")
+    parser.add_argument('--list-iterations', type=int, default=5, help="list_conversations 的调用次数")
+    parser.add_argument('--writers', type=int, default=8, help="并发写入的线程数")
+    parser.add_argument('--backend', choices=('file', 'sqlite'), default='file', help="历史存储实现")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--quick', action='store_true', help="小规模冒烟（500 个对话、长对话 200 条消息）")
+    parser.add_argument('--output', help="结果 JSON 的保存路径（默认输出到标准输出）")
+    parser.add_argument('--compare', help="基线结果 JSON，对比并在出现回退时以状态码 1 退出")
+    parser.add_argument('--threshold', type=float, default=1.25, help="判定回退的变慢倍数")
+    parser.add_argument('--keep', action='store_true', help="保留生成的临时目录")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.conversations, args.long_conversations, args.long_messages = 500, 5, 200
+        args.iterations, args.list_iterations = 50, 3
+    args.long_conversations = max(1, min(args.long_conversations, args.conversations - 1))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='bench_history_')
+    if not args.keep:
+        # 在导入应用之前注册：atexit 后注册先执行，指标模块退出时的最后一次写入完成后才删除
+        atexit.register(shutil.rmtree, workdir, True)
+    # 指标快照写到临时目录，不影响 uploads/metrics
+    os.environ['METRICS_DIR'] = os.path.join(workdir, 'metrics')
+    # 只在退出时写一次快照，避免后台写入与退出时删除临时目录交错
+    os.environ['METRICS_FLUSH_INTERVAL'] = '3600'
+    # 每次写入都会递增 state_backend 中的版本号，使用临时目录中的 SQLite（与生产相同的开销）
+    os.environ['STATE_DB_PATH'] = os.path.join(workdir, 'state.db')
+    # 每次新建/保存都会写 INFO 日志；history_service 的警告与错误只计数，记入结果的 warnings_logged
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+    os.environ['HISTORY_SEARCH_DB_PATH'] = os.path.join(workdir, 'search.db')
+
+    from app.services import blob_store, history_service, history_store, search_index
+    for module in (history_service, history_store):
+        service_logger = logging.getLogger(module.__name__)
+        service_logger.setLevel(logging.WARNING)
+        service_logger.addHandler(_log_counter)
+        service_logger.propagate = False
+    history_dir = os.path.join(workdir, 'history')
+    blob_store.BLOB_DIR = os.path.join(workdir, 'blobs')
+    blob_store.CATALOG_FILE = os.path.join(blob_store.BLOB_DIR, 'catalog.json')
+    blob_store.CATALOG_LOCK = os.path.join(blob_store.BLOB_DIR, 'catalog.lock')
+
+    started = time.perf_counter()
+    short_ids, long_ids = generate_tree(history_dir, args.conversations,
+                                        args.long_conversations, args.long_messages, rng)
+    sys.stderr.write(f"generated {args.conversations} conversations in {workdir} "
+                     f"({time.perf_counter() - started:.1f}s)\n")
+    store = history_store.FileHistoryStore(history_dir)
+    setup = {}
+    if args.backend == 'sqlite':
+        started = time.perf_counter()
+        target = history_store.SQLiteHistoryStore(os.path.join(workdir, 'history.db'))
+        migrated = history_store.migrate(store, target)
+        setup['migrate_seconds'] = round(time.perf_counter() - started, 3)
+        setup['migrated'] = migrated
+        sys.stderr.write(f"migrated to SQLite {migrated} ({setup['migrate_seconds']}s)\n")
+        store = target
+    history_store.set_store(store)
+    started = time.perf_counter()
+    setup['reindexed'] = search_index.get_index().rebuild(store)
+    setup['reindex_seconds'] = round(time.perf_counter() - started, 3)
+    setup['search_db_bytes'] = os.path.getsize(os.environ['HISTORY_SEARCH_DB_PATH'])
+    sys.stderr.write(f"indexed {setup['reindexed']} ({setup['reindex_seconds']}s)\n")
+    _log_counter.count = 0
+    archive = {}
+    results = run_benchmarks(history_service, store, short_ids, long_ids, args, rng, archive)
+    if args.keep:
+        sys.stderr.write(f"kept {workdir}\n")
+
+    report = {
+        "meta": {
+            "benchmark": "history_service",
+            "backend": args.backend,
+            "commit": _git_commit(),
+            "time": datetime.utcnow().isoformat() + 'Z',
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "params": {key: getattr(args, key) for key in
+                   ('conversations', 'long_conversations', 'long_messages', 'iterations',
+                    'list_iterations', 'writers', 'seed')},
+        "setup": setup,
+        "archive": archive,
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            sys.stderr.write(f"regressions: {', '.join(regressions)}\n")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
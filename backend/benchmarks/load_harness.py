@@ -0,0 +1,377 @@
+"""
+端到端压测：模拟多个用户对后端发起混合请求（聊天、保存消息、对话列表、读取历史、文档上传），
+统计各类请求的吞吐量、延迟分位数与错误率，以及聊天首字节时间（TTFB）和 token 速率。
+
+默认在进程内启动模拟 Dify（mock_dify.py）与 create_app() 构建的应用（多线程 WSGI），
+历史记录、上传暂存、文件 ID 缓存、指标等全部写入临时目录，限流默认关闭：
+    python benchmarks/load_harness.py --users 20 --duration 60
+    python benchmarks/load_harness.py --users 50 --ttft 1.5 --token-rate 30 --error-rate 0.02 --output run.json
+    HISTORY_BACKEND=sqlite python benchmarks/load_harness.py --users 20   # 使用 SQLite 历史存储
+
+也可以压测已部署的服务（例如不同 worker 数的 gunicorn），此时需先单独启动 mock_dify.py
+并在该服务的 config.json 中把模型指向它：
+    python benchmarks/mock_dify.py --port 5050 &
+    python benchmarks/load_harness.py --target http://127.0.0.1:5004 --users 50 --duration 120
+
+流量比例用 --mix 调整，例如 --mix chat=4,list=2,history=2,upload=1,new_conversation=1。
+每次 chat 之后按前端的行为保存用户消息与回复（计入 save）。
+"""
+import argparse
+import atexit
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import requests
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, BACKEND_DIR)
+
+import mock_dify  # noqa: E402  同目录模块
+from stats import latency_summary  # noqa: E402
+
+MODEL = 'dify1'
+OPERATIONS = ('chat', 'list', 'history', 'upload', 'new_conversation')
+DEFAULT_MIX = "chat=4,list=2,history=2,upload=1,new_conversation=1"
+QUERIES = [
+    "这个函数是否存在缓冲区溢出？",
+    "请解释 main 函数的控制流。",
+    "上传的样本调用了哪些可疑的 Windows API？",
+    "如何修复这段代码中的格式化字符串漏洞？",
+]
+
+
+class Recorder:
+    """线程安全地收集每类请求的耗时与结果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.errors = Counter()
+        self.ttfb = []
+        self.tokens = 0
+        self.stream_seconds = 0.0
+
+    def record(self, op, latency, status, ok):
+        with self._lock:
+            self.latencies[op].append(latency)
+            self.statuses[op][str(status)] += 1
+            if not ok:
+                self.errors[op] += 1
+
+    def record_stream(self, ttfb, tokens, seconds):
+        with self._lock:
+            if ttfb is not None:
+                self.ttfb.append(ttfb)
+            self.tokens += tokens
+            self.stream_seconds += seconds
+
+    def report(self, elapsed):
+        results = {}
+        for op in sorted(self.latencies):
+            summary = latency_summary(self.latencies[op], elapsed)
+            summary["errors"] = self.errors[op]
+            summary["error_rate"] = round(self.errors[op] / summary["count"], 4) if summary["count"] else 0.0
+            summary["status"] = dict(self.statuses[op])
+            results[op] = summary
+        total = sum(len(v) for v in self.latencies.values())
+        return {
+            "requests": total,
+            "throughput_rps": round(total / elapsed, 2) if elapsed > 0 else 0.0,
+            "results": results,
+            "chat_ttfb": latency_summary(self.ttfb),
+            "tokens_received": self.tokens,
+            "tokens_per_stream_second": round(self.tokens / self.stream_seconds, 2) if self.stream_seconds else 0.0,
+        }
+
+
+class VirtualUser:
+    """一个模拟用户：持有自己的对话，按权重随机执行操作"""
+
+    def __init__(self, index, base_url, args, recorder, upload_pool):
+        self.base_url = base_url.rstrip('/')
+        self.args = args
+        self.recorder = recorder
+        self.upload_pool = upload_pool
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.user = f"load-user-{index}"
+        self.session = requests.Session()
+        self.session.headers['X-User-Id'] = self.user
+        # 限流按客户端地址计数：模拟每个用户来自不同地址（进程内模式下按一层代理解析）
+        self.session.headers['X-Forwarded-For'] = f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}"
+        self.conversation_id = None
+        self.turn = 0
+
+    def _timed(self, op, method, path, ok_statuses=(200, 201), **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=self.args.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            self.recorder.record(op, time.perf_counter() - started, type(e).__name__, False)
+            return None
+        self.recorder.record(op, time.perf_counter() - started, response.status_code,
+                             response.status_code in ok_statuses)
+        return response
+
+    def new_conversation(self):
+        response = self._timed('new_conversation', 'POST', '/chat/conversations', json={"model": MODEL})
+        if response is not None and response.status_code == 201:
+            self.conversation_id = response.json().get('id')
+            self.turn = 0
+
+    def chat(self):
+        if not self.conversation_id:
+            return self.new_conversation()
+        query = f"{self.rng.choice(QUERIES)} ({self.turn})"
+        self.turn += 1
+        payload = {"query": query, "model": MODEL, "conversation_id": self.conversation_id, "user": self.user}
+        started = time.perf_counter()
+        ttfb = None
+        tokens = 0
+        answer = []
+        ok = False
+        status = None
+        try:
+            with self.session.post(f"{self.base_url}/chat", json=payload, stream=True,
+                                   timeout=self.args.timeout) as response:
+                status = response.status_code
+                buffer = b''
+                for chunk in response.iter_content(chunk_size=None):
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - started
+                    buffer += chunk
+                    *events, buffer = buffer.split(b'\n\n')
+                    for event in events:
+                        if not event.startswith(b'data:'):
+                            continue
+                        data = json.loads(event[5:])
+                        if data.get('event') == 'message':
+                            tokens += 1
+                            answer.append(data.get('answer', ''))
+                        elif data.get('event') == 'message_end':
+                            ok = True
+                        elif data.get('event') == 'error':
+                            status = 'stream_error'
+        except (requests.exceptions.RequestException, ValueError) as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+        self.recorder.record('chat', elapsed, status, ok and status == 200)
+        self.recorder.record_stream(ttfb, tokens, elapsed - (ttfb or 0))
+
+        # 与前端一致：回复结束后保存用户消息和助手回复
+        path = f"/chat/conversations/{self.conversation_id}/messages"
+        self._timed('save', 'POST', path, json={"model": MODEL, "message": {"sender": "user", "text": query}})
+        if answer:
+            self._timed('save', 'POST', path,
+                        json={"model": MODEL, "message": {"sender": "assistant", "text": ''.join(answer)}})
+
+    def list(self):
+        self._timed('list', 'GET', '/chat/conversations', params={"model": MODEL})
+
+    def history(self):
+        if self.conversation_id:
+            self._timed('history', 'GET', f"/chat/conversations/{self.conversation_id}/messages",
+                        params={"model": MODEL})
+
+    def upload(self):
+        if not self.conversation_id:
+            return self.new_conversation()
+        name, content = self.rng.choice(self.upload_pool)
+        # 表单字段在文件之前，后端可直接流式转发到 Dify
+        self._timed('upload', 'POST', '/chat/upload',
+                    data={"model": MODEL, "conversation_id": self.conversation_id, "user": self.user},
+                    files={"file": (name, content, 'text/plain')})
+
+    def run(self, deadline, operations, weights):
+        self.new_conversation()
+        while time.time() < deadline:
+            getattr(self, self.rng.choices(operations, weights)[0])()
+            if self.args.think > 0:
+                time.sleep(self.rng.uniform(0, 2 * self.args.think))
+        self.session.close()
+
+
+# --- 进程内启动 ---
+
+def _isolate(workdir):
+    """把应用的数据目录指向临时目录（需在导入 app 之前设置环境变量）"""
+    from app import config as app_config
+    from app.services import blob_store, file_id_cache, history_store, search_index, upload_service
+
+    # 与正式部署相同，按 HISTORY_BACKEND 选择历史存储
+    history_dir = os.path.join(workdir, 'history')
+    if history_store.HISTORY_BACKEND == 'sqlite':
+        history_store.set_store(history_store.SQLiteHistoryStore(os.path.join(history_dir, 'history.db')))
+    else:
+        history_store.set_store(history_store.FileHistoryStore(history_dir))
+    if search_index.HISTORY_SEARCH_ENABLED:
+        search_index.set_index(search_index.SearchIndex(os.path.join(history_dir, 'search.db')))
+    upload_service.PARTIAL_DIR = os.path.join(workdir, 'partial')
+    blob_store.BLOB_DIR = os.path.join(workdir, 'blobs')
+    blob_store.CATALOG_DB = os.path.join(blob_store.BLOB_DIR, 'catalog.db')
+    blob_store.CATALOG_FILE = os.path.join(blob_store.BLOB_DIR, 'catalog.json')
+    blob_store.CATALOG_LOCK = os.path.join(blob_store.BLOB_DIR, 'catalog.lock')
+    file_id_cache.UPLOAD_DIR = workdir
+    file_id_cache.CACHE_FILE = os.path.join(workdir, 'dify_file_cache.json')
+    file_id_cache.CACHE_LOCK = os.path.join(workdir, 'dify_file_cache.lock')
+    app_config.CONFIG_FILE = os.path.join(workdir, 'config.json')
+    app_config.CONFIG_LOCK_FILE = app_config.CONFIG_FILE + '.lock'
+    return app_config
+
+
+def start_local_stack(args, workdir):
+    """启动模拟 Dify 与应用，返回 (应用地址, 模拟 Dify 地址, 模拟 Dify 参数)"""
+    os.environ['STATE_BACKEND'] = 'memory'
+    os.environ['METRICS_DIR'] = os.path.join(workdir, 'metrics')
+    # 只在退出时写一次快照，避免后台写入与退出时删除临时目录交错
+    os.environ['METRICS_FLUSH_INTERVAL'] = '3600'
+    os.environ['PROFILE_DIR'] = os.path.join(workdir, 'profiles')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    if not args.rate_limit:
+        os.environ['RATE_LIMIT_ENABLED'] = 'false'
+    os.environ['TRUSTED_PROXIES'] = '1'
+
+    mock_app = mock_dify.create_mock_app(**mock_dify.options_from_args(args))
+    mock = mock_dify.serve(mock_app)
+    mock_url = f"http://127.0.0.1:{mock.server_port}"
+
+    app_config = _isolate(workdir)
+    with open(app_config.CONFIG_FILE, 'w', encoding='utf-8') as f:
+        json.dump({MODEL: {"api_url": f"{mock_url}/v1", "api_key": "mock-key"}}, f)
+    app_config.load_config()
+
+    from app import create_app
+    server = mock_dify.serve(create_app())
+    # 开发服务器的逐请求访问日志会淹没结果
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    return f"http://127.0.0.1:{server.server_port}", mock_url, mock_app.config['MOCK_SETTINGS']
+
+
+def _parse_mix(text):
+    operations, weights = [], []
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise SystemExit(f"unknown operation in --mix: {name}")
+        operations.append(name)
+        weights.append(float(weight or 1))
+    return operations, weights
+
+
+def _upload_pool(size, count=20):
+    """上传内容池：重复的内容会命中 Dify 文件 ID 缓存，与实际使用相近"""
+    line = "int main(int argc, char **argv) { char buf[64]; strcpy(buf, argv[1]); return 0; }\n"
+    body = (line * (size // len(line) + 1))[:size]
+    return [(f"sample_{i}.txt", f"// sample {i}\n{body}".encode('utf-8')) for i in range(count)]
+
+
+def print_report(report):
+    out = sys.stderr
+    out.write(f"\n{report['requests']} requests in {report['duration_s']}s, {report['throughput_rps']} req/s\n")
+    out.write(f"{'operation':18s} {'count':>7s} {'err%':>6s} {'rps':>8s} {'p50 ms':>9s} {'p90 ms':>9s} "
+              f"{'p99 ms':>9s} {'max ms':>9s}\n")
+    for op, r in report['results'].items():
+        out.write(f"{op:18s} {r['count']:7d} {r['error_rate'] * 100:6.2f} {r['throughput_ops']:8.2f} "
+                  f"{r['p50_ms']:9.1f} {r['p90_ms']:9.1f} {r['p99_ms']:9.1f} {r['max_ms']:9.1f}\n")
+    ttfb = report['chat_ttfb']
+    out.write(f"chat TTFB: p50 {ttfb['p50_ms']:.1f} ms, p90 {ttfb['p90_ms']:.1f} ms, p99 {ttfb['p99_ms']:.1f} ms; "
+              f"{report['tokens_per_stream_second']} tokens/s per stream\n")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="后端端到端压测（模拟 Dify）")
+    parser.add_argument('--target', help="压测已部署的服务地址；不指定时在进程内启动应用与模拟 Dify")
+    parser.add_argument('--users', type=int, default=10, help="并发用户数")
+    parser.add_argument('--duration', type=float, default=30, help="压测持续秒数")
+    parser.add_argument('--ramp', type=float, default=2, help="所有用户在该秒数内陆续启动")
+    parser.add_argument('--think', type=float, default=0.2, help="两次操作之间的平均停顿秒数")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"操作权重（默认 {DEFAULT_MIX}）")
+    parser.add_argument('--upload-size', type=int, default=32 * 1024, help="上传文档大小（字节）")
+    parser.add_argument('--timeout', type=float, default=120, help="单个请求超时秒数")
+    parser.add_argument('--rate-limit', action='store_true', help="进程内模式下保留限流（默认关闭）")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="结果 JSON 的保存路径（默认输出到标准输出）")
+    mock_dify.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    operations, weights = _parse_mix(args.mix)
+    workdir = None
+    mock_url = None
+    if args.target:
+        base_url = args.target
+    else:
+        workdir = tempfile.mkdtemp(prefix='load_harness_')
+        # 在导入应用之前注册：atexit 后注册先执行，指标模块退出时的最后一次写入完成后才删除
+        atexit.register(shutil.rmtree, workdir, True)
+        base_url, mock_url, mock_settings = start_local_stack(args, workdir)
+    sys.stderr.write(f"target {base_url}, {args.users} users for {args.duration}s, mix {args.mix}\n")
+
+    recorder = Recorder()
+    upload_pool = _upload_pool(args.upload_size)
+    started = time.time()
+    deadline = started + args.ramp + args.duration
+    threads = []
+    for index in range(args.users):
+        user = VirtualUser(index, base_url, args, recorder, upload_pool)
+        thread = threading.Thread(target=user.run, args=(deadline, operations, weights), daemon=True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(args.ramp / max(args.users, 1))
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    report = {
+        "meta": {
+            "benchmark": "load_harness",
+            "commit": _git_commit(),
+            "time": datetime.utcnow().isoformat() + 'Z',
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "target": args.target or "in-process",
+        },
+        "params": {key: getattr(args, key) for key in
+                   ('users', 'duration', 'ramp', 'think', 'mix', 'upload_size', 'rate_limit', 'seed')},
+        "duration_s": round(elapsed, 2),
+    }
+    report.update(recorder.report(elapsed))
+    if mock_url:
+        report["mock"] = {"settings": mock_settings,
+                          "stats": requests.get(f"{mock_url}/mock/stats", timeout=5).json()}
+
+    print_report(report)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+本地模拟 Dify 服务，用于压测，不调用真实大模型。
+
+实现后端用到的两个接口：
+  POST /v1/chat-messages   流式（SSE）或阻塞模式的聊天回复
+  POST /v1/files/upload    文件上传，返回随机文件 ID
+另有 GET /mock/stats 返回已处理的请求数。
+
+可调参数：首 token 延迟（ttft）、每秒 token 数（token_rate）、回复长度（tokens）、
+随机抖动（jitter，按比例）、请求失败率（error_rate，返回 500）、流中途出错率（stream_error_rate）。
+
+单独运行（例如配合 gunicorn 部署压测，config.json 中将模型的 api_url 指向 http://127.0.0.1:5050/v1）：
+    python benchmarks/mock_dify.py --port 5050 --ttft 0.8 --token-rate 40 --tokens 300
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+DEFAULTS = {
+    "ttft": 0.5,
+    "token_rate": 50.0,
+    "tokens": 200,
+    "jitter": 0.2,
+    "error_rate": 0.0,
+    "stream_error_rate": 0.0,
+    "upload_delay": 0.05,
+}
+
+TOKEN_TEXT = "分析"
+
+
+def _sse(data):
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def create_mock_app(**options):
+    """创建模拟 Dify 的 Flask 应用，options 覆盖 DEFAULTS 中的参数"""
+    settings = dict(DEFAULTS)
+    settings.update({k: v for k, v in options.items() if v is not None})
+    rng = random.Random()
+    stats = {"chat": 0, "chat_errors": 0, "stream_errors": 0, "uploads": 0, "upload_errors": 0}
+    stats_lock = threading.Lock()
+
+    app = Flask('mock_dify')
+    app.config['MOCK_SETTINGS'] = settings
+
+    def count(key):
+        with stats_lock:
+            stats[key] += 1
+
+    def jittered(seconds):
+        return max(0.0, seconds * (1 + rng.uniform(-settings['jitter'], settings['jitter'])))
+
+    def unauthorized():
+        return not request.headers.get('Authorization', '').startswith('Bearer ')
+
+    @app.route('/v1/chat-messages', methods=['POST'])
+    def chat_messages():
+        if unauthorized():
+            return jsonify({"code": "unauthorized", "message": "Access token is invalid"}), 401
+        count('chat')
+        if rng.random() < settings['error_rate']:
+            count('chat_errors')
+            return jsonify({"code": "internal_server_error", "message": "mock injected error"}), 500
+
+        data = request.get_json(silent=True) or {}
+        conversation_id = data.get('conversation_id') or str(uuid.uuid4())
+        # 本地日期格式 ID 不是 Dify 的对话 ID，与真实 Dify 一样分配新的 UUID
+        if '_' in conversation_id:
+            conversation_id = str(uuid.uuid4())
+        message_id = str(uuid.uuid4())
+        tokens = int(settings['tokens'])
+        fail_at = rng.randint(1, max(1, tokens)) if rng.random() < settings['stream_error_rate'] else None
+
+        if data.get('response_mode') == 'blocking':
+            time.sleep(jittered(settings['ttft']) + tokens / settings['token_rate'])
+            return jsonify({"event": "message", "message_id": message_id, "conversation_id": conversation_id,
+                            "answer": TOKEN_TEXT * tokens, "metadata": {"usage": {"completion_tokens": tokens}}})
+
+        def generate():
+            started = time.time()
+            time.sleep(jittered(settings['ttft']))
+            interval = 1.0 / settings['token_rate'] if settings['token_rate'] > 0 else 0
+            for i in range(tokens):
+                if fail_at is not None and i == fail_at:
+                    count('stream_errors')
+                    yield _sse({"event": "error", "message_id": message_id, "status": 500,
+                                "code": "completion_request_error", "message": "mock injected stream error"})
+                    return
+                yield _sse({"event": "message", "message_id": message_id, "conversation_id": conversation_id,
+                            "answer": TOKEN_TEXT, "created_at": int(time.time())})
+                if interval:
+                    time.sleep(jittered(interval))
+            yield _sse({"event": "message_end", "message_id": message_id, "conversation_id": conversation_id,
+                        "metadata": {"usage": {"completion_tokens": tokens,
+                                               "latency": round(time.time() - started, 3)}}})
+
+        return Response(generate(), mimetype='text/event-stream')
+
+    @app.route('/v1/files/upload', methods=['POST'])
+    def files_upload():
+        if unauthorized():
+            return jsonify({"code": "unauthorized", "message": "Access token is invalid"}), 401
+        count('uploads')
+        upload = request.files.get('file')
+        if upload is None:
+            return jsonify({"code": "no_file_uploaded", "message": "Please upload your file."}), 400
+        size = len(upload.read())
+        time.sleep(jittered(settings['upload_delay']))
+        if rng.random() < settings['error_rate']:
+            count('upload_errors')
+            return jsonify({"code": "internal_server_error", "message": "mock injected error"}), 500
+        name = upload.filename or 'file'
+        return jsonify({
+            "id": str(uuid.uuid4()),
+            "name": name,
+            "size": size,
+            "extension": name.rsplit('.', 1)[-1] if '.' in name else '',
+            "mime_type": upload.mimetype,
+            "created_by": request.form.get('user'),
+            "created_at": int(time.time()),
+        }), 201
+
+    @app.route('/mock/stats', methods=['GET'])
+    def mock_stats():
+        with stats_lock:
+            return jsonify(dict(stats))
+
+    return app
+
+
+def serve(app, host='127.0.0.1', port=0):
+    """在后台线程中启动多线程 WSGI 服务，返回 server（server.server_port 为实际端口）"""
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name=f'{app.name}-server', daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    """注册模拟服务的命令行参数（压测脚本共用）"""
+    parser.add_argument('--ttft', type=float, help=f"首 token 延迟秒数（默认 {DEFAULTS['ttft']}）")
+    parser.add_argument('--token-rate', type=float, help=f"每秒输出 token 数（默认 {DEFAULTS['token_rate']}）")
+    parser.add_argument('--tokens', type=int, help=f"每次回复的 token 数（默认 {DEFAULTS['tokens']}）")
+    parser.add_argument('--jitter', type=float, help=f"延迟随机抖动比例（默认 {DEFAULTS['jitter']}）")
+    parser.add_argument('--error-rate', type=float, help="请求直接返回 500 的比例（默认 0）")
+    parser.add_argument('--stream-error-rate', type=float, help="流中途返回 error 事件的比例（默认 0）")
+    parser.add_argument('--upload-delay', type=float, help=f"文件上传处理秒数（默认 {DEFAULTS['upload_delay']}）")
+
+
+def options_from_args(args):
+    return {key: getattr(args, key, None) for key in DEFAULTS}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="模拟 Dify 服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    app = create_mock_app(**options_from_args(args))
+    print(f"mock Dify listening on http://{args.host}:{args.port}/v1 {app.config['MOCK_SETTINGS']}")
+    make_server(args.host, args.port, app, threaded=True).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""基准测试共用的延迟统计"""
+
+
+def percentile(sorted_values, fraction):
+    """线性插值的分位数，sorted_values 需已排序"""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def latency_summary(latencies, elapsed=None):
+    """延迟（秒）列表 -> 次数、均值与分位数（毫秒）；给出总耗时 elapsed 时附带吞吐量"""
+    values = sorted(latencies)
+    result = {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 4) if values else 0.0,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 4),
+        "p90_ms": round(percentile(values, 0.90) * 1000, 4),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 4),
+        "max_ms": round(values[-1] * 1000, 4) if values else 0.0,
+    }
+    if elapsed is not None:
+        result["throughput_ops"] = round(len(values) / elapsed, 2) if elapsed > 0 else 0.0
+    return result
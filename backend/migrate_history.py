@@ -0,0 +1,45 @@
+"""
+把文件形式的对话历史（history/difyN/ 下的 JSON 文件）导入 SQLite 历史存储，或反向导出。
+
+用法（在 backend/ 目录下，迁移前先停止服务）：
+    python migrate_history.py                                  # history/ -> history/history.db
+    python migrate_history.py --db /data/history.db --models dify1 dify2
+    python migrate_history.py --reverse --history-dir /tmp/history_export   # SQLite -> 文件
+
+迁移完成后在 .env 中设置 HISTORY_BACKEND=sqlite（以及自定义路径时的 HISTORY_DB_PATH）并重启。
+目标中已存在的对话默认跳过，可重复执行；--overwrite 覆盖。原有文件不会被修改或删除。
+"""
+import argparse
+import json
+import sys
+import time
+
+from app.services import history_store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="在文件与 SQLite 历史存储之间迁移对话")
+    parser.add_argument('--history-dir', default=history_store.HISTORY_DIR, help="文件历史的根目录")
+    parser.add_argument('--db', default=history_store.HISTORY_DB_PATH, help="SQLite 数据库路径")
+    parser.add_argument('--models', nargs='*', help="只迁移指定模型（默认全部）")
+    parser.add_argument('--overwrite', action='store_true', help="覆盖目标中已存在的对话")
+    parser.add_argument('--reverse', action='store_true', help="从 SQLite 导出为文件")
+    args = parser.parse_args(argv)
+
+    file_store = history_store.FileHistoryStore(args.history_dir)
+    sqlite_store = history_store.SQLiteHistoryStore(args.db)
+    source, target = (sqlite_store, file_store) if args.reverse else (file_store, sqlite_store)
+
+    def progress(model, done):
+        sys.stderr.write(f"  {model}: {done} conversations\n")
+
+    started = time.perf_counter()
+    stats = history_store.migrate(source, target, models=args.models, overwrite=args.overwrite,
+                                  progress=progress)
+    stats["seconds"] = round(time.perf_counter() - started, 2)
+    print(json.dumps(stats, ensure_ascii=False))
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,39 @@
+"""
+从当前历史存储（HISTORY_BACKEND）重建全文检索索引（history/search.db）。
+
+用法（在 backend/ 目录下）：
+    python reindex_history.py                        # 清空并重建全部索引
+    python reindex_history.py --models dify1 dify2   # 只重建指定模型的对话
+
+首次启用全文检索、迁移历史存储或索引损坏后执行一次；之后索引随保存、重命名、删除自动更新。
+服务运行期间也可以执行，但重建过程中正在写入的对话可能漏掉个别新消息，建议在低峰期执行。
+已归档（压缩）的对话直接读取，不会被解压还原。
+"""
+import argparse
+import json
+import sys
+import time
+
+from app.services import history_store, search_index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="重建对话历史的全文检索索引")
+    parser.add_argument('--db', default=search_index.HISTORY_SEARCH_DB_PATH, help="索引数据库路径")
+    parser.add_argument('--models', nargs='*', help="只重建指定模型（默认全部并先清空索引）")
+    args = parser.parse_args(argv)
+
+    index = search_index.SearchIndex(args.db)
+
+    def progress(model, done):
+        sys.stderr.write(f"  {model}: {done} conversations\n")
+
+    started = time.perf_counter()
+    stats = index.rebuild(history_store.get_store(), models=args.models or None, progress=progress)
+    stats["seconds"] = round(time.perf_counter() - started, 2)
+    print(json.dumps(stats, ensure_ascii=False))
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# 在导入 app 之前设置：状态存储在进程内，指标、搜索索引不写入仓库目录
+_scratch = tempfile.mkdtemp(prefix='backend-tests-')
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('METRICS_DIR', os.path.join(_scratch, 'metrics'))
+os.environ.setdefault('METRICS_FLUSH_INTERVAL', '3600')
+os.environ.setdefault('HISTORY_SEARCH_ENABLED', 'false')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
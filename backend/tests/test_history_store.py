@@ -0,0 +1,203 @@
+"""
+history_service 公开函数在两种存储（FileHistoryStore、SQLiteHistoryStore）上的行为。
+"""
+import json
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from app.services import history_service, history_store
+
+MODEL = 'dify1'
+
+
+def _make_store(backend, root):
+    if backend == 'sqlite':
+        return history_store.SQLiteHistoryStore(os.path.join(root, 'history.db'))
+    return history_store.FileHistoryStore(root)
+
+
+@pytest.fixture(params=['file', 'sqlite'])
+def store(request, tmp_path):
+    store = _make_store(request.param, str(tmp_path))
+    history_store.set_store(store)
+    yield store
+    history_store.set_store(None)
+
+
+def _save(conversation_id, text, sender='user', **extra):
+    assert history_service.save_message(conversation_id, {'sender': sender, 'text': text, **extra}, MODEL)
+
+
+def _texts(messages):
+    return [message['text'] for message in messages]
+
+
+def test_create_and_read(store):
+    conversation_id = history_service.create_new_conversation(MODEL)
+    assert not conversation_id.startswith('new_')
+    _save(conversation_id, 'hello')
+    _save(conversation_id, 'hi', sender='assistant')
+
+    assert _texts(history_service.get_messages(conversation_id, MODEL)) == ['hello', 'hi']
+    metadata = history_service.get_conversation_metadata(conversation_id, MODEL)
+    assert metadata['conversation_id'] == conversation_id
+    assert history_service.rename_conversation_name(conversation_id, '样本分析', MODEL)
+    assert history_service.list_conversations(MODEL)[0]['name'] == '样本分析'
+
+
+def test_duplicate_messages_are_skipped(store):
+    conversation_id = history_service.create_new_conversation(MODEL)
+    _save(conversation_id, 'hello')
+    _save(conversation_id, 'hello')
+    _save(conversation_id, 'hello', sender='assistant')
+
+    messages = history_service.get_messages(conversation_id, MODEL)
+    assert [(m['sender'], m['text']) for m in messages] == [('user', 'hello'), ('assistant', 'hello')]
+
+
+def test_messages_page_by_index_and_id(store):
+    conversation_id = history_service.create_new_conversation(MODEL)
+    for i in range(5):
+        _save(conversation_id, f'message {i}', id=f'm{i}')
+
+    page = history_service.get_messages_page(conversation_id, MODEL, limit=2)
+    assert _texts(page['messages']) == ['message 0', 'message 1']
+    assert (page['total'], page['next_after'], page['has_more']) == (5, 1, True)
+
+    page = history_service.get_messages_page(conversation_id, MODEL, after=page['next_after'], limit=2)
+    assert _texts(page['messages']) == ['message 2', 'message 3']
+
+    page = history_service.get_messages_page(conversation_id, MODEL, after='m3', limit=10)
+    assert _texts(page['messages']) == ['message 4']
+    assert (page['next_after'], page['has_more']) == (4, False)
+
+    page = history_service.get_messages_page(conversation_id, MODEL, after=4)
+    assert page['messages'] == [] and not page['has_more']
+
+    with pytest.raises(ValueError):
+        history_service.get_messages_page(conversation_id, MODEL, after='missing')
+    assert history_service.get_messages_page('20990101_1_deadbeef', MODEL) is None
+
+
+def test_messages_page_rebuilds_stale_index(tmp_path):
+    store = history_store.FileHistoryStore(str(tmp_path))
+    history_store.set_store(store)
+    try:
+        conversation_id = history_service.create_new_conversation(MODEL)
+        for i in range(3):
+            _save(conversation_id, f'message {i}', id=f'm{i}')
+        assert history_service.get_messages_page(conversation_id, MODEL, limit=1)['total'] == 3
+
+        # 绕过存储直接改写文件（旧版本写入、手工编辑），.idx 中的偏移不再对应
+        filepath = store._path(MODEL, conversation_id)
+        with open(filepath, 'r', encoding='utf-8') as f:
+            history = json.load(f)
+        history.insert(1, {'sender': 'user', 'text': 'inserted ' * 10, 'id': 'x'})
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(history, f)
+
+        page = history_service.get_messages_page(conversation_id, MODEL, after='x', limit=10)
+        assert _texts(page['messages']) == ['message 0', 'message 1', 'message 2']
+        assert page['total'] == 4
+    finally:
+        history_store.set_store(None)
+
+
+def test_conversation_cursor_paging(store):
+    created = []
+    for i in range(5):
+        conversation_id = f'20240101_{i + 1}_{i:08x}'
+        store.import_conversation(MODEL, conversation_id, history_service._new_metadata(conversation_id, MODEL),
+                                  [], timestamp=1_700_000_000_000 + i * 1000)
+        created.append(conversation_id)
+
+    seen, cursor = [], None
+    while True:
+        page = history_service.list_conversations_page(MODEL, limit=2, cursor=cursor)
+        seen.extend(c['id'] for c in page['conversations'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+        # 翻页期间新建的对话排在最前，不影响后续页
+        if len(seen) == 2:
+            history_service.create_new_conversation(MODEL)
+    assert seen == list(reversed(created))
+
+    with pytest.raises(ValueError):
+        history_service.list_conversations_page(MODEL, cursor='@@@')
+
+
+def test_archive_rehydrate_round_trip(tmp_path):
+    store = history_store.FileHistoryStore(str(tmp_path))
+    history_store.set_store(store)
+    try:
+        conversation_id = history_service.create_new_conversation(MODEL)
+        for i in range(3):
+            _save(conversation_id, f'message {i}' * 50, id=f'm{i}')
+        history_service.rename_conversation_name(conversation_id, 'archived', MODEL)
+        filepath = store._path(MODEL, conversation_id)
+        mtime_ns = os.stat(filepath).st_mtime_ns
+
+        result = store.archive_idle(time.time() + 60)
+        assert result['archived'] == 1 and result['bytes_after'] < result['bytes_before']
+        assert not os.path.exists(filepath) and os.path.exists(filepath + '.gz')
+
+        # 列表与元数据直接读取压缩文件，不还原
+        assert history_service.list_conversations(MODEL)[0]['name'] == 'archived'
+        assert history_service.get_conversation_metadata(conversation_id, MODEL)['custom_name'] == 'archived'
+        assert not os.path.exists(filepath)
+
+        page = history_service.get_messages_page(conversation_id, MODEL, after='m0')
+        assert _texts(page['messages']) == ['message 1' * 50, 'message 2' * 50]
+        assert os.path.exists(filepath) and not os.path.exists(filepath + '.gz')
+        assert os.stat(filepath).st_mtime_ns == mtime_ns
+
+        # 刚还原的对话不会在下一轮被再次归档
+        assert store.archive_idle(time.time() - 60)['archived'] == 0
+        store.archive_idle(time.time() + 60)
+        _save(conversation_id, 'after archive')
+        assert len(history_service.get_messages(conversation_id, MODEL)) == 4
+    finally:
+        history_store.set_store(None)
+
+
+def _allocate(backend, root, day, count, queue):
+    store = _make_store(backend, root)
+    queue.put([store.next_sequence(MODEL, day) for _ in range(count)])
+
+
+def _append(backend, root, conversation_id, worker, count):
+    history_store.set_store(_make_store(backend, root))
+    for i in range(count):
+        _save(conversation_id, f'worker {worker} message {i}')
+
+
+@pytest.mark.parametrize('backend', ['file', 'sqlite'])
+def test_concurrent_writers(backend, tmp_path):
+    root = str(tmp_path)
+    history_store.set_store(_make_store(backend, root))
+    try:
+        conversation_id = history_service.create_new_conversation(MODEL)
+        ctx = multiprocessing.get_context('fork')
+        queue = ctx.Queue()
+        workers, count = 4, 10
+        processes = [ctx.Process(target=_allocate, args=(backend, root, '20240102', count, queue))
+                     for _ in range(workers)]
+        processes += [ctx.Process(target=_append, args=(backend, root, conversation_id, w, count))
+                      for w in range(workers)]
+        for process in processes:
+            process.start()
+        allocated = sorted(value for _ in range(workers) for value in queue.get(timeout=60))
+        for process in processes:
+            process.join(timeout=60)
+            assert process.exitcode == 0
+
+        assert allocated == list(range(1, workers * count + 1))
+        messages = history_service.get_messages(conversation_id, MODEL)
+        assert sorted(_texts(messages)) == sorted(f'worker {w} message {i}'
+                                                  for w in range(workers) for i in range(count))
+    finally:
+        history_store.set_store(None)
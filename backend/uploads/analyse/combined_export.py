@@ -3,11 +3,48 @@
 # combined_export.py - Export both decompiled C code and disassembly (Jython 2.7 compatible)
 
 import os
+import re
 import json
+import hashlib
 from ghidra.app.decompiler import DecompInterface
 from ghidra.util.task import ConsoleTaskMonitor
 import datetime
 
+# Instruction normalization - must stay in sync with backend/app/services/diff_service.py
+_ADDRESS_RE = re.compile(r'0x[0-9a-fA-F]{4,}')
+_AUTO_NAME_RE = re.compile(r'\b(FUN|DAT|LAB|PTR|SUB|UNK|thunk_FUN|switchD|caseD|s|u)_[0-9a-fA-F]+\b')
+
+def normalize_instruction(code):
+    """Strip link-address dependent parts from an instruction"""
+    code = _AUTO_NAME_RE.sub(r'\1_#', code)
+    return _ADDRESS_RE.sub('#', code)
+
+def instruction_hash(disassembly):
+    """Stable hash of a function's normalized instruction sequence"""
+    lines = [normalize_instruction(item["code"]) for item in disassembly if "code" in item]
+    return hashlib.sha1(u"\n".join(lines).encode("utf-8")).hexdigest()
+
+def load_previous_decompilation():
+    """Map instruction hash -> decompiled C from PREVIOUS_ANALYSIS (if set)"""
+    previous_file = os.environ.get('PREVIOUS_ANALYSIS')
+    if not previous_file or not os.path.exists(previous_file):
+        return {}
+    try:
+        with open(previous_file, "r") as f:
+            previous = json.load(f)
+    except Exception as e:
+        print("Failed to load previous analysis %s: %s" % (previous_file, str(e)))
+        return {}
+    reusable = {}
+    for func in previous.get("functions", []):
+        func_hash = func.get("instruction_hash")
+        if not func_hash and func.get("disassembly"):
+            func_hash = instruction_hash(func["disassembly"])
+        if func_hash and func.get("c_code"):
+            reusable[func_hash] = func["c_code"]
+    print("Loaded %d reusable functions from %s" % (len(reusable), previous_file))
+    return reusable
+
 def get_decompiled_c(function):
     """Get decompiled C code for a function"""
     try:
@@ -37,6 +74,77 @@ def get_disassembly(function, program):
     
     return disassembly
 
+def _external_name(symbol_or_function):
+    """Return (library, name) for an external symbol/function"""
+    try:
+        ext_loc = symbol_or_function.getExternalLocation()
+        return str(ext_loc.getLibraryName()), str(ext_loc.getLabel())
+    except Exception:
+        return None, str(symbol_or_function.getName())
+
+def _resolve_external(program, address):
+    """If address refers (directly or through a pointer such as an IAT slot) to an external, return (library, name)"""
+    if address.isExternalAddress():
+        symbol = program.getSymbolTable().getPrimarySymbol(address)
+        if symbol is not None:
+            return _external_name(symbol)
+        return None
+    for ref in program.getReferenceManager().getReferencesFrom(address):
+        to_addr = ref.getToAddress()
+        if to_addr.isExternalAddress():
+            symbol = program.getSymbolTable().getPrimarySymbol(to_addr)
+            if symbol is not None:
+                return _external_name(symbol)
+    return None
+
+def get_references(function, program):
+    """Collect call edges, imported API references and string references for a function"""
+    callees = []
+    imported_apis = []
+    string_refs = []
+    seen_callees = set()
+    seen_imports = set()
+    seen_strings = set()
+    try:
+        function_manager = program.getFunctionManager()
+        listing = program.getListing()
+        for instruction in listing.getInstructions(function.getBody(), True):
+            for ref in instruction.getReferencesFrom():
+                to_addr = ref.getToAddress()
+                ref_type = ref.getReferenceType()
+                if ref_type.isCall():
+                    target = function_manager.getFunctionAt(to_addr)
+                    if target is not None and target.isThunk():
+                        target = target.getThunkedFunction(True)
+                    if target is not None and target.isExternal():
+                        lib, name = _external_name(target)
+                        key = (lib, name)
+                        if key not in seen_imports:
+                            seen_imports.add(key)
+                            imported_apis.append({"library": lib, "name": name, "site": "0x%s" % instruction.getAddress()})
+                        continue
+                    if target is not None:
+                        entry = "0x%s" % target.getEntryPoint()
+                        if entry not in seen_callees:
+                            seen_callees.add(entry)
+                            callees.append(entry)
+                        continue
+                external = _resolve_external(program, to_addr)
+                if external is not None:
+                    if external not in seen_imports:
+                        seen_imports.add(external)
+                        imported_apis.append({"library": external[0], "name": external[1], "site": "0x%s" % instruction.getAddress()})
+                    continue
+                data = listing.getDataAt(to_addr)
+                if data is not None and data.hasStringValue():
+                    address = "0x%s" % to_addr
+                    if address not in seen_strings:
+                        seen_strings.add(address)
+                        string_refs.append({"address": address, "value": unicode(data.getValue())})
+    except Exception as e:
+        print("Reference extraction failed for %s: %s" % (function.getName(), str(e)))
+    return callees, imported_apis, string_refs
+
 def export_function_data():
     try:
         # 优先使用环境变量OUTPUT_FILE
@@ -63,28 +171,49 @@ def export_function_data():
                 "language_id": str(program.getLanguageID()),
                 "compiler_spec_id": str(program.getCompilerSpec().getCompilerSpecID())
             },
-            "functions": []
+            "functions": [],
+            "call_edges": []
         }
         
         function_manager = program.getFunctionManager()
         functions = list(function_manager.getFunctions(True))
         
         print("Processing %d functions..." % len(functions))
+        reusable = load_previous_decompilation()
+        reused_count = 0
         
         for function in functions:
             func_name = str(function.getName())
             print("Processing function: " + func_name)
             
+            entry_point = "0x%s" % function.getEntryPoint()
+            callees, imported_apis, string_refs = get_references(function, program)
+            disassembly = get_disassembly(function, program)
+            func_hash = instruction_hash(disassembly)
+            # Unchanged functions (same normalized instructions) reuse the previous decompilation
+            reused = func_hash in reusable
+            if reused:
+                reused_count += 1
             func_data = {
                 "name": func_name,
-                "entry_point": "0x%s" % function.getEntryPoint(),
+                "entry_point": entry_point,
                 "signature": str(function.getSignature(True)),
-                "c_code": get_decompiled_c(function),
-                "disassembly": get_disassembly(function, program)
+                "c_code": reusable[func_hash] if reused else get_decompiled_c(function),
+                "disassembly": disassembly,
+                "instruction_hash": func_hash,
+                "reused": reused,
+                "callees": callees,
+                "imported_apis": imported_apis,
+                "string_refs": string_refs
             }
             
             result["functions"].append(func_data)
+            for callee in callees:
+                result["call_edges"].append([entry_point, callee])
         
+        if reusable:
+            print("Reused decompilation for %d of %d functions" % (reused_count, len(functions)))
+
         with open(output_file, "w") as f:
             json.dump(result, f, indent=2)
             
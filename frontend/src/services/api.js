@@ -282,12 +282,13 @@ export async function uploadFile(file, conversationId, model, user = 'vue-app-us
     console.log(`API: 上传文件 ${fileName}`);
     
     // 构建最简单的FormData，与Python脚本保持一致
+    // 元数据字段放在文件之前，后端可在收到文件内容时直接流式转发到Dify，无需落盘
     const formData = new FormData();
-    // 使用原始文件，不修改其内容或类型
-    formData.append('file', file);
     formData.append('user', user);
     formData.append('model', model);
     formData.append('conversation_id', conversationId);
+    // 使用原始文件，不修改其内容或类型
+    formData.append('file', file);
     
     // 发送请求，保持与后端相同的简单格式
     const response = await fetch(`${BACKEND_URL}/chat/upload`, {